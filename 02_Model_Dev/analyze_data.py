@@ -1,5 +1,6 @@
 import json
 import re
+import sys
 from collections import defaultdict
 
 # Define the expected mappings based on observation and tool definitions
@@ -37,50 +38,70 @@ action_counts = defaultdict(int)
 total_samples = 0
 malformed_samples = 0
 
-with open('driver_assist_finetune.jsonl', 'r') as f:
-    for line in f:
-        try:
-            data = json.loads(line)
-            text = data.get('text', '')
+# Structured sidecar (step1 dataset_context.jsonl): no prompt parsing needed
+context_path = sys.argv[1] if len(sys.argv) > 1 else None
+
+if context_path:
+    with open(context_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                malformed_samples += 1
+                continue
+            for key in record["context"].keys():
+                context_counts[key] += 1
+            for action in record["expected"]:
+                name = action.get('name')
+                if name:
+                    action_counts[name] += 1
+            total_samples += 1
+
+else:
+    with open('driver_assist_finetune.jsonl', 'r') as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+                text = data.get('text', '')
             
-            # Extract Input Context
-            # Pattern: Input context is structured sensor state (do not invent fields):\n{...}\n\nUser prompt:
-            context_match = re.search(r'Input context is structured sensor state \(do not invent fields\):\n(\{.*?\})\n\nUser prompt:', text, re.DOTALL)
-            if context_match:
-                try:
-                    context_json_str = context_match.group(1)
-                    context_data = json.loads(context_json_str)
+                # Extract Input Context
+                # Pattern: Input context is structured sensor state (do not invent fields):\n{...}\n\nUser prompt:
+                context_match = re.search(r'Input context is structured sensor state \(do not invent fields\):\n(\{.*?\})\n\nUser prompt:', text, re.DOTALL)
+                if context_match:
+                    try:
+                        context_json_str = context_match.group(1)
+                        context_data = json.loads(context_json_str)
                     
-                    for key in context_data.keys():
-                        # Count the key itself
-                        # Also try to map it to a tool
-                        # We track all keys found to see if there are any we missed
-                        context_counts[key] += 1
+                        for key in context_data.keys():
+                            # Count the key itself
+                            # Also try to map it to a tool
+                            # We track all keys found to see if there are any we missed
+                            context_counts[key] += 1
                         
-                except json.JSONDecodeError:
-                    print("Failed to decode context JSON")
-                    pass
+                    except json.JSONDecodeError:
+                        print("Failed to decode context JSON")
+                        pass
             
-            # Extract Model Response (Action Tools)
-            # Pattern: <start_of_turn>model\n[...]
-            model_match = re.search(r'<start_of_turn>model\n(\[.*?\])<end_of_turn>', text, re.DOTALL)
-            if model_match:
-                try:
-                    actions_json_str = model_match.group(1)
-                    actions_data = json.loads(actions_json_str)
+                # Extract Model Response (Action Tools)
+                # Pattern: <start_of_turn>model\n[...]
+                model_match = re.search(r'<start_of_turn>model\n(\[.*?\])<end_of_turn>', text, re.DOTALL)
+                if model_match:
+                    try:
+                        actions_json_str = model_match.group(1)
+                        actions_data = json.loads(actions_json_str)
                     
-                    for action in actions_data:
-                        name = action.get('name')
-                        if name:
-                            action_counts[name] += 1
-                except json.JSONDecodeError:
-                    print("Failed to decode action JSON")
-                    pass
+                        for action in actions_data:
+                            name = action.get('name')
+                            if name:
+                                action_counts[name] += 1
+                    except json.JSONDecodeError:
+                        print("Failed to decode action JSON")
+                        pass
             
-            total_samples += 1
+                total_samples += 1
             
-        except json.JSONDecodeError:
-            malformed_samples += 1
+            except json.JSONDecodeError:
+                malformed_samples += 1
 
 print(f"Total Samples: {total_samples}")
 print(f"Malformed Lines: {malformed_samples}")
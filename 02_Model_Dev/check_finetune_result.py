@@ -1,12 +1,19 @@
 
+import argparse
 import json
+import sys
 import torch
 import os
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from peft import PeftModel
 from tqdm import tqdm
 
-# --- 설정 (경로 수정 필요 시 여기를 변경하세요) ---
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline"))
+from utils.model_cache import load_cached_model, default_cache_dir
+from utils.inference_backends import generate_batch
+from utils.metric_utils import ToolCallMatchMetric
+
+# --- 설정 (경로 수정 필요 시 여기를 변경하거나 CLI 인자로 넘기세요) ---
 BASE_MODEL_NAME = "google/functiongemma-270m-it"
 # 파인튜닝 결과물 (LoRA 어댑터) 경로
 ADAPTER_PATH = "./pipeline/history/01_seed/run_v5/test_finetune_output/final_model"
@@ -19,10 +26,18 @@ OUTPUT_FILE = "comparison_report.txt"
 DEVICE = "cpu"
 DTYPE = torch.float32
 
+# PEFT mixed-batch 추론에서 어댑터를 끈 상태를 뜻하는 이름
+BASE_VARIANT = "__base__"
+
 def load_base_model(model_name):
     print(f"Loading Base Model: {model_name} on {DEVICE}...")
     tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-    
+
+    # MODEL_CACHE_DIR 설정 시 dtype 변환된 safetensors 캐시에서 바로 로드
+    if default_cache_dir():
+        model = load_cached_model(model_name, dtype=DTYPE, device=DEVICE)
+        return model, tokenizer
+
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
         torch_dtype=DTYPE,
@@ -31,119 +46,162 @@ def load_base_model(model_name):
     )
     return model, tokenizer
 
-def run_inference(model, tokenizer, prompt):
-    # 데이터셋의 불필요한 태그 제거
-    cleaned_prompt = prompt.replace("<end_of_turn>", "").strip()
-    
-    # Gemma 프롬프트 포맷 적용
-    # tokenizer.bos_token이 설정 안 된 경우 대비
-    bos = tokenizer.bos_token if tokenizer.bos_token else "<bos>"
-    formatted_prompt = f"{bos}<start_of_turn>user\n{cleaned_prompt}<end_of_turn>\n<start_of_turn>model\n"
-    
-    inputs = tokenizer(
-        formatted_prompt, 
-        return_tensors="pt", 
-        add_special_tokens=False
-    ).to(model.device)
-    
-    # 종료 조건 설정
-    terminators = [
-        tokenizer.eos_token_id,
-        tokenizer.convert_tokens_to_ids("<end_of_turn>")
-    ]
-    
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=256,
-            do_sample=False, # 결정론적 결과 (Greedy Decoding)
-            eos_token_id=terminators,
-        )
-    
-    # 입력 프롬프트 제외하고 생성된 답변만 추출
-    input_len = inputs.input_ids.shape[1]
-    generated_ids = outputs[0][input_len:]
-    response = tokenizer.decode(generated_ids, skip_special_tokens=True)
-    
-    return response.strip()
-
-def main():
-    if not os.path.exists(ADAPTER_PATH):
-        print(f"Error: Adapter path not found: {ADAPTER_PATH}")
-        return
-    if not os.path.exists(DATA_PATH):
-        print(f"Error: Data path not found: {DATA_PATH}")
-        return
-
-    print(f"Reading data from {DATA_PATH}")
-    with open(DATA_PATH, "r") as f:
-        # 테스트 시간을 위해 앞쪽 3개 샘플만 사용 (전체 실행하려면 슬라이싱 제거)
-        samples = [json.loads(line) for line in f][:3]
-
-    # 1. Base Model 실행
-    print("\n" + "="*50)
-    print("Phase 1: Running Base Model (Before Finetuning)")
-    print("="*50)
-    model, tokenizer = load_base_model(BASE_MODEL_NAME)
-    
-    results = []
-    for sample in tqdm(samples, desc="Base Model Inference"):
-        user_msg = next((m["content"] for m in sample["messages"] if m["role"] == "user"), "")
-        base_output = run_inference(model, tokenizer, user_msg)
-        
-        # 긴 프롬프트 요약 (화면 표시용)
-        try:
-            short_prompt = user_msg.split("User prompt:\n")[-1].split("\n\nReturn")[0].strip()
-        except:
-            short_prompt = "Context..."
-
-        results.append({
-            "id": sample["id"],
-            "input": short_prompt,
-            "full_input": user_msg,
-            "expected": json.dumps(sample["expected"], indent=2),
-            "base_output": base_output
-        })
-
-    # 2. Finetuned Model (Adapter) 로드 및 실행
-    print("\n" + "="*50)
-    print("Phase 2: Loading Adapter & Running Finetuned Model")
-    print("="*50)
-    print(f"Loading Adapter from {ADAPTER_PATH}")
-    model = PeftModel.from_pretrained(model, ADAPTER_PATH)
+def load_adapters(base_model, adapters):
+    """
+    Base 모델 하나에 여러 LoRA 어댑터를 이름별로 올립니다.
+    adapters: {name: path}
+    """
+    names = list(adapters)
+    print(f"Loading Adapter '{names[0]}' from {adapters[names[0]]}")
+    model = PeftModel.from_pretrained(base_model, adapters[names[0]], adapter_name=names[0])
+    for name in names[1:]:
+        print(f"Loading Adapter '{name}' from {adapters[name]}")
+        model.load_adapter(adapters[name], adapter_name=name)
     model.to(DEVICE)
     model.eval()
-    
-    for i, sample in enumerate(tqdm(samples, desc="Finetuned Model Inference")):
-        ft_output = run_inference(model, tokenizer, results[i]["full_input"])
-        results[i]["ft_output"] = ft_output
+    return model
 
-    # 3. 결과 저장 및 출력
-    print(f"\nSaving detailed comparison to {OUTPUT_FILE}...")
-    with open(OUTPUT_FILE, "w") as f:
+def generate_variants(model, tokenizer, prompts, variants):
+    """
+    모든 variant(base + 어댑터들)의 출력을 한 번의 batched generate로 계산합니다.
+    PEFT 버전이 mixed-adapter batch를 지원하지 않으면 variant별로
+    disable_adapter()/set_adapter()를 사용해 배치 추론합니다.
+    Returns: {variant: [output, ...]}
+    """
+    try:
+        flat_prompts = [p for p in prompts for _ in variants]
+        flat_names = [v for _ in prompts for v in variants]
+        flat_outputs = generate_batch(model, tokenizer, flat_prompts, adapter_names=flat_names)
+        return {v: flat_outputs[i::len(variants)] for i, v in enumerate(variants)}
+    except (TypeError, ValueError):
+        outputs = {}
+        for v in variants:
+            if v == BASE_VARIANT:
+                with model.disable_adapter():
+                    outputs[v] = generate_batch(model, tokenizer, prompts)
+            else:
+                model.set_adapter(v)
+                outputs[v] = generate_batch(model, tokenizer, prompts)
+        return outputs
+
+def parse_adapters(specs):
+    """
+    ["run_v4=path/a", "run_v5=path/b"] -> {"run_v4": "path/a", "run_v5": "path/b"}
+    이름이 없으면 "finetuned"를 사용합니다.
+    """
+    adapters = {}
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = ("finetuned" if not adapters else f"adapter_{len(adapters)}"), spec
+        adapters[name] = path
+    return adapters
+
+def write_report(output_file, results, variants, accuracy):
+    labels = {v: ("Base Model" if v == BASE_VARIANT else f"Finetuned [{v}]") for v in variants}
+    with open(output_file, "w") as f:
         f.write("="*80 + "\n")
-        f.write("COMPARISON RESULTS (Base vs Finetuned)\n")
+        f.write(f"COMPARISON RESULTS ({' vs '.join(labels[v] for v in variants)})\n")
+        f.write("="*80 + "\n")
+        for v in variants:
+            f.write(f"{labels[v]:<40} accuracy: {accuracy[v]:.2%}\n")
         f.write("="*80 + "\n")
         for res in results:
             f.write(f"\n[Sample ID: {res['id']}]\n")
             f.write(f"Input Command: {res['input']}\n")
             f.write("-" * 40 + "\n")
             f.write(f"Expected (Label):\n{res['expected']}\n")
-            f.write("-" * 40 + "\n")
-            f.write(f"Base Model Output:\n{res['base_output']}\n")
-            f.write("-" * 40 + "\n")
-            f.write(f"Finetuned Model Output:\n{res['ft_output']}\n")
+            for v in variants:
+                mark = "O" if res["correct"][v] else "X"
+                f.write("-" * 40 + "\n")
+                f.write(f"{labels[v]} Output [{mark}]:\n{res['outputs'][v]}\n")
             f.write("="*80 + "\n")
-            
+
+def main():
+    parser = argparse.ArgumentParser(description="Base vs fine-tuned (multi-adapter) comparison with a single model load")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL_NAME)
+    parser.add_argument("--adapters", type=str, nargs="+", default=[ADAPTER_PATH],
+                        help="name=path pairs, e.g. run_v4=pipeline/history/01_seed/run_v4/final_model")
+    parser.add_argument("--data-path", type=str, default=DATA_PATH)
+    parser.add_argument("--output", type=str, default=OUTPUT_FILE)
+    parser.add_argument("--batch-size", type=int, default=8, help="Samples per batch (each sample runs once per variant)")
+    parser.add_argument("--limit", type=int, default=0, help="0 means all samples")
+    parser.add_argument("--no-base", action="store_true", help="Only compare adapters")
+    args = parser.parse_args()
+
+    adapters = parse_adapters(args.adapters)
+    for name, path in adapters.items():
+        if not os.path.exists(path):
+            print(f"Error: Adapter path not found ({name}): {path}")
+            return
+    if not os.path.exists(args.data_path):
+        print(f"Error: Data path not found: {args.data_path}")
+        return
+
+    print(f"Reading data from {args.data_path}")
+    with open(args.data_path, "r") as f:
+        samples = [json.loads(line) for line in f]
+    if args.limit > 0:
+        samples = samples[:args.limit]
+
+    # 1. Base 모델을 한 번만 로드하고 모든 어댑터를 올림
+    print("\n" + "="*50)
+    print("Loading Base Model & Adapters (single load)")
+    print("="*50)
+    base_model, tokenizer = load_base_model(args.base_model)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = load_adapters(base_model, adapters)
+
+    variants = ([] if args.no_base else [BASE_VARIANT]) + list(adapters)
+
+    # 2. 배치 단위로 모든 variant를 같은 pass에서 추론
+    results = []
+    correct = {v: 0 for v in variants}
+    for i in tqdm(range(0, len(samples), args.batch_size), desc="Comparison Inference"):
+        batch = samples[i:i + args.batch_size]
+        prompts = []
+        for sample in batch:
+            user_msg = next((m["content"] for m in sample["messages"] if m["role"] == "user"), "")
+            # 데이터셋의 불필요한 태그 제거
+            prompts.append(user_msg.replace("<end_of_turn>", "").strip())
+
+        outputs = generate_variants(model, tokenizer, prompts, variants)
+
+        for j, sample in enumerate(batch):
+            # 긴 프롬프트 요약 (화면 표시용)
+            try:
+                short_prompt = prompts[j].split("User prompt:\n")[-1].split("\n\nReturn")[0].strip()
+            except:
+                short_prompt = "Context..."
+
+            res = {
+                "id": sample["id"],
+                "input": short_prompt,
+                "expected": json.dumps(sample["expected"], indent=2),
+                "outputs": {},
+                "correct": {},
+            }
+            for v in variants:
+                is_match, _, _ = ToolCallMatchMetric.match(outputs[v][j], sample["expected"])
+                res["outputs"][v] = outputs[v][j]
+                res["correct"][v] = is_match
+                correct[v] += int(is_match)
+            results.append(res)
+
+    accuracy = {v: correct[v] / len(results) if results else 0.0 for v in variants}
+
+    # 3. 결과 저장 및 출력
+    print(f"\nSaving detailed comparison to {args.output}...")
+    write_report(args.output, results, variants, accuracy)
+
     # 화면에 간단 요약 출력
     print("\n" + "="*80)
-    print("Sample Results Preview:")
-    for res in results:
-        print(f"\nCommand: {res['input']}")
-        print(f" -> Base: {res['base_output'][:50]}...")
-        print(f" -> Finetuned: {res['ft_output']}")
+    print("Accuracy Summary:")
+    for v in variants:
+        print(f" -> {v}: {accuracy[v]:.2%}")
     print("="*80)
-    print(f"\nDone! Check {OUTPUT_FILE} for full details.")
+    print(f"\nDone! Check {args.output} for full details.")
 
 if __name__ == "__main__":
     main()
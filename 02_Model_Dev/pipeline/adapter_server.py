@@ -0,0 +1,273 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftModel
+from utils.inference_backends import generate_batch
+
+# Route name for requests that should run on the plain base model
+BASE_ADAPTER = "__base__"
+
+class AdapterServer:
+    """
+    Keeps one base model in memory and serves many LoRA adapters by name.
+    - Requests are queued and batched (up to max_batch_size, waiting at most
+      max_wait_ms); rows for different adapters share one generate call
+      through PEFT mixed-adapter batches.
+    - At most max_loaded adapters stay attached; the least recently used one
+      is deleted when a new one is needed.
+    - Latency (queue wait + generation) is tracked per adapter over the
+      last latency_window requests.
+    """
+
+    def __init__(self, base_model_name, adapters, max_loaded=4, max_batch_size=8, max_wait_ms=20, device=None, latency_window=1000):
+        self.adapter_paths = dict(adapters)
+        self.max_loaded = max(1, max_loaded)
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        dtype = torch.float16 if device == "cuda" else torch.float32
+        print(f"Loading base model: {base_model_name} ({device}, {dtype})")
+        self.tokenizer = AutoTokenizer.from_pretrained(base_model_name, trust_remote_code=True)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_name,
+            torch_dtype=dtype,
+            trust_remote_code=True
+        ).to(device)
+        self.base_model.eval()
+        self.model = None # PeftModel, created with the first adapter
+
+        self.loaded = OrderedDict() # adapter name -> None, in LRU order
+        self.counters = defaultdict(int)
+        self.requests = Counter()
+        self.latencies = defaultdict(lambda: deque(maxlen=latency_window))
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    # --- Adapter management ---
+
+    def register(self, name, path):
+        with self._lock:
+            self.adapter_paths[name] = path
+
+    def _load(self, name):
+        path = self.adapter_paths[name]
+        print(f"Loading adapter '{name}' from {path}")
+        if self.model is None:
+            self.model = PeftModel.from_pretrained(self.base_model, path, adapter_name=name)
+            self.model.eval()
+        else:
+            self.model.load_adapter(path, adapter_name=name)
+        self.counters["adapter_loads"] += 1
+
+    def _ensure_loaded(self, names):
+        for name in names:
+            if name == BASE_ADAPTER:
+                continue
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                continue
+            # Load before evicting so the PeftModel never ends up with zero adapters
+            self._load(name)
+            self.loaded[name] = None
+            while len(self.loaded) > self.max_loaded:
+                victim = next(v for v in self.loaded if v not in names)
+                print(f"Evicting idle adapter '{victim}'")
+                self.model.delete_adapter(victim)
+                del self.loaded[victim]
+                self.counters["adapter_evictions"] += 1
+
+    # --- Request handling ---
+
+    def submit(self, adapter, prompt):
+        if adapter != BASE_ADAPTER and adapter not in self.adapter_paths:
+            raise KeyError(f"Unknown adapter: {adapter}")
+        future = Future()
+        self._queue.put((adapter, prompt, time.perf_counter(), future))
+        return future
+
+    def generate(self, adapter, prompt, timeout=None):
+        return self.submit(adapter, prompt).result(timeout=timeout)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _split_by_capacity(self, batch):
+        """
+        Split a batch so each chunk needs at most max_loaded distinct adapters.
+        """
+        chunks, current, names = [], [], set()
+        for req in batch:
+            adapter = req[0]
+            if adapter != BASE_ADAPTER and adapter not in names and len(names) >= self.max_loaded:
+                chunks.append(current)
+                current, names = [], set()
+            current.append(req)
+            if adapter != BASE_ADAPTER:
+                names.add(adapter)
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _serve_chunk(self, chunk):
+        names = [req[0] for req in chunk]
+        with self._lock:
+            self._ensure_loaded(set(names))
+            model = self.model if self.model is not None else self.base_model
+            adapter_names = names if self.model is not None else None
+            outputs = generate_batch(model, self.tokenizer, [req[1] for req in chunk], adapter_names=adapter_names)
+
+        done = time.perf_counter()
+        latencies = [(done - req[2]) * 1000.0 for req in chunk]
+        with self._lock:
+            for adapter, latency_ms in zip(names, latencies):
+                self.requests[adapter] += 1
+                self.latencies[adapter].append(latency_ms)
+            self.counters["batches"] += 1
+        for (adapter, _, _, future), output, latency_ms in zip(chunk, outputs, latencies):
+            future.set_result({"adapter": adapter, "output": output, "latency_ms": latency_ms})
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            for chunk in self._split_by_capacity(batch):
+                try:
+                    self._serve_chunk(chunk)
+                except Exception as e:
+                    for req in chunk:
+                        req[3].set_exception(e)
+
+    def stats(self):
+        # Snapshot under the lock; the worker adds adapters and evicts while serving
+        with self._lock:
+            latencies = {adapter: list(values) for adapter, values in self.latencies.items()}
+            requests = dict(self.requests)
+            loaded = list(self.loaded)
+            registered = list(self.adapter_paths)
+            counters = dict(self.counters)
+        per_adapter = {}
+        for adapter, values in latencies.items():
+            per_adapter[adapter] = {
+                "requests": requests[adapter],
+                "latency_window": len(values),
+                "latency_ms_mean": float(np.mean(values)),
+                "latency_ms_p50": float(np.percentile(values, 50)),
+                "latency_ms_p95": float(np.percentile(values, 95)),
+            }
+        return {
+            "loaded_adapters": loaded,
+            "registered_adapters": registered,
+            "counters": counters,
+            "per_adapter": per_adapter,
+        }
+
+    def close(self):
+        self._stop.set()
+        self._worker.join(timeout=5)
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, server.stats())
+            else:
+                self._reply(404, {"error": "not_found"})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._reply(404, {"error": "not_found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                req = json.loads(self.rfile.read(length) or b"{}")
+                result = server.generate(req.get("adapter", BASE_ADAPTER), req["prompt"])
+                self._reply(200, result)
+            except KeyError as e:
+                self._reply(400, {"error": str(e)})
+            except Exception as e:
+                self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, format, *args):
+            pass # Keep the console for adapter load/evict messages
+
+    return Handler
+
+
+def parse_adapters(specs):
+    adapters = {}
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            raise ValueError(f"Adapter spec must be name=path, got: {spec}")
+        adapters[name] = path
+    return adapters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve many LoRA adapters on one base model (A/B testing)")
+    parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--adapters", type=str, nargs="+", required=True,
+                        help="name=path pairs, e.g. run_v4=history/01_seed/run_v4/final_model")
+    parser.add_argument("--max-loaded", type=int, default=4, help="Adapters kept in memory (LRU eviction)")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=int, default=20, help="How long to wait to fill a batch")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    server = AdapterServer(
+        args.base_model,
+        parse_adapters(args.adapters),
+        max_loaded=args.max_loaded,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print(f"🚀 Serving adapters {list(server.adapter_paths)} on http://{args.host}:{args.port}")
+    print('   POST /generate {"adapter": "<name>|__base__", "prompt": "..."}   GET /stats')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.close()
+        print(json.dumps(server.stats(), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import mlflow
+from step3_evaluate import run_evaluation
+from utils.mlflow_logger import run_logger
+
+def compare_results(reference_results, candidate_results):
+    """
+    Per-sample agreement between two eval_results.json lists (matched by id).
+    """
+    ref_by_id = {r["id"]: r for r in reference_results}
+    same_output = 0
+    same_verdict = 0
+    flipped = []
+    for r in candidate_results:
+        ref = ref_by_id.get(r["id"])
+        if ref is None:
+            continue
+        if r["predicted_parsed"] == ref["predicted_parsed"]:
+            same_output += 1
+        if r["is_correct"] == ref["is_correct"]:
+            same_verdict += 1
+        else:
+            flipped.append({"id": r["id"], "reference_correct": ref["is_correct"], "candidate_correct": r["is_correct"]})
+    total = len(candidate_results) or 1
+    return {
+        "output_agreement": same_output / total,
+        "verdict_agreement": same_verdict / total,
+        "flipped_samples": flipped,
+    }
+
+def parse_variant(variant):
+    """
+    "torch" -> ("torch", "none"), "torch:int8" -> ("torch", "int8")
+    """
+    backend, _, quantize = variant.partition(":")
+    return backend, quantize or "none"
+
+def run_parity(model_path, dataset_path, base_model_name, output_dir, backends):
+    """
+    Evaluate the same adapter on every backend variant and compare against the
+    first one. Variants are "<backend>[:<quantize>]", e.g. torch, torch:int8, onnx.
+    """
+    reports = {}
+    results_by_backend = {}
+    for variant in backends:
+        print(f"\n[Parity] Backend: {variant}")
+        backend, quantize = parse_variant(variant)
+        backend_dir = os.path.join(output_dir, variant.replace(":", "_"))
+        metrics, res_path, _ = run_evaluation(
+            model_path=model_path,
+            dataset_path=dataset_path,
+            base_model_name=base_model_name,
+            output_dir=backend_dir,
+            backend=backend,
+            quantize=quantize,
+        )
+        with open(res_path, "r") as f:
+            results_by_backend[variant] = json.load(f)
+        reports[variant] = {"metrics": metrics}
+
+    reference = backends[0]
+    ref_metrics = reports[reference]["metrics"]
+    for backend in backends[1:]:
+        metrics = reports[backend]["metrics"]
+        reports[backend]["vs_reference"] = {
+            "reference": reference,
+            "accuracy_delta": metrics["accuracy_total"] - ref_metrics["accuracy_total"],
+            "latency_speedup_p50": ref_metrics["latency_ms_p50"] / metrics["latency_ms_p50"] if metrics.get("latency_ms_p50") else None,
+            "model_size_ratio": metrics["model_size_mb"] / ref_metrics["model_size_mb"] if "model_size_mb" in metrics and "model_size_mb" in ref_metrics else None,
+            "rss_model_ratio": metrics["rss_model_mb"] / ref_metrics["rss_model_mb"] if ref_metrics.get("rss_model_mb", 0) > 0 else None,
+            **compare_results(results_by_backend[reference], results_by_backend[backend]),
+        }
+
+    os.makedirs(output_dir, exist_ok=True)
+    report_path = os.path.join(output_dir, "parity_report.json")
+    with open(report_path, "w") as f:
+        json.dump(reports, f, indent=2)
+
+    print("\n" + "=" * 76)
+    print(f"{'backend':<14}{'accuracy':>10}{'valid_json':>12}{'p50 ms':>10}{'p95 ms':>10}{'size MB':>10}{'agree':>10}")
+    for backend in backends:
+        m = reports[backend]["metrics"]
+        agree = reports[backend].get("vs_reference", {}).get("output_agreement", 1.0)
+        print(f"{backend:<14}{m['accuracy_total']:>10.2%}{m['json_validity_score']:>12.2%}"
+              f"{m.get('latency_ms_p50', 0):>10.1f}{m.get('latency_ms_p95', 0):>10.1f}"
+              f"{m.get('model_size_mb', 0):>10.1f}{agree:>10.2%}")
+    print("=" * 76)
+    print(f"Parity report saved to {report_path}")
+    return reports, report_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare accuracy and latency across inference backends")
+    parser.add_argument("--model-path", type=str, required=True, help="Path to adapter (step 2 output)")
+    parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset_canonical.jsonl")
+    parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--output-dir", type=str, default="parity_output")
+    parser.add_argument("--backends", type=str, nargs="+", default=["torch", "onnx"],
+                        help="Variants as backend[:quantize], e.g. torch torch:int8 torch:int4 onnx. First one is the reference")
+    parser.add_argument("--experiment-name", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.experiment_name:
+        mlflow.set_experiment(args.experiment_name)
+
+    with mlflow.start_run(run_name="backend_parity"):
+        reports, report_path = run_parity(
+            args.model_path,
+            args.dataset_path,
+            args.base_model,
+            args.output_dir,
+            args.backends,
+        )
+        for backend, report in reports.items():
+            run_logger.log_metrics({f"{backend.replace(':', '_')}_{k}": v for k, v in report["metrics"].items()})
+        run_logger.log_artifact(report_path)
+        run_logger.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import torch
+
+# Run from anywhere: pipeline/ modules are imported the same way the steps do
+PIPELINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PIPELINE_DIR)
+
+from step1_generate_data import run_generator, generate_random_context, determine_actions, construct_prompt, format_for_finetuning
+from step3_evaluate import _extract_json_from_text
+from utils.finetune_utils import get_data_collator
+from utils.inference_backends import generate_response, generate_batch
+from utils.metric_utils import ToolCallMatchMetric
+
+SPECIAL_TOKENS = ["<pad>", "<eos>", "<bos>", "<unk>", "<start_of_turn>", "<end_of_turn>"]
+BENCHMARKS = ["generate_data", "tokenize", "collator", "inference", "metric", "json_extract"]
+
+# Metric suffixes used for regression comparison
+LOWER_IS_BETTER = ("_ms",)
+HIGHER_IS_BETTER = ("_per_sec",)
+
+
+# --- Offline fixtures ---
+
+def sample_texts(n, seed=0):
+    """
+    Finetune-format texts and canonical (prompt, expected) pairs from the step 1 generator.
+    """
+    random.seed(seed)
+    texts, pairs = [], []
+    for _ in range(n):
+        ctx, prompt_hint, _ = generate_random_context()
+        actions = determine_actions(ctx, prompt_hint)
+        prompt = construct_prompt(ctx, prompt_hint)
+        texts.append(format_for_finetuning(prompt, actions)["text"])
+        pairs.append((prompt, actions))
+    return texts, pairs
+
+def build_offline_tokenizer(corpus, vocab_size=2048):
+    """
+    Small byte-level BPE trained on generated samples, with the Gemma chat
+    special tokens, so no Hub download is needed.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers, processors
+    from transformers import PreTrainedTokenizerFast
+
+    tok = Tokenizer(models.BPE(unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tok.train_from_iterator(corpus, trainer=trainer)
+    tok.post_processor = processors.TemplateProcessing(
+        single="<bos> $A", pair="<bos> $A $B", special_tokens=[("<bos>", tok.token_to_id("<bos>"))]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tok,
+        bos_token="<bos>", eos_token="<eos>", pad_token="<pad>", unk_token="<unk>",
+        additional_special_tokens=["<start_of_turn>", "<end_of_turn>"],
+    )
+
+def build_tiny_model(tokenizer, seed=0):
+    """
+    Randomly initialized Gemma3 text model with the real architecture but
+    tiny dimensions. Outputs are meaningless; only the cost profile matters.
+    """
+    from transformers import Gemma3TextConfig, Gemma3ForCausalLM
+
+    torch.manual_seed(seed)
+    config = Gemma3TextConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        head_dim=32,
+        max_position_embeddings=2048,
+        sliding_window=512,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+    )
+    model = Gemma3ForCausalLM(config)
+    model.eval()
+    return model
+
+
+# --- Timing helpers ---
+
+def time_call(fn, repeat=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return {
+        "mean_ms": float(np.mean(times)),
+        "p50_ms": float(np.percentile(times, 50)),
+        "min_ms": float(np.min(times)),
+    }
+
+
+# --- Benchmarks (each returns a flat dict of metrics) ---
+
+def bench_generate_data(num_samples, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        t = time_call(lambda: run_generator(tmp, num_samples, seed=42), repeat=repeat)
+    return {
+        "generate_data_mean_ms": t["mean_ms"],
+        "generate_data_samples_per_sec": num_samples / (t["p50_ms"] / 1000.0),
+    }
+
+def bench_tokenize(tokenizer, texts, repeat):
+    n_tokens = sum(len(ids) for ids in tokenizer(texts)["input_ids"])
+    t = time_call(lambda: tokenizer(texts), repeat=repeat)
+    return {
+        "tokenize_mean_ms": t["mean_ms"],
+        "tokenize_samples_per_sec": len(texts) / (t["p50_ms"] / 1000.0),
+        "tokenize_tokens_per_sec": n_tokens / (t["p50_ms"] / 1000.0),
+    }
+
+def bench_collator(tokenizer, texts, batch_size, repeat):
+    collator = get_data_collator(tokenizer)
+    encoded = tokenizer(texts)
+    features = [{"input_ids": ids, "attention_mask": mask} for ids, mask in zip(encoded["input_ids"], encoded["attention_mask"])]
+    batches = [features[i:i + batch_size] for i in range(0, len(features), batch_size)]
+    t = time_call(lambda: [collator.torch_call(b) for b in batches], repeat=repeat)
+    return {
+        "collator_batch_mean_ms": t["mean_ms"] / len(batches),
+        "collator_samples_per_sec": len(features) / (t["p50_ms"] / 1000.0),
+    }
+
+def bench_inference(model, tokenizer, prompts, batch_size, max_new_tokens, repeat):
+    # Random weights rarely emit a terminator, so every call decodes max_new_tokens
+    single = time_call(lambda: generate_response(model, tokenizer, prompts[0], max_new_tokens=max_new_tokens), repeat=repeat)
+    batch = prompts[:batch_size]
+    batched = time_call(lambda: generate_batch(model, tokenizer, batch, max_new_tokens=max_new_tokens), repeat=repeat)
+    return {
+        "inference_single_p50_ms": single["p50_ms"],
+        "inference_single_tokens_per_sec": max_new_tokens / (single["p50_ms"] / 1000.0),
+        "inference_batch_p50_ms": batched["p50_ms"],
+        "inference_batch_tokens_per_sec": len(batch) * max_new_tokens / (batched["p50_ms"] / 1000.0),
+    }
+
+def bench_metric(pairs, repeat):
+    # Mix of exact matches, argument mismatches and unparsable outputs
+    cases = []
+    for i, (_, expected) in enumerate(pairs):
+        if i % 3 == 0:
+            cases.append((json.dumps(expected), expected))
+        elif i % 3 == 1:
+            wrong = json.loads(json.dumps(expected))
+            wrong[-1]["arguments"] = {}
+            cases.append((json.dumps(wrong), expected))
+        else:
+            cases.append((json.dumps(expected)[:-5], expected))
+    t = time_call(lambda: [ToolCallMatchMetric.match(text, exp) for text, exp in cases], repeat=repeat)
+    return {
+        "metric_match_mean_ms": t["mean_ms"],
+        "metric_match_calls_per_sec": len(cases) / (t["p50_ms"] / 1000.0),
+    }
+
+def bench_json_extract(pairs, repeat):
+    # Plain JSON, ```json fenced and bare ``` fenced judge outputs
+    texts = []
+    for i, (_, expected) in enumerate(pairs):
+        body = json.dumps({"correct": True, "score": 1.0, "reason": "ok", "expected": expected})
+        texts.append([body, f"Here is the verdict:\n```json\n{body}\n```", f"```\n{body}\n```"][i % 3])
+    t = time_call(lambda: [_extract_json_from_text(text) for text in texts], repeat=repeat)
+    return {
+        "json_extract_mean_ms": t["mean_ms"],
+        "json_extract_calls_per_sec": len(texts) / (t["p50_ms"] / 1000.0),
+    }
+
+
+# --- Reporting ---
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PIPELINE_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def compare_results(current, baseline, threshold=0.1):
+    """
+    Relative change per metric; a regression is a change in the wrong
+    direction larger than `threshold`.
+    """
+    rows = []
+    for key, value in current["metrics"].items():
+        base = baseline.get("metrics", {}).get(key)
+        if base in (None, 0):
+            continue
+        change = (value - base) / base
+        if key.endswith(LOWER_IS_BETTER):
+            regression = change > threshold
+        elif key.endswith(HIGHER_IS_BETTER):
+            regression = change < -threshold
+        else:
+            regression = False
+        rows.append({"metric": key, "baseline": base, "current": value, "change": change, "regression": regression})
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for pipeline hot paths (tiny random Gemma3 model)")
+    parser.add_argument("--only", type=str, nargs="*", default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument("--samples", type=int, default=200, help="Samples for data/tokenizer/collator/metric benchmarks")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=1, help="torch CPU threads (fixed for comparable numbers)")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="Use a real tokenizer (e.g. google/functiongemma-270m-it) instead of the offline BPE")
+    parser.add_argument("--output", type=str, default=None, help="Default: benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline results JSON")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    texts, pairs = sample_texts(args.samples)
+
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    else:
+        tokenizer = build_offline_tokenizer(texts)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    metrics = {}
+    for name in args.only:
+        print(f"⏱️  {name}")
+        if name == "generate_data":
+            metrics.update(bench_generate_data(args.samples, args.repeat))
+        elif name == "tokenize":
+            metrics.update(bench_tokenize(tokenizer, texts, args.repeat))
+        elif name == "collator":
+            metrics.update(bench_collator(tokenizer, texts, args.batch_size, args.repeat))
+        elif name == "inference":
+            model = build_tiny_model(tokenizer)
+            prompts = [prompt for prompt, _ in pairs]
+            metrics.update(bench_inference(model, tokenizer, prompts, args.batch_size, args.max_new_tokens, args.repeat))
+        elif name == "metric":
+            metrics.update(bench_metric(pairs, args.repeat))
+        elif name == "json_extract":
+            metrics.update(bench_json_extract(pairs, args.repeat))
+
+    commit = git_commit()
+    result = {
+        "commit": commit,
+        "created_at": datetime.now().isoformat(),
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "metrics": metrics,
+    }
+
+    output = args.output or os.path.join(PIPELINE_DIR, "benchmarks", "results", f"{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print("=" * 60)
+    for key, value in metrics.items():
+        print(f"{key:<40} {value:>14.3f}")
+    print("=" * 60)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare_results(result, baseline, args.threshold)
+        print(f"\nComparison vs {baseline.get('commit')} (threshold {args.threshold:.0%})")
+        for row in rows:
+            flag = "❌" if row["regression"] else "  "
+            print(f"{flag} {row['metric']:<40} {row['baseline']:>12.3f} -> {row['current']:>12.3f} ({row['change']:+.1%})")
+        if any(row["regression"] for row in rows):
+            print("\nRegressions detected.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import random
+import time
+import mlflow
+import numpy as np
+from step1_generate_data import generate_random_context, evolve_context, determine_actions, construct_prompt, SCENARIO_TYPES
+from step3_evaluate import load_backend
+from utils.metric_utils import ToolCallMatchMetric
+from utils.response_cache import CachedInference, ResponseCache
+from utils.session_inference import DrivingSession
+from utils.mlflow_logger import run_logger
+
+DEFAULT_SCHEDULE = "normal:5,drowsy:5,safe_mode_needed:5"
+
+def parse_schedule(spec):
+    """
+    "normal:5,drowsy:3" -> [("normal", 5.0), ("drowsy", 3.0)] (scenario, seconds)
+    """
+    segments = []
+    for part in spec.split(","):
+        scenario, _, seconds = part.strip().partition(":")
+        if scenario not in SCENARIO_TYPES:
+            raise ValueError(f"Unknown scenario in schedule: {scenario}")
+        segments.append((scenario, float(seconds or 1)))
+    return segments
+
+def build_frame_stream(schedule, hz, seed=42):
+    """
+    Time-stamped frames at `hz` following the scenario schedule.
+    Each segment starts from generate_random_context(scenario) and evolves with
+    small per-frame changes, like consecutive readings from a vehicle.
+    """
+    random.seed(seed)
+    dt = 1.0 / hz
+    frames = []
+    t = 0.0
+    for scenario, seconds in schedule:
+        context, prompt_hint, _ = generate_random_context(scenario)
+        for _ in range(max(1, int(round(seconds * hz)))):
+            frames.append({
+                "index": len(frames),
+                "t": round(t, 6),
+                "scenario": scenario,
+                "context": context,
+                "prompt_hint": prompt_hint,
+            })
+            context = evolve_context(context, dt)
+            t += dt
+    return frames
+
+def _percentiles(values, prefix):
+    if not values:
+        return {}
+    return {
+        f"{prefix}_p50": float(np.percentile(values, 50)),
+        f"{prefix}_p95": float(np.percentile(values, 95)),
+        f"{prefix}_p99": float(np.percentile(values, 99)),
+        f"{prefix}_max": float(np.max(values)),
+    }
+
+def replay(frames, engine, slo_ms=100.0, realtime=True):
+    """
+    Drive `engine` (backend, CachedInference or DrivingSession) with the frame stream.
+    Frames arrive on the stream clock; a single worker processes them in order,
+    so a slow frame delays the following ones (queueing delay).
+    Returns (summary, per_frame_records).
+    """
+    records = []
+    clock_start = time.perf_counter()
+    busy_until = 0.0 # stream time when the worker becomes free
+
+    for frame in frames:
+        arrival = frame["t"]
+        if realtime:
+            now = time.perf_counter() - clock_start
+            if now < arrival:
+                time.sleep(arrival - now)
+            start = time.perf_counter() - clock_start
+        else:
+            start = max(arrival, busy_until)
+
+        call_start = time.perf_counter()
+        cache_hit = False
+        if isinstance(engine, CachedInference):
+            output, stats, cache_hit = engine.infer(frame["context"], frame["prompt_hint"])
+        elif isinstance(engine, DrivingSession):
+            output, stats = engine.step(frame["context"], frame["prompt_hint"])
+        else:
+            output, stats = engine.generate(construct_prompt(frame["context"], frame["prompt_hint"]))
+        service_ms = (time.perf_counter() - call_start) * 1000.0
+
+        finish = (time.perf_counter() - clock_start) if realtime else start + service_ms / 1000.0
+        busy_until = finish
+        e2e_ms = (finish - arrival) * 1000.0
+        expected = determine_actions(frame["context"], frame["prompt_hint"])
+        is_match, _, _ = ToolCallMatchMetric.match(output, expected)
+
+        records.append({
+            "index": frame["index"],
+            "t": arrival,
+            "scenario": frame["scenario"],
+            "queue_delay_ms": max(0.0, (start - arrival) * 1000.0),
+            "service_ms": service_ms,
+            "e2e_ms": e2e_ms,
+            "deadline_miss": e2e_ms > slo_ms,
+            "cache_hit": cache_hit,
+            "prompt_tokens": stats.get("prompt_tokens"),
+            "is_correct": is_match,
+        })
+
+    duration = records[-1]["t"] + records[-1]["e2e_ms"] / 1000.0 if records else 0.0
+    misses = sum(r["deadline_miss"] for r in records)
+    summary = {
+        "frames": len(records),
+        "slo_ms": slo_ms,
+        "deadline_misses": misses,
+        "deadline_miss_rate": misses / len(records) if records else 0.0,
+        "accuracy": sum(r["is_correct"] for r in records) / len(records) if records else 0.0,
+        "throughput_fps": len(records) / duration if duration else 0.0,
+    }
+    summary.update(_percentiles([r["queue_delay_ms"] for r in records], "queue_delay_ms"))
+    summary.update(_percentiles([r["service_ms"] for r in records], "service_ms"))
+    summary.update(_percentiles([r["e2e_ms"] for r in records], "e2e_ms"))
+    prompt_tokens = [r["prompt_tokens"] for r in records if r["prompt_tokens"] is not None]
+    if prompt_tokens:
+        summary["prompt_tokens_mean"] = float(np.mean(prompt_tokens))
+    if isinstance(engine, CachedInference):
+        summary.update(engine.cache.stats())
+
+    # Per-scenario SLO view (transitions are where misses cluster)
+    summary["per_scenario"] = {}
+    for scenario in dict.fromkeys(r["scenario"] for r in records):
+        rows = [r for r in records if r["scenario"] == scenario]
+        summary["per_scenario"][scenario] = {
+            "frames": len(rows),
+            "deadline_misses": sum(r["deadline_miss"] for r in rows),
+            **_percentiles([r["e2e_ms"] for r in rows], "e2e_ms"),
+        }
+    return summary, records
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a sensor-frame stream against an inference backend and report SLO misses")
+    parser.add_argument("--model-path", type=str, required=True, help="Adapter dir, ONNX dir or .gguf (see step3_evaluate --backend)")
+    parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--backend", type=str, default="torch")
+    parser.add_argument("--decoding", type=str, default="generate", choices=["generate", "structured"])
+    parser.add_argument("--schedule", type=str, default=DEFAULT_SCHEDULE, help="scenario:seconds,... e.g. normal:10,drowsy:5")
+    parser.add_argument("--hz", type=float, default=10.0, help="Frame rate")
+    parser.add_argument("--slo-ms", type=float, default=100.0, help="End-to-end deadline per frame")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache", action="store_true", help="Put the response cache in front of the backend")
+    parser.add_argument("--cache-ttl", type=float, default=5.0)
+    parser.add_argument("--session", action="store_true",
+                        help="Keep a KV-cached driving session and send only changed fields per frame (torch backend)")
+    parser.add_argument("--session-max-tokens", type=int, default=1024, help="Re-prefill once the session cache would exceed this")
+    parser.add_argument("--simulated-clock", action="store_true",
+                        help="Do not sleep between frames; compute queueing on the stream clock instead")
+    parser.add_argument("--output-dir", type=str, default="replay_output")
+    parser.add_argument("--experiment-name", type=str, default=None)
+    args = parser.parse_args()
+
+    frames = build_frame_stream(parse_schedule(args.schedule), args.hz, seed=args.seed)
+    print(f"Replaying {len(frames)} frames at {args.hz} Hz (SLO {args.slo_ms} ms)")
+
+    engine = load_backend(args.backend, args.base_model, args.model_path, decoding=args.decoding,
+                          work_dir=os.path.join(args.output_dir, f"{args.backend}_export"))
+    if args.session:
+        if args.backend != "torch":
+            raise ValueError("--session requires --backend torch")
+        engine = DrivingSession(engine.model, engine.tokenizer, max_cache_tokens=args.session_max_tokens)
+    elif args.cache:
+        engine = CachedInference(engine, ResponseCache(ttl_seconds=args.cache_ttl))
+
+    summary, records = replay(frames, engine, slo_ms=args.slo_ms, realtime=not args.simulated_clock)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = os.path.join(args.output_dir, "replay_report.json")
+    with open(report_path, "w") as f:
+        json.dump({"config": vars(args), "summary": summary, "frames": records}, f, indent=2)
+
+    print("=" * 60)
+    print(f"Deadline misses: {summary['deadline_misses']}/{summary['frames']} ({summary['deadline_miss_rate']:.1%})")
+    print(f"E2E p50/p99: {summary.get('e2e_ms_p50', 0):.1f} / {summary.get('e2e_ms_p99', 0):.1f} ms")
+    print(f"Queue delay p99: {summary.get('queue_delay_ms_p99', 0):.1f} ms, accuracy: {summary['accuracy']:.2%}")
+    print("=" * 60)
+    print(f"Report saved to {report_path}")
+
+    if args.experiment_name:
+        mlflow.set_experiment(args.experiment_name)
+        with mlflow.start_run(run_name="replay"):
+            run_logger.log_params({"backend": args.backend, "hz": args.hz, "slo_ms": args.slo_ms, "schedule": args.schedule, "cache": args.cache, "session": args.session})
+            run_logger.log_metrics({k: float(v) for k, v in summary.items() if isinstance(v, (int, float))})
+            run_logger.log_artifact(report_path)
+            run_logger.flush()
+
+if __name__ == "__main__":
+    main()
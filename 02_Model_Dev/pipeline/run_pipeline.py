@@ -1,13 +1,69 @@
 import argparse
+import json
 import os
 import shutil
 import mlflow
 from datetime import datetime
 
 # Import step functions
-from step1_generate_data import run_generator
+from step1_generate_data import run_generator, SCENARIO_TYPES, SCENARIO_WEIGHTS
 from step2_finetune import run_finetuning
+from step2_export_gguf import run_gguf_export
+from step2_distill import run_distillation
 from step3_evaluate import run_evaluation
+from utils.analyze_and_split import analyze_and_split
+from utils.columnar_dataset import jsonl_to_parquet
+from utils.dedup import dedup_files, leakage_report
+from utils.hard_examples import mine_failures, failure_weights
+from utils.mlflow_logger import run_logger
+from transformers.trainer_utils import get_last_checkpoint
+
+STATE_FILE = "pipeline_state.json"
+ACCURACY_THRESHOLD = 0.8
+
+def load_state(run_dir):
+    path = os.path.join(run_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {"args": {}, "steps": {}}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_state(run_dir, state):
+    # Write-then-rename so a crash never leaves a truncated state file
+    path = os.path.join(run_dir, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def mark_done(run_dir, state, step_name, outputs):
+    # Step end: write buffered MLflow values and wait for artifact uploads
+    run_logger.flush()
+    active = mlflow.active_run()
+    state["steps"][step_name] = {
+        "status": "completed",
+        "run_id": active.info.run_id if active else None,
+        "completed_at": datetime.now().isoformat(),
+        "outputs": outputs,
+    }
+    save_state(run_dir, state)
+
+def step_done(state, step_name, paths=()):
+    """
+    A step counts as done when the state file says so, its output files still
+    exist and its MLflow run (if recorded and reachable) did not fail.
+    """
+    info = state["steps"].get(step_name)
+    if not info or info.get("status") != "completed":
+        return False
+    if not all(os.path.exists(p) for p in paths):
+        return False
+    if info.get("run_id"):
+        try:
+            if mlflow.get_run(info["run_id"]).info.status == "FAILED":
+                return False
+        except Exception:
+            pass # Tracking server unreachable or run deleted; trust the artifacts
+    return True
 
 def main():
     parser = argparse.ArgumentParser(description="Driver Assist Function Gemma Pipeline")
@@ -17,100 +73,467 @@ def main():
     # Gen Params
     parser.add_argument("--gen-samples", type=int, default=100)
     parser.add_argument("--gen-seed", type=int, default=42)
+    parser.add_argument("--gen-session-samples", type=int, default=0, help="Extra multi-turn delta-prompt training samples")
+    parser.add_argument("--gen-session-turns", type=int, default=3)
+    parser.add_argument("--gen-mode", type=str, default="random", choices=["random", "coverage"],
+                        help="coverage: samples per decision path of determine_actions instead of --gen-samples random ones")
+    parser.add_argument("--gen-coverage-variants", type=int, default=3, help="Samples per decision path (--gen-mode coverage)")
+    parser.add_argument("--train-ratio", type=float, default=1.0,
+                        help="Opt-in hash train/eval split of the step 1 data, e.g. 0.9 (steps 2/3 train on train, evaluate on eval); 1.0 (default) trains and evaluates on all of it")
+    parser.add_argument("--dedup", action="store_true", help="Drop exact/near duplicate samples (decision signature) after step 1")
+    parser.add_argument("--dataset-format", type=str, default="jsonl", choices=["jsonl", "parquet"],
+                        help="parquet: convert step 1 output to one zstd Parquet file for steps 2 and 3")
     
     # Train Params
     parser.add_argument("--epochs", type=int, default=1)
     parser.add_argument("--batch-size", type=int, default=4)
     parser.add_argument("--lr", type=float, default=2e-4)
+    parser.add_argument("--profile", action="store_true", help="Profile fine-tuning (torch.profiler trace, step timing, memory)")
     parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--distill-layers", type=int, default=0,
+                        help="Distill the final model into a student with this many layers and evaluate it (0 disables)")
+    parser.add_argument("--active-rounds", type=int, default=0,
+                        help="Hard-example rounds after evaluation while accuracy is below the threshold (0 disables)")
+    parser.add_argument("--active-samples", type=int, default=100, help="New training samples per hard-example round")
+    parser.add_argument("--dev-ratio", type=float, default=0.1,
+                        help="Dev split for hard-example mining, taken from the train share (only with --active-rounds)")
     
     # Eval Params
     parser.add_argument("--geval", action="store_true", help="Enable OpenAI G-Eval judging")
     parser.add_argument("--geval-model", type=str, default="gpt-4o-mini")
     parser.add_argument("--geval-max-samples", type=int, default=0, help="0 means judge all samples")
+    parser.add_argument("--decoding", type=str, default="generate", choices=["generate", "structured"])
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx", "llama_cpp"])
+    
+    # GGUF Params
+    parser.add_argument("--gguf-quants", type=str, nargs="*", default=[],
+                        help="Export final_model to GGUF at these levels (e.g. Q8_0 Q4_K_M) and evaluate each with llama.cpp")
+    parser.add_argument("--llama-cpp-dir", type=str, default=None, help="llama.cpp checkout (default: $LLAMA_CPP_DIR)")
+    
+    parser.add_argument("--resume", type=str, default=None, metavar="RUN_DIR",
+                        help="Continue an interrupted run: skip completed steps, resume training/evaluation (other flags are taken from the original run)")
     
     args = parser.parse_args()
+    if not args.resume and args.active_rounds:
+        # Rounds mine a dev split and are gated on the eval split; neither may be trained on
+        if args.train_ratio >= 1.0:
+            parser.error("--active-rounds needs a held-out split (--train-ratio < 1.0)")
+        if args.train_ratio - args.dev_ratio <= 0:
+            parser.error("--dev-ratio must be smaller than --train-ratio")
     
     # Setup Output Dir
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    run_dir = os.path.join(args.base_output_dir, f"run_{timestamp}")
+    if args.resume:
+        run_dir = args.resume.rstrip(os.sep)
+        state = load_state(run_dir)
+        # Keep the original configuration so resumed steps stay consistent
+        state["args"].setdefault("train_ratio", 1.0) # runs from before the split step
+        state["args"].setdefault("dev_ratio", 0.0)
+        resume_dir = args.resume
+        vars(args).update(state["args"])
+        args.resume = resume_dir
+        timestamp = os.path.basename(run_dir).replace("run_", "", 1)
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        run_dir = os.path.join(args.base_output_dir, f"run_{timestamp}")
+        state = {"args": {k: v for k, v in vars(args).items() if k != "resume"}, "steps": {}}
     os.makedirs(run_dir, exist_ok=True)
+    save_state(run_dir, state)
     
-    print(f"🚀 Starting Pipeline... Output: {run_dir}")
+    print(f"🚀 {'Resuming' if args.resume else 'Starting'} Pipeline... Output: {run_dir}")
     
     # Initialize Pipeline Context
     from chatbot_tester.utils import PipelineContext
     
-    with PipelineContext(args.experiment_name, args.base_output_dir) as ctx:
-        ctx.log_params({
+    ctx = PipelineContext(args.experiment_name, args.base_output_dir)
+    ctx.timestamp = timestamp
+    ctx.run_dir = run_dir
+    with ctx:
+        run_logger.log_params({
             "base_model": args.base_model,
             "gen_samples": args.gen_samples
         })
+        if args.resume:
+            run_logger.set_tag("resumed_from", run_dir)
         
         # --- Step 1: Generation ---
-        with ctx.step("data_generation") as step1_dir:
-            print("\n[Step 1] Data Generation")
-            
-            c_path, f_path, m_path, meta = run_generator(
-                output_dir=step1_dir,
-                num_samples=args.gen_samples,
-                seed=args.gen_seed
-            )
-            
-            # Log artifacts
-            # Note: PipelineContext.log_artifact logs to current active run (which is step run here)
-            ctx.log_artifact(c_path)
-            ctx.log_artifact(f_path)
-            ctx.log_artifact(m_path)
-            
-            # Log tags
-            mlflow.set_tag("dataset_version", meta["version"])
-            for tag, count in meta["tag_stats"].items():
-                mlflow.log_metric(f"count_{tag}", count)
+        step1 = state["steps"].get("data_generation", {}).get("outputs", {})
+        if step_done(state, "data_generation", [step1.get("canonical", ""), step1.get("finetune", "")]):
+            print("\n[Step 1] Data Generation ⏭️ already completed")
+            c_path, f_path = step1["canonical"], step1["finetune"]
+        else:
+            with ctx.step("data_generation") as step1_dir:
+                print("\n[Step 1] Data Generation")
+                
+                c_path, f_path, m_path, meta = run_generator(
+                    output_dir=step1_dir,
+                    num_samples=args.gen_samples,
+                    seed=args.gen_seed,
+                    session_samples=args.gen_session_samples,
+                    session_turns=args.gen_session_turns,
+                    mode=args.gen_mode,
+                    coverage_variants=args.gen_coverage_variants
+                )
+                
+                # Log artifacts
+                # Note: run_logger uploads to the run active at call time (the step run here)
+                run_logger.log_artifact(c_path)
+                run_logger.log_artifact(f_path)
+                run_logger.log_artifact(m_path)
+                
+                # Log tags
+                run_logger.set_tag("dataset_version", meta["version"])
+                run_logger.log_metrics({f"count_{tag}": count for tag, count in meta["tag_stats"].items()})
+                run_logger.log_metrics({
+                    "decision_path_coverage": meta["coverage"]["decision_path_coverage"],
+                    "threshold_edges_covered": meta["coverage"]["threshold_edges_covered"],
+                })
+
+                if args.dedup and args.train_ratio >= 1.0:
+                    # Train on one sample per decision signature (with a split, dedup runs in data_split)
+                    c_path, f_path, dedup_report = dedup_files(c_path, f_path, os.path.join(step1_dir, "dedup"))
+                    run_logger.log_metrics({
+                        "dedup_kept": dedup_report["kept"],
+                        "dedup_removed_exact": dedup_report["removed_exact"],
+                        "dedup_removed_near": dedup_report["removed_near"],
+                    })
+                    run_logger.log_artifact(os.path.join(step1_dir, "dedup", "dedup_report.json"))
+
+                if args.dataset_format == "parquet" and args.train_ratio >= 1.0:
+                    # Steps 2 and 3 read the same columnar file
+                    c_path = f_path = jsonl_to_parquet(c_path, f_path, os.path.join(step1_dir, "dataset.parquet"))
+                    run_logger.log_artifact(c_path)
+                    run_logger.log_metric("parquet_size_mb", os.path.getsize(c_path) / (1024 * 1024))
+                mark_done(run_dir, state, "data_generation", {"canonical": c_path, "finetune": f_path, "metadata": m_path})
+
+        # --- Step 1b: Train/eval split + leakage report ---
+        split = {}
+        dev_ratio = args.dev_ratio if args.active_rounds else 0.0
+        if args.train_ratio < 1.0:
+            split = state["steps"].get("data_split", {}).get("outputs", {})
+            if step_done(state, "data_split", [split.get("train_finetune", ""), split.get("eval_canonical", "")]):
+                print("\n[Step 1b] Train/Eval Split ⏭️ already completed")
+            else:
+                with ctx.step("data_split") as split_dir:
+                    print("\n[Step 1b] Train/Eval Split")
+                    analyze_and_split(c_path, f_path, split_dir, train_ratio=args.train_ratio - dev_ratio, seed=args.gen_seed,
+                                      dedup=args.dedup, dev_ratio=dev_ratio)
+                    with open(os.path.join(split_dir, "leakage_report.json"), "r") as f:
+                        leakage = json.load(f)
+                    split_metrics = {
+                        "eval_samples": leakage["eval_samples"],
+                        "leakage_rate": leakage["leakage_rate"],
+                        "leaked_exact": leakage["leaked_exact"],
+                        "leaked_near": leakage["leaked_near"],
+                    }
+                    if args.dedup:
+                        split_metrics.update({
+                            "dedup_removed_exact": leakage["removed_exact"],
+                            "dedup_removed_near": leakage["removed_near"],
+                            "leakage_rate_before_dedup": leakage["before_dedup"]["leakage_rate"],
+                        })
+                    run_logger.log_metrics(split_metrics)
+                    run_logger.log_artifact(os.path.join(split_dir, "leakage_report.json"))
+                    run_logger.log_artifact(os.path.join(split_dir, "split_report.json"))
+
+                    split = {kind: os.path.join(split_dir, f"{kind}.jsonl")
+                             for kind in ("train_canonical", "train_finetune", "eval_canonical", "eval_finetune")}
+                    if dev_ratio > 0:
+                        split["dev_canonical"] = os.path.join(split_dir, "dev_canonical.jsonl")
+                    if args.dataset_format == "parquet":
+                        for name in ("train", "eval"):
+                            context = os.path.join(split_dir, f"{name}_context.jsonl")
+                            parquet_path = jsonl_to_parquet(split[f"{name}_canonical"], split[f"{name}_finetune"],
+                                                            os.path.join(split_dir, f"{name}.parquet"),
+                                                            context_path=context if os.path.exists(context) else None)
+                            split[f"{name}_canonical"] = split[f"{name}_finetune"] = parquet_path
+                    mark_done(run_dir, state, "data_split", split)
+            # Train on the train split, evaluate on the held-out eval split
+            c_path, f_path = split["eval_canonical"], split["train_finetune"]
 
         # --- Step 2: Fine-tuning ---
-        with ctx.step("finetuning") as step2_dir:
-            print("\n[Step 2] Fine-tuning")
-             
-            # HF Autolog setup
-            mlflow.transformers.autolog()
-             
-            model_path = run_finetuning(
-                 dataset_path=f_path,
-                 output_dir=step2_dir,
-                 model_name=args.base_model,
-                 epochs=args.epochs,
-                 batch_size=args.batch_size,
-                 learning_rate=args.lr
-            )
+        step2 = state["steps"].get("finetuning", {}).get("outputs", {})
+        if step_done(state, "finetuning", [os.path.join(step2.get("model_path", ""), "adapter_config.json")]):
+            print("\n[Step 2] Fine-tuning ⏭️ already completed")
+            model_path = step2["model_path"]
+        else:
+            with ctx.step("finetuning") as step2_dir:
+                print("\n[Step 2] Fine-tuning")
+                 
+                # HF Autolog setup
+                mlflow.transformers.autolog()
+
+                checkpoint = get_last_checkpoint(step2_dir) if args.resume else None
+                model_path = run_finetuning(
+                     dataset_path=f_path,
+                     output_dir=step2_dir,
+                     model_name=args.base_model,
+                     epochs=args.epochs,
+                     batch_size=args.batch_size,
+                     learning_rate=args.lr,
+                     profile=args.profile,
+                     resume_from_checkpoint=checkpoint
+                )
+                mark_done(run_dir, state, "finetuning", {"model_path": model_path})
              
         # --- Step 3: Evaluation ---
-        with ctx.step("evaluation") as step3_dir:
-            print("\n[Step 3] Evaluation")
-            
-            metrics, res_path, geval_path = run_evaluation(
-                model_path=model_path,
-                dataset_path=c_path,
-                base_model_name=args.base_model,
-                output_dir=step3_dir,
-                enable_geval=args.geval,
-                geval_model=args.geval_model,
-                geval_max_samples=args.geval_max_samples,
-            )
-            
-            # Log metrics
-            ctx.log_metrics(metrics)
-            ctx.log_artifact(res_path)
-
-            if geval_path:
-                ctx.log_artifact(geval_path)
-            
-            # Check Threshold
-            if metrics["accuracy_total"] < 0.8:
-                print("⚠️ Warning: Model accuracy is below 80%")
-                mlflow.set_tag("status", "failed_threshold")
+        step3 = state["steps"].get("evaluation", {}).get("outputs", {})
+        if step_done(state, "evaluation", [step3.get("results", "")]):
+            print("\n[Step 3] Evaluation ⏭️ already completed")
+            res_path, accuracy = step3["results"], step3["accuracy_total"]
+        else:
+            with ctx.step("evaluation") as step3_dir:
+                print("\n[Step 3] Evaluation")
+                
+                metrics, res_path, geval_path = run_evaluation(
+                    model_path=model_path,
+                    dataset_path=c_path,
+                    base_model_name=args.base_model,
+                    output_dir=step3_dir,
+                    enable_geval=args.geval,
+                    geval_model=args.geval_model,
+                    geval_max_samples=args.geval_max_samples,
+                    decoding=args.decoding,
+                    backend=args.backend,
+                    resume=bool(args.resume),
+                )
+                
+                # Log metrics
+                run_logger.log_metrics(metrics)
+                run_logger.log_artifact(res_path)
+
+                if geval_path:
+                    run_logger.log_artifact(geval_path)
+                
+                # Check Threshold
+                if metrics["accuracy_total"] < ACCURACY_THRESHOLD:
+                    print("⚠️ Warning: Model accuracy is below 80%")
+                    run_logger.set_tag("status", "failed_threshold")
+                else:
+                    run_logger.set_tag("status", "passed")
+                accuracy = metrics["accuracy_total"]
+                mark_done(run_dir, state, "evaluation", {"results": res_path, "accuracy_total": accuracy})
+
+        # --- Step 3b (optional): Hard-example rounds ---
+        # Failures of the current model on the dev split steer the next generation
+        # slice; the adapter keeps training on that slice only. The eval split,
+        # which no slice is derived from, gates the rounds.
+        dev_path = split.get("dev_canonical")
+        for round_idx in range(1, args.active_rounds + 1):
+            if accuracy >= ACCURACY_THRESHOLD:
+                print(f"\n[Active Learning] Accuracy {accuracy:.2%} reached the threshold, stopping")
+                break
+
+            if dev_path:
+                dev_name = f"dev_evaluation_r{round_idx}"
+                dev_out = state["steps"].get(dev_name, {}).get("outputs", {})
+                if step_done(state, dev_name, [dev_out.get("results", "")]):
+                    print(f"\n[Active Learning {round_idx}] Dev evaluation ⏭️ already completed")
+                    mine_source = dev_out["results"]
+                else:
+                    with ctx.step(dev_name) as dev_dir:
+                        print(f"\n[Active Learning {round_idx}] Dev evaluation")
+                        dev_metrics, mine_source, _ = run_evaluation(
+                            model_path=model_path,
+                            dataset_path=dev_path,
+                            base_model_name=args.base_model,
+                            output_dir=dev_dir,
+                            decoding=args.decoding,
+                            backend=args.backend,
+                            resume=bool(args.resume),
+                        )
+                        run_logger.log_metrics(dev_metrics)
+                        mark_done(run_dir, state, dev_name, {"results": mine_source, "accuracy_total": dev_metrics["accuracy_total"]})
+            else:
+                # Resumed run from before the dev split
+                print("⚠️ No dev split in this run; mining the eval results (eval accuracy is optimistic)")
+                mine_source = res_path
+
+            mine_name = f"hard_mining_r{round_idx}"
+            mined_out = state["steps"].get(mine_name, {}).get("outputs", {})
+            if step_done(state, mine_name, [mined_out.get("finetune", "")]):
+                print(f"\n[Active Learning {round_idx}] Hard-example mining ⏭️ already completed")
+                slice_path = mined_out["finetune"]
+            else:
+                with ctx.step(mine_name) as mine_dir:
+                    print(f"\n[Active Learning {round_idx}] Hard-example mining")
+                    mined = mine_failures(mine_source)
+                    weights = failure_weights(mined, SCENARIO_TYPES, SCENARIO_WEIGHTS)
+                    slice_canonical, slice_path, slice_meta_path, _ = run_generator(
+                        output_dir=mine_dir,
+                        num_samples=args.active_samples,
+                        seed=args.gen_seed + round_idx,
+                        mode="hard",
+                        scenario_weights=weights,
+                        hard_examples=mined
+                    )
+                    report_path = os.path.join(mine_dir, "hard_examples.json")
+                    with open(report_path, "w") as f:
+                        report = {k: v for k, v in mined.items() if k != "failing_contexts"}
+                        report["scenario_weights"] = dict(zip(SCENARIO_TYPES, weights))
+                        json.dump(report, f, indent=2)
+                    run_logger.log_artifact(report_path)
+                    run_logger.log_artifact(slice_meta_path)
+                    run_logger.log_metrics({
+                        "failed_samples": mined["failed"],
+                        **{f"errors_{error}": count for error, count in mined["error_types"].items()},
+                    })
+                    if split:
+                        # How much of the slice still duplicates the eval split it is gated on
+                        split_dir = os.path.dirname(split["train_finetune"])
+                        eval_context = os.path.join(split_dir, "eval_context.jsonl")
+                        slice_leakage = leakage_report(
+                            slice_canonical,
+                            os.path.join(split_dir, "eval_canonical.jsonl"),
+                            os.path.join(mine_dir, "dataset_context.jsonl"),
+                            eval_context if os.path.exists(eval_context) else None,
+                        )
+                        run_logger.log_metric("slice_eval_leakage_rate", slice_leakage["leakage_rate"])
+                    mark_done(run_dir, state, mine_name, {"finetune": slice_path})
+
+            ft_name = f"finetuning_r{round_idx}"
+            ft_out = state["steps"].get(ft_name, {}).get("outputs", {})
+            if step_done(state, ft_name, [os.path.join(ft_out.get("model_path", ""), "adapter_config.json")]):
+                print(f"\n[Active Learning {round_idx}] Fine-tuning ⏭️ already completed")
+                model_path = ft_out["model_path"]
+            else:
+                with ctx.step(ft_name) as ft_dir:
+                    print(f"\n[Active Learning {round_idx}] Incremental fine-tuning from {model_path}")
+                    mlflow.transformers.autolog()
+                    model_path = run_finetuning(
+                        dataset_path=slice_path,
+                        output_dir=ft_dir,
+                        model_name=args.base_model,
+                        epochs=args.epochs,
+                        batch_size=args.batch_size,
+                        learning_rate=args.lr,
+                        resume_from_checkpoint=get_last_checkpoint(ft_dir) if args.resume else None,
+                        init_adapter=model_path
+                    )
+                    mark_done(run_dir, state, ft_name, {"model_path": model_path})
+
+            ev_name = f"evaluation_r{round_idx}"
+            ev_out = state["steps"].get(ev_name, {}).get("outputs", {})
+            if step_done(state, ev_name, [ev_out.get("results", "")]):
+                print(f"\n[Active Learning {round_idx}] Evaluation ⏭️ already completed")
+                res_path, accuracy = ev_out["results"], ev_out["accuracy_total"]
             else:
-                mlflow.set_tag("status", "passed")
+                with ctx.step(ev_name) as ev_dir:
+                    print(f"\n[Active Learning {round_idx}] Evaluation")
+                    metrics, res_path, _ = run_evaluation(
+                        model_path=model_path,
+                        dataset_path=c_path,
+                        base_model_name=args.base_model,
+                        output_dir=ev_dir,
+                        decoding=args.decoding,
+                        backend=args.backend,
+                        resume=bool(args.resume),
+                    )
+                    run_logger.log_metrics(metrics)
+                    run_logger.log_artifact(res_path)
+                    accuracy = metrics["accuracy_total"]
+                    run_logger.set_tag("status", "passed" if accuracy >= ACCURACY_THRESHOLD else "failed_threshold")
+                    mark_done(run_dir, state, ev_name, {"results": res_path, "accuracy_total": accuracy})
+            run_logger.log_metrics({f"active_r{round_idx}_accuracy_total": accuracy})
+
+        # --- Step 3c (optional): Distillation into a smaller student ---
+        if args.distill_layers:
+            distill = state["steps"].get("distillation", {}).get("outputs", {})
+            if step_done(state, "distillation", [os.path.join(distill.get("student_path", ""), "config.json")]):
+                print("\n[Distillation] ⏭️ already completed")
+                student_path = distill["student_path"]
+            else:
+                with ctx.step("distillation") as distill_dir:
+                    print(f"\n[Distillation] {args.distill_layers}-layer student")
+                    student_path = run_distillation(
+                        teacher_path=model_path,
+                        dataset_path=f_path,
+                        output_dir=distill_dir,
+                        base_model_name=args.base_model,
+                        epochs=args.epochs,
+                        batch_size=args.batch_size,
+                        learning_rate=args.lr,
+                        student_layers=args.distill_layers,
+                    )
+                    mark_done(run_dir, state, "distillation", {"student_path": student_path})
+
+            student_eval = state["steps"].get("evaluation_student", {}).get("outputs", {})
+            if step_done(state, "evaluation_student", [student_eval.get("results", "")]):
+                print("\n[Distillation] Student evaluation ⏭️ already completed")
+                s_metrics = student_eval["metrics"]
+            else:
+                with ctx.step("evaluation_student") as student_eval_dir:
+                    print("\n[Distillation] Student evaluation")
+                    s_metrics, s_res_path, _ = run_evaluation(
+                        model_path=student_path,
+                        dataset_path=c_path,
+                        base_model_name=args.base_model,
+                        output_dir=student_eval_dir,
+                        backend="torch",
+                        resume=bool(args.resume),
+                    )
+                    run_logger.log_metrics(s_metrics)
+                    run_logger.log_artifact(s_res_path)
+                    mark_done(run_dir, state, "evaluation_student", {"results": s_res_path, "metrics": s_metrics})
+
+            # Accuracy / latency trade-off next to the teacher on the parent run
+            run_logger.log_metrics({
+                "student_accuracy_total": s_metrics["accuracy_total"],
+                "student_accuracy_delta": s_metrics["accuracy_total"] - accuracy,
+                "student_latency_ms_p50": s_metrics.get("latency_ms_p50", 0.0),
+                "student_model_size_mb": s_metrics.get("model_size_mb", 0.0),
+            })
+
+        # --- Step 4 (optional): GGUF export + llama.cpp evaluation ---
+        if args.gguf_quants:
+            export = state["steps"].get("gguf_export", {}).get("outputs", {})
+            if step_done(state, "gguf_export", list(export.get("gguf_paths", {}).values()) or [""]):
+                print("\n[Step 4] GGUF Export ⏭️ already completed")
+                gguf_paths = export["gguf_paths"]
+            else:
+                with ctx.step("gguf_export") as gguf_dir:
+                    print("\n[Step 4] GGUF Export")
+                    gguf_paths, manifest_path = run_gguf_export(
+                        model_path=model_path,
+                        base_model_name=args.base_model,
+                        output_dir=gguf_dir,
+                        quant_types=args.gguf_quants,
+                        llama_cpp_dir=args.llama_cpp_dir,
+                    )
+                    run_logger.log_artifact(manifest_path)
+                    mark_done(run_dir, state, "gguf_export", {"gguf_paths": gguf_paths, "manifest": manifest_path})
+
+            for quant, gguf_path in gguf_paths.items():
+                step_name = f"evaluation_gguf_{quant}"
+                if step_done(state, step_name, [state["steps"].get(step_name, {}).get("outputs", {}).get("results", "")]):
+                    print(f"\n[Step 4] llama.cpp Evaluation ({quant}) ⏭️ already completed")
+                    q_metrics = state["steps"][step_name]["outputs"]["metrics"]
+                else:
+                    with ctx.step(step_name) as quant_eval_dir:
+                        print(f"\n[Step 4] llama.cpp Evaluation ({quant})")
+                        run_logger.set_tag("gguf_quant", quant)
+                        q_metrics, q_res_path, _ = run_evaluation(
+                            model_path=gguf_path,
+                            dataset_path=c_path,
+                            base_model_name=args.base_model,
+                            output_dir=quant_eval_dir,
+                            backend="llama_cpp",
+                            resume=bool(args.resume),
+                        )
+                        run_logger.log_metrics(q_metrics)
+                        run_logger.log_artifact(q_res_path)
+                        mark_done(run_dir, state, step_name, {"results": q_res_path, "metrics": q_metrics})
+
+                # Side-by-side comparison on the parent run
+                run_logger.log_metrics({
+                    f"gguf_{quant}_accuracy_total": q_metrics["accuracy_total"],
+                    f"gguf_{quant}_tokens_per_sec": q_metrics.get("tokens_per_sec", 0.0),
+                    f"gguf_{quant}_latency_ms_p50": q_metrics.get("latency_ms_p50", 0.0),
+                })
+
+        # Remaining parent-run values, plus how much time logging itself took
+        run_logger.flush()
+        run_logger.log_metrics({"mlflow_flush_ms": run_logger.flush_ms, "mlflow_upload_ms": run_logger.upload_ms})
+        run_logger.close()
                 
     print(f"\n✅ Pipeline Complete! Check MLflow for results.")
 
@@ -3,6 +3,8 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from peft import PeftModel
 import os
+from utils.quantization import quantize_model
+from utils.model_cache import load_cached_model, default_cache_dir
 
 def load_model(base_model_name, adapter_path):
     print(f"Loading tokenizer from: {adapter_path}")
@@ -16,16 +18,25 @@ def load_model(base_model_name, adapter_path):
 
     print(f"Loading base model: {base_model_name}")
     print(f"Using device: {device}, dtype: {dtype}")
-    base_model = AutoModelForCausalLM.from_pretrained(
-        base_model_name,
-        torch_dtype=dtype,
-        trust_remote_code=True
-    ).to(device)
-    
-    print(f"Loading adapter from: {adapter_path}")
-    model = PeftModel.from_pretrained(base_model, adapter_path)
-    model = model.to(dtype=dtype)
-    model.eval()
+    if default_cache_dir():
+        # MODEL_CACHE_DIR set: reuse merged safetensors across restarts
+        model = load_cached_model(base_model_name, adapter_path, dtype=dtype, device=device)
+    else:
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_name,
+            torch_dtype=dtype,
+            trust_remote_code=True
+        ).to(device)
+        
+        print(f"Loading adapter from: {adapter_path}")
+        model = PeftModel.from_pretrained(base_model, adapter_path)
+        model = model.to(dtype=dtype)
+        model.eval()
+
+    # QUANTIZE=int8|int4 merges the adapter and quantizes for CPU inference
+    quantize = os.environ.get("QUANTIZE", "none")
+    if quantize != "none":
+        model = quantize_model(model, quantize)
     
     return model, tokenizer
 
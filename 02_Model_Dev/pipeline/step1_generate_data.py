@@ -5,6 +5,10 @@ import sys
 import argparse
 from datetime import datetime
 import mlflow
+from utils.prompt_templates import render_prompt, context_record, DEFAULT_TEMPLATE_ID, DELTA_TEMPLATE_ID
+from utils.coverage import generate_coverage_contexts, coverage_stats
+from utils.hard_examples import generate_hard_contexts
+from utils.mlflow_logger import run_logger
 
 # Add chatbot-tester to path if needed (assuming it's a sibling directory)
 # In a real environment, it should be installed via pip
@@ -16,24 +20,32 @@ try:
 except ImportError:
     pass
 
+# Structured sidecar: raw context, prompt hint, expected actions, template id
+CONTEXT_FILE = "dataset_context.jsonl"
+
 # --- 1. Logic ported from dataset_gen_v2.py ---
 
-def generate_random_context():
-    # Expanded scenarios
-    scenario_type = random.choices(
-        [
-            "normal", 
-            "drowsy", 
-            "lane_departure", 
-            "hands_off", 
-            "collision_risk", 
-            "complex", 
-            "sensor_fail",
-            "bad_weather",
-            "safe_mode_needed"
-        ],
-        weights=[0.2, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1]
-    )[0]
+# Expanded scenarios
+SCENARIO_TYPES = [
+    "normal", 
+    "drowsy", 
+    "lane_departure", 
+    "hands_off", 
+    "collision_risk", 
+    "complex", 
+    "sensor_fail",
+    "bad_weather",
+    "safe_mode_needed"
+]
+SCENARIO_WEIGHTS = [0.2, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1]
+
+def generate_random_context(scenario_type=None, weights=None):
+    # Pick a scenario unless the caller forces one (e.g. replay streams);
+    # weights override SCENARIO_WEIGHTS (e.g. failure-weighted hard-example rounds)
+    if scenario_type is None:
+        scenario_type = random.choices(SCENARIO_TYPES, weights=weights or SCENARIO_WEIGHTS)[0]
+    elif scenario_type not in SCENARIO_TYPES:
+        raise ValueError(f"Unknown scenario: {scenario_type}")
 
     # Base Context
     context = {
@@ -180,59 +192,112 @@ def determine_actions(context, prompt):
     return unique_actions
 
 def construct_prompt(context, prompt_hint):
-    return f"""You are FunctionGemma, a function selection model for a driver assistance demo.
-
-Input context is structured sensor state (do not invent fields):
-{json.dumps(context, indent=2)}
-
-User prompt:
-{prompt_hint}
-
-Return ONLY a JSON array of tool calls. Each item must be:
-{{"name": "<tool_name>", "arguments": {{ ... }}}}
-
-Allowed tool names:
-- trigger_steering_vibration
-- trigger_navigation_notification
-- trigger_drowsiness_alert_sound
-- trigger_cluster_visual_warning
-- trigger_hud_warning
-- trigger_voice_prompt
-- escalate_warning_level
-- trigger_rest_recommendation
-- log_safety_event
-- request_safe_mode
-
-If no action is needed, return:
-[{{"name":"log_safety_event","arguments":{{"message":"no_action_selected"}}}}]
-"""
+    return render_prompt(context, prompt_hint, DEFAULT_TEMPLATE_ID)
+
+def context_delta(prev, curr):
+    """
+    Fields of `curr` that differ from `prev` (nested dicts keep only changed keys).
+    """
+    delta = {}
+    for key, value in curr.items():
+        if isinstance(value, dict) and isinstance(prev.get(key), dict):
+            sub = context_delta(prev[key], value)
+            if sub:
+                delta[key] = sub
+        elif prev.get(key) != value:
+            delta[key] = value
+    return delta
+
+def construct_delta_prompt(delta, prompt_hint):
+    # Follow-up turn of a driving session: only changed fields, compact JSON
+    return render_prompt(delta, prompt_hint, DELTA_TEMPLATE_ID)
+
+def evolve_context(context, dt=1.0):
+    """
+    Next reading of the same situation `dt` seconds later: small sensor noise on
+    continuous fields, time since the last warning advances.
+    """
+    ctx = json.loads(json.dumps(context))
+    for key in ("lane_departure", "driver_drowsiness"):
+        conf = ctx[key]["confidence"] + random.uniform(-0.02, 0.02)
+        ctx[key]["confidence"] = round(min(max(conf, 0.0), 0.99), 2)
+    ctx["forward_collision_risk"] = round(min(max(ctx["forward_collision_risk"] + random.uniform(-0.02, 0.02), 0.0), 0.99), 2)
+    ctx["vehicle_speed_kph"] = max(0, ctx["vehicle_speed_kph"] + random.randint(-1, 1))
+    ctx["recent_warning_history"]["seconds_ago"] = round(ctx["recent_warning_history"]["seconds_ago"] + dt, 2)
+    return ctx
+
+def generate_session(num_turns, switch_prob=0.5, dt=5.0):
+    """
+    Consecutive frames of one drive. Each follow-up turn either evolves the
+    previous context or switches to a new scenario (same drive, so the driving
+    duration carries over).
+    Returns a list of (context, prompt_hint, scenario_type).
+    """
+    ctx, prompt_hint, scenario_type = generate_random_context()
+    turns = [(ctx, prompt_hint, scenario_type)]
+    for _ in range(num_turns - 1):
+        if random.random() < switch_prob:
+            new_ctx, prompt_hint, scenario_type = generate_random_context()
+            new_ctx["driving_duration_minutes"] = ctx["driving_duration_minutes"]
+            ctx = new_ctx
+        else:
+            ctx = evolve_context(ctx, dt)
+        turns.append((ctx, prompt_hint, scenario_type))
+    return turns
 
 def format_for_finetuning(prompt_text, actions):
     # Function Gemma format
     input_text = f"<start_of_turn>user\n{prompt_text}<end_of_turn>\n<start_of_turn>model\n{json.dumps(actions)}<end_of_turn>"
     return {"text": input_text}
 
+def format_session_for_finetuning(turns):
+    """
+    turns: list of (prompt_text, actions). First prompt is the full context,
+    later ones are delta prompts; all turns are concatenated into one sample.
+    """
+    return {"text": "\n".join(format_for_finetuning(p, a)["text"] for p, a in turns)}
+
 # --- 2. Generator Pipeline ---
 
-def run_generator(output_dir, num_samples, seed):
+def run_generator(output_dir, num_samples, seed, session_samples=0, session_turns=3, mode="random", coverage_variants=3,
+                  scenario_weights=None, hard_examples=None):
+    """
+    mode="random": num_samples contexts drawn with SCENARIO_WEIGHTS (or scenario_weights).
+    mode="coverage": every decision path of determine_actions with
+    coverage_variants samples each (utils/coverage.py); num_samples is ignored.
+    mode="hard": num_samples contexts around the failures in hard_examples
+    (utils.hard_examples.mine_failures output) plus scenario_weights draws.
+    """
     random.seed(seed)
     
     canonical_samples = []
     finetune_samples = []
+    context_records = [] # structured columns behind each canonical prompt
     
     # Statistics
     tag_counts = {}
     
-    print(f"Generating {num_samples} samples with seed {seed}...")
+    if mode == "coverage":
+        contexts = generate_coverage_contexts(coverage_variants)
+        num_samples = len(contexts)
+        id_prefix = "cov"
+        print(f"Generating {num_samples} coverage samples ({coverage_variants} per decision path) with seed {seed}...")
+    elif mode == "hard":
+        contexts = generate_hard_contexts(hard_examples, num_samples, scenario_weights)
+        id_prefix = "hard"
+        print(f"Generating {num_samples} hard-example samples ({len(hard_examples['failing_contexts'])} failures) with seed {seed}...")
+    else:
+        contexts = (generate_random_context(weights=scenario_weights) for _ in range(num_samples))
+        id_prefix = "gen"
+        print(f"Generating {num_samples} samples with seed {seed}...")
     
-    for i in range(num_samples):
-        ctx, prompt_hint, scenario_type = generate_random_context()
+    for i, (ctx, prompt_hint, scenario_type) in enumerate(contexts):
         actions = determine_actions(ctx, prompt_hint)
         
         # 1. Create Canonical Sample (Chatbot Tester Format)
         prompt_text = construct_prompt(ctx, prompt_hint)
         
-        sample_id = f"gen_{seed}_{i:05d}"
+        sample_id = f"{id_prefix}_{seed}_{i:05d}"
         sample = {
             "id": sample_id,
             "messages": [
@@ -246,6 +311,7 @@ def run_generator(output_dir, num_samples, seed):
             }
         }
         canonical_samples.append(sample)
+        context_records.append(context_record(sample_id, ctx, prompt_hint, actions, scenario_type))
         
         # Update stats
         tag_counts[scenario_type] = tag_counts.get(scenario_type, 0) + 1
@@ -254,6 +320,30 @@ def run_generator(output_dir, num_samples, seed):
         finetune_entry = format_for_finetuning(prompt_text, actions)
         finetune_samples.append(finetune_entry)
         
+    # Multi-turn sessions (full context first, then deltas). Generated after the
+    # single-turn samples so those stay identical for a given seed.
+    session_records = []
+    for i in range(session_samples):
+        turns = generate_session(session_turns)
+        record_turns = []
+        train_turns = []
+        prev_ctx = None
+        for ctx, prompt_hint, scenario_type in turns:
+            actions = determine_actions(ctx, prompt_hint)
+            if prev_ctx is None:
+                prompt_text = construct_prompt(ctx, prompt_hint)
+            else:
+                prompt_text = construct_delta_prompt(context_delta(prev_ctx, ctx), prompt_hint)
+            record_turns.append({"context": ctx, "prompt_hint": prompt_hint, "expected": actions, "scenario": scenario_type})
+            train_turns.append((prompt_text, actions))
+            prev_ctx = ctx
+        session_records.append({
+            "id": f"session_{seed}_{i:05d}",
+            "turns": record_turns,
+            "tags": sorted({t["scenario"] for t in record_turns}),
+        })
+        finetune_samples.append(format_session_for_finetuning(train_turns))
+
     # Write files
     os.makedirs(output_dir, exist_ok=True)
     
@@ -269,6 +359,18 @@ def run_generator(output_dir, num_samples, seed):
         for s in finetune_samples:
             f.write(json.dumps(s) + "\n")
 
+    # Save structured context sidecar (same order/ids as the canonical dataset)
+    context_path = os.path.join(output_dir, CONTEXT_FILE)
+    with open(context_path, "w") as f:
+        for r in context_records:
+            f.write(json.dumps(r) + "\n")
+
+    if session_records:
+        sessions_path = os.path.join(output_dir, "dataset_sessions.jsonl")
+        with open(sessions_path, "w") as f:
+            for s in session_records:
+                f.write(json.dumps(s) + "\n")
+
     # Save Metadata
     metadata = {
         "dataset_id": "driver_assist_generated",
@@ -276,7 +378,15 @@ def run_generator(output_dir, num_samples, seed):
         "created_at": datetime.now().isoformat(),
         "sample_count": num_samples,
         "seed": seed,
-        "tag_stats": tag_counts
+        "generation_mode": mode,
+        "coverage_variants": coverage_variants if mode == "coverage" else 0,
+        "scenario_weights": dict(zip(SCENARIO_TYPES, scenario_weights or SCENARIO_WEIGHTS)),
+        "coverage": coverage_stats([r["context"] for r in context_records]),
+        "tag_stats": tag_counts,
+        "context_file": CONTEXT_FILE,
+        "template_id": DEFAULT_TEMPLATE_ID,
+        "session_samples": session_samples,
+        "session_turns": session_turns if session_samples else 0
     }
     metadata_path = os.path.join(output_dir, "metadata.json")
     with open(metadata_path, "w") as f:
@@ -292,6 +402,11 @@ def main():
     parser.add_argument("--samples", type=int, default=1000)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--output-dir", type=str, default="data_output")
+    parser.add_argument("--session-samples", type=int, default=0, help="Extra multi-turn (delta prompt) training samples")
+    parser.add_argument("--session-turns", type=int, default=3, help="Turns per session sample")
+    parser.add_argument("--mode", type=str, default="random", choices=["random", "coverage"],
+                        help="coverage: N samples per decision path / threshold edge instead of --samples random ones")
+    parser.add_argument("--coverage-variants", type=int, default=3, help="Samples per decision path in coverage mode")
     args = parser.parse_args()
     
     # Start MLflow run
@@ -307,23 +422,38 @@ def main():
 
     try:
         # Log parameters
-        mlflow.log_param("gen_samples", args.samples)
-        mlflow.log_param("gen_seed", args.seed)
+        run_logger.log_params({
+            "gen_samples": args.samples,
+            "gen_seed": args.seed,
+            "gen_session_samples": args.session_samples,
+            "gen_mode": args.mode,
+        })
         
         # Execute generation
-        c_path, f_path, m_path, meta = run_generator(args.output_dir, args.samples, args.seed)
+        c_path, f_path, m_path, meta = run_generator(
+            args.output_dir, args.samples, args.seed,
+            session_samples=args.session_samples, session_turns=args.session_turns,
+            mode=args.mode, coverage_variants=args.coverage_variants
+        )
         
         # Log artifacts
-        mlflow.log_artifact(c_path)
-        mlflow.log_artifact(f_path)
-        mlflow.log_artifact(m_path)
+        run_logger.log_artifact(c_path)
+        run_logger.log_artifact(f_path)
+        run_logger.log_artifact(m_path)
+        run_logger.log_artifact(os.path.join(args.output_dir, CONTEXT_FILE))
+        if args.session_samples:
+            run_logger.log_artifact(os.path.join(args.output_dir, "dataset_sessions.jsonl"))
         
         # Log metrics/tags
-        mlflow.set_tag("dataset_version", meta["version"])
-        for tag, count in meta["tag_stats"].items():
-            mlflow.log_metric(f"count_{tag}", count)
+        run_logger.set_tag("dataset_version", meta["version"])
+        run_logger.log_metrics({f"count_{tag}": count for tag, count in meta["tag_stats"].items()})
+        run_logger.log_metrics({
+            "decision_path_coverage": meta["coverage"]["decision_path_coverage"],
+            "threshold_edges_covered": meta["coverage"]["threshold_edges_covered"],
+        })
             
     finally:
+        run_logger.flush()
         if not active_run:
             mlflow.end_run()
 
@@ -0,0 +1,275 @@
+import argparse
+import copy
+import json
+import os
+import mlflow
+import torch
+import torch.nn.functional as F
+from datasets import load_dataset
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftModel
+from trl import SFTTrainer
+from utils.finetune_utils import get_data_collator, get_training_args
+from utils.columnar_dataset import is_parquet, load_finetune_dataset
+from utils.mlflow_logger import run_logger
+
+DISTILL_CONFIG_FILE = "distill_config.json"
+
+class DistillationTrainer(SFTTrainer):
+    """
+    SFTTrainer whose loss mixes the label cross-entropy with the KL divergence
+    to the (frozen) teacher's temperature-softened distribution:
+        alpha * CE + (1 - alpha) * T^2 * KL(teacher || student)
+    Both terms only cover completion tokens (labels != -100 from
+    CompletionOnlyDataCollator), so the student never learns the prompts.
+    Like the step 2 CE loss, both are summed over tokens and divided by
+    num_items_in_batch (completion tokens across the gradient-accumulation
+    steps) when the Trainer passes it; it then skips its own GA division.
+    """
+
+    def __init__(self, *args, teacher=None, temperature=2.0, alpha=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher.to(self.args.device).eval()
+        for p in self.teacher.parameters():
+            p.requires_grad_(False)
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        labels = inputs["labels"]
+        model_inputs = {"input_ids": inputs["input_ids"], "attention_mask": inputs.get("attention_mask")}
+        outputs = model(**model_inputs)
+        with torch.no_grad():
+            teacher_logits = self.teacher(**model_inputs).logits
+
+        # Position t predicts token t + 1
+        mask = labels[:, 1:] != -100
+        if not mask.any():
+            loss = outputs.logits.sum() * 0.0
+            return (loss, outputs) if return_outputs else loss
+        student = outputs.logits[:, :-1][mask].float()
+        teacher = teacher_logits[:, :-1][mask].float()
+        targets = labels[:, 1:][mask]
+
+        ce = F.cross_entropy(student, targets, reduction="sum")
+        t = self.temperature
+        kl = F.kl_div(
+            F.log_softmax(student / t, dim=-1),
+            F.log_softmax(teacher / t, dim=-1),
+            log_target=True,
+            reduction="sum",
+        ) * (t * t)
+        # Per-token mean over the whole accumulated batch, else over this micro-batch
+        denominator = num_items_in_batch if num_items_in_batch is not None else targets.numel()
+        loss = (self.alpha * ce + (1.0 - self.alpha) * kl) / denominator
+        return (loss, outputs) if return_outputs else loss
+
+def load_teacher(base_model_name, adapter_path):
+    """
+    Base model with the step 2 adapter merged in (fp32, frozen).
+    """
+    print(f"Loading teacher: {base_model_name} + {adapter_path}")
+    model = AutoModelForCausalLM.from_pretrained(base_model_name, torch_dtype=torch.float32, trust_remote_code=True)
+    model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    model.eval()
+    return model
+
+def select_layers(num_teacher_layers, num_student_layers):
+    """
+    Evenly spaced teacher layers (first and last always included).
+    """
+    if num_student_layers >= num_teacher_layers:
+        return list(range(num_teacher_layers))
+    if num_student_layers == 1:
+        return [num_teacher_layers - 1]
+    step = (num_teacher_layers - 1) / (num_student_layers - 1)
+    return [round(i * step) for i in range(num_student_layers)]
+
+def build_student(teacher, num_layers=None, overrides=None):
+    """
+    Student config = teacher config with fewer layers and/or the overrides
+    (e.g. {"hidden_size": 320, "intermediate_size": 1024}). The vocabulary
+    is kept so teacher and student logits line up.
+    If only the depth changes, the student starts from the teacher's
+    embeddings, final norm and the selected layers; otherwise from scratch.
+    Returns (student, teacher layer indices or None).
+    """
+    config = copy.deepcopy(teacher.config)
+    overrides = dict(overrides or {})
+    overrides.pop("vocab_size", None)
+    layer_ids = None
+    if num_layers:
+        layer_ids = select_layers(teacher.config.num_hidden_layers, num_layers)
+        config.num_hidden_layers = len(layer_ids)
+        if getattr(config, "layer_types", None):
+            # Gemma 3 alternates sliding-window / full attention per layer
+            config.layer_types = [teacher.config.layer_types[i] for i in layer_ids]
+    for key, value in overrides.items():
+        setattr(config, key, value)
+
+    student = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32, trust_remote_code=True)
+    if overrides:
+        print("Student width differs from the teacher; initializing from scratch")
+        return student, None
+
+    layer_ids = layer_ids or list(range(config.num_hidden_layers))
+    new_index = {old: new for new, old in enumerate(layer_ids)}
+    state = {}
+    for key, value in teacher.state_dict().items():
+        if ".layers." in key:
+            prefix, rest = key.split(".layers.", 1)
+            idx, suffix = rest.split(".", 1)
+            if int(idx) not in new_index:
+                continue
+            key = f"{prefix}.layers.{new_index[int(idx)]}.{suffix}"
+        state[key] = value
+    missing, unexpected = student.load_state_dict(state, strict=False)
+    print(f"Student initialized from teacher layers {layer_ids} ({len(missing)} missing, {len(unexpected)} unexpected keys)")
+    return student, layer_ids
+
+def count_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+def run_distillation(
+    teacher_path,
+    dataset_path,
+    output_dir,
+    base_model_name,
+    epochs,
+    batch_size,
+    learning_rate,
+    student_layers=None,
+    student_overrides=None,
+    temperature=2.0,
+    alpha=0.5,
+):
+    # 1. Teacher (merged adapter) & Tokenizer
+    teacher = load_teacher(base_model_name, teacher_path)
+    tokenizer = AutoTokenizer.from_pretrained(base_model_name, trust_remote_code=True)
+    tokenizer.padding_side = 'right' # FunctionGemma specific
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    # 2. Student
+    student, layer_ids = build_student(teacher, student_layers, student_overrides)
+    student.config.use_cache = False
+    teacher_params, student_params = count_params(teacher), count_params(student)
+    print(f"Teacher {teacher_params / 1e6:.1f}M params -> student {student_params / 1e6:.1f}M params")
+
+    # 3. Dataset (same text format and completion-only masking as step 2)
+    print(f"Loading dataset from {dataset_path}...")
+    if is_parquet(dataset_path):
+        dataset = load_finetune_dataset(dataset_path)
+    else:
+        dataset = load_dataset("json", data_files=dataset_path, split="train")
+    collator = get_data_collator(tokenizer)
+
+    training_args = get_training_args(
+        output_dir=output_dir,
+        epochs=epochs,
+        batch_size=batch_size,
+        learning_rate=learning_rate,
+        save_strategy="no"
+    )
+
+    trainer = DistillationTrainer(
+        model=student,
+        train_dataset=dataset,
+        processing_class=tokenizer,
+        args=training_args,
+        data_collator=collator,
+        teacher=teacher,
+        temperature=temperature,
+        alpha=alpha,
+    )
+
+    print("Starting distillation...")
+    trainer.train()
+
+    # 4. Save the full student model (step 3 loads it without an adapter)
+    student_path = os.path.join(output_dir, "student_model")
+    trainer.model.config.use_cache = True
+    trainer.save_model(student_path)
+    tokenizer.save_pretrained(student_path)
+    distill_config = {
+        "teacher_adapter": teacher_path,
+        "base_model": base_model_name,
+        "teacher_layers": layer_ids,
+        "student_overrides": student_overrides or {},
+        "teacher_params": teacher_params,
+        "student_params": student_params,
+        "temperature": temperature,
+        "alpha": alpha,
+    }
+    with open(os.path.join(student_path, DISTILL_CONFIG_FILE), "w") as f:
+        json.dump(distill_config, f, indent=2)
+    print(f"Student saved to {student_path}")
+
+    if mlflow.active_run():
+        run_logger.log_params({
+            "student_layers": student.config.num_hidden_layers,
+            "distill_temperature": temperature,
+            "distill_alpha": alpha,
+        })
+        run_logger.log_metrics({
+            "teacher_params_m": teacher_params / 1e6,
+            "student_params_m": student_params / 1e6,
+            "student_param_ratio": student_params / teacher_params,
+        })
+        run_logger.log_artifact(os.path.join(student_path, DISTILL_CONFIG_FILE))
+
+    return student_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill the fine-tuned model into a smaller student")
+    parser.add_argument("--teacher-path", type=str, required=True, help="Teacher adapter (step 2 final_model)")
+    parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset_finetune.jsonl or dataset.parquet")
+    parser.add_argument("--output-dir", type=str, default="distill_output")
+    parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=6)
+    parser.add_argument("--learning-rate", type=float, default=1e-4)
+    parser.add_argument("--student-layers", type=int, default=6, help="Student depth (teacher layers are subsampled)")
+    parser.add_argument("--student-config", type=str, default=None,
+                        help="JSON file with config overrides, e.g. {\"hidden_size\": 320, \"intermediate_size\": 1024}")
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--alpha", type=float, default=0.5, help="Weight of the label loss (1 - alpha for the teacher KL)")
+    parser.add_argument("--experiment-name", type=str, default=None, help="MLflow experiment name for standalone run")
+    args = parser.parse_args()
+
+    overrides = None
+    if args.student_config:
+        with open(args.student_config, "r") as f:
+            overrides = json.load(f)
+
+    if args.experiment_name:
+        mlflow.set_experiment(args.experiment_name)
+
+    active_run = mlflow.active_run()
+    if active_run:
+        print(f"Attach to existing run: {active_run.info.run_id}")
+    else:
+        print("Starting new MLflow run...")
+        mlflow.start_run(run_name="distillation")
+
+    try:
+        run_distillation(
+            args.teacher_path,
+            args.dataset_path,
+            args.output_dir,
+            args.base_model,
+            args.epochs,
+            args.batch_size,
+            args.learning_rate,
+            student_layers=args.student_layers,
+            student_overrides=overrides,
+            temperature=args.temperature,
+            alpha=args.alpha,
+        )
+    finally:
+        run_logger.flush()
+        if not active_run:
+            mlflow.end_run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import mlflow
+from utils.export_utils import merge_adapter, export_gguf
+from utils.mlflow_logger import run_logger
+
+DEFAULT_QUANTS = ["Q8_0", "Q4_K_M"]
+
+def run_gguf_export(model_path, base_model_name, output_dir, quant_types=DEFAULT_QUANTS, llama_cpp_dir=None):
+    """
+    Merge the step 2 adapter (final_model) into the base model and convert it
+    to GGUF at each requested quantization level.
+    Returns {quant_type: gguf_path}.
+    """
+    merged_dir = merge_adapter(base_model_name, model_path, os.path.join(output_dir, "merged"))
+    gguf_paths = export_gguf(merged_dir, output_dir, quant_types=quant_types, llama_cpp_dir=llama_cpp_dir)
+
+    manifest = {
+        "adapter_path": model_path,
+        "base_model": base_model_name,
+        "files": {q: {"path": p, "size_mb": os.path.getsize(p) / (1024 * 1024)} for q, p in gguf_paths.items()},
+    }
+    manifest_path = os.path.join(output_dir, "gguf_manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    for quant, info in manifest["files"].items():
+        print(f"  {quant}: {info['path']} ({info['size_mb']:.1f} MB)")
+    return gguf_paths, manifest_path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True, help="Path to adapter (step 2 final_model)")
+    parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--output-dir", type=str, default="gguf_output")
+    parser.add_argument("--quants", type=str, nargs="+", default=DEFAULT_QUANTS)
+    parser.add_argument("--llama-cpp-dir", type=str, default=None, help="llama.cpp checkout (default: $LLAMA_CPP_DIR)")
+    parser.add_argument("--experiment-name", type=str, default=None, help="MLflow experiment name for standalone run")
+    args = parser.parse_args()
+
+    if args.experiment_name:
+        mlflow.set_experiment(args.experiment_name)
+
+    active_run = mlflow.active_run()
+    if active_run:
+        print(f"Attach to existing run: {active_run.info.run_id}")
+    else:
+        print("Starting new MLflow run...")
+        mlflow.start_run(run_name="gguf_export")
+
+    try:
+        gguf_paths, manifest_path = run_gguf_export(
+            args.model_path,
+            args.base_model,
+            args.output_dir,
+            quant_types=args.quants,
+            llama_cpp_dir=args.llama_cpp_dir,
+        )
+        run_logger.log_param("gguf_quants", ",".join(args.quants))
+        run_logger.log_metrics({f"gguf_size_mb_{quant}": os.path.getsize(path) / (1024 * 1024) for quant, path in gguf_paths.items()})
+        run_logger.log_artifact(manifest_path)
+    finally:
+        run_logger.flush()
+        if not active_run:
+            mlflow.end_run()
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,51 @@ import os
 import mlflow
 from datasets import load_dataset
 from trl import SFTTrainer
+from transformers.trainer_utils import get_last_checkpoint
 from utils.finetune_utils import (
     load_model_and_tokenizer,
     get_lora_config,
     get_data_collator,
     get_training_args
 )
+from utils.checkpointing import AsyncCheckpointCallback
+from utils.columnar_dataset import is_parquet, load_finetune_dataset
+from utils.mlflow_logger import run_logger
 
-def run_finetuning(dataset_path, output_dir, model_name, epochs, batch_size, learning_rate):
+def run_finetuning(
+    dataset_path,
+    output_dir,
+    model_name,
+    epochs,
+    batch_size,
+    learning_rate,
+    profile=False,
+    profile_steps=3,
+    save_every_seconds=None,
+    save_every_epoch=0.25,
+    keep_last=2,
+    resume_from_checkpoint=None,
+    init_adapter=None,
+):
     # 1. Load Model & Tokenizer
     model, tokenizer = load_model_and_tokenizer(model_name)
     
     # 2. Load Dataset
     print(f"Loading dataset from {dataset_path}...")
-    dataset = load_dataset("json", data_files=dataset_path, split="train")
+    if is_parquet(dataset_path):
+        dataset = load_finetune_dataset(dataset_path)
+    else:
+        dataset = load_dataset("json", data_files=dataset_path, split="train")
 
     # 3. Get LoRA Config (Optimized from train_unsloth.py)
-    peft_config = get_lora_config()
+    if init_adapter:
+        # Incremental round: keep training an existing adapter instead of a fresh one
+        from peft import PeftModel
+        print(f"Continuing from adapter {init_adapter}...")
+        model = PeftModel.from_pretrained(model, init_adapter, is_trainable=True)
+        peft_config = None
+    else:
+        peft_config = get_lora_config()
     
     # 4. Get Data Collator (Fixes padding issue)
     collator = get_data_collator(tokenizer)
@@ -29,9 +57,26 @@ def run_finetuning(dataset_path, output_dir, model_name, epochs, batch_size, lea
         output_dir=output_dir,
         epochs=epochs,
         batch_size=batch_size,
-        learning_rate=learning_rate
+        learning_rate=learning_rate,
+        save_strategy="no" # adapter-only async checkpoints below
     )
 
+    # Adapter-only checkpoints on a time/epoch-fraction budget, written in the background
+    callbacks = []
+    if save_every_seconds or save_every_epoch:
+        callbacks.append(AsyncCheckpointCallback(
+            output_dir,
+            every_seconds=save_every_seconds,
+            every_epoch_fraction=save_every_epoch,
+            keep_last=keep_last,
+        ))
+
+    # Optional: torch.profiler trace, collator timing and memory per step
+    if profile:
+        from utils.profiling import TimedCollator, ProfilingCallback
+        collator = TimedCollator(collator)
+        callbacks.append(ProfilingCallback(os.path.join(output_dir, "profiling"), collator, active=profile_steps))
+
     # 6. Initialize Trainer
     trainer = SFTTrainer(
         model=model,
@@ -40,10 +85,14 @@ def run_finetuning(dataset_path, output_dir, model_name, epochs, batch_size, lea
         args=training_args,
         peft_config=peft_config,
         data_collator=collator,
+        callbacks=callbacks,
     )
 
-    print("Starting training...")
-    trainer.train()
+    if resume_from_checkpoint:
+        print(f"Resuming training from {resume_from_checkpoint}...")
+    else:
+        print("Starting training...")
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
     
     # 7. Save Model
     final_model_path = os.path.join(output_dir, "final_model")
@@ -63,13 +112,20 @@ def run_finetuning(dataset_path, output_dir, model_name, epochs, batch_size, lea
 def main():
     print("Script started...")
     parser = argparse.ArgumentParser()
-    parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset_finetune.jsonl")
+    parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset_finetune.jsonl or dataset.parquet")
     parser.add_argument("--output-dir", type=str, default="model_output")
     parser.add_argument("--model-name", type=str, default="google/functiongemma-270m-it")
     parser.add_argument("--epochs", type=int, default=1)
     parser.add_argument("--batch-size", type=int, default=6)
     parser.add_argument("--learning-rate", type=float, default=2e-4)
     parser.add_argument("--experiment-name", type=str, default=None, help="MLflow experiment name for standalone run")
+    parser.add_argument("--profile", action="store_true", help="Record a torch.profiler trace and per-step timing/memory")
+    parser.add_argument("--profile-steps", type=int, default=3, help="Optimizer steps captured in the profiler trace")
+    parser.add_argument("--save-every-seconds", type=float, default=None, help="Checkpoint at most this often (wall clock)")
+    parser.add_argument("--save-every-epoch", type=float, default=0.25, help="Checkpoint every fraction of an epoch (0 with no --save-every-seconds disables checkpoints)")
+    parser.add_argument("--keep-last", type=int, default=2, help="Checkpoints kept besides the best one")
+    parser.add_argument("--resume", action="store_true", help="Continue from the latest checkpoint in --output-dir")
+    parser.add_argument("--init-adapter", type=str, default=None, help="Continue training this LoRA adapter (e.g. a previous final_model) instead of a new one")
     args = parser.parse_args()
 
     # MLflow auto-logging
@@ -92,9 +148,17 @@ def main():
             args.model_name, 
             args.epochs, 
             args.batch_size, 
-            args.learning_rate
+            args.learning_rate,
+            profile=args.profile,
+            profile_steps=args.profile_steps,
+            save_every_seconds=args.save_every_seconds,
+            save_every_epoch=args.save_every_epoch,
+            keep_last=args.keep_last,
+            resume_from_checkpoint=get_last_checkpoint(args.output_dir) if args.resume and os.path.isdir(args.output_dir) else None,
+            init_adapter=args.init_adapter
         )
     finally:
+        run_logger.flush()
         if not active_run:
             mlflow.end_run()
 
@@ -1,6 +1,7 @@
 import argparse
 import json
 import os
+import time
 import mlflow
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -8,15 +9,33 @@ from peft import PeftModel
 import numpy as np
 from tqdm import tqdm
 from openai import OpenAI
+from utils.inference_backends import BACKENDS, TorchBackend, OnnxBackend, LlamaCppBackend, generate_response
+from utils.quantization import QUANT_MODES, quantize_model, model_size_mb, current_rss_mb
+from utils.model_cache import load_cached_model, default_cache_dir
+from utils.tracing import StageTimer, summarize_timings
+from utils.columnar_dataset import is_parquet, iter_canonical
+from utils.vocab_trim import is_trimmed_model, load_trimmed_model, TrimmedTokenizer
+from utils.mlflow_logger import run_logger
 
-def load_model(base_model_name, adapter_path):
+def load_model(base_model_name, adapter_path, cache_dir=None):
     print(f"Loading base model: {base_model_name}")
     tokenizer = AutoTokenizer.from_pretrained(base_model_name, trust_remote_code=True)
     
+    # fp16 kernels are slow or missing on CPU
+    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+
+    # Warm start: merged + dtype-converted weights from the local model cache
+    cache_dir = cache_dir or default_cache_dir()
+    if cache_dir:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = load_cached_model(base_model_name, adapter_path, dtype=dtype, device=device, cache_dir=cache_dir)
+        return model, tokenizer
+
+    start = time.perf_counter()
     # Load base model
     base_model = AutoModelForCausalLM.from_pretrained(
         base_model_name,
-        torch_dtype=torch.float16,
+        torch_dtype=dtype,
         device_map="auto",
         trust_remote_code=True
     )
@@ -25,36 +44,91 @@ def load_model(base_model_name, adapter_path):
     print(f"Loading adapter from: {adapter_path}")
     model = PeftModel.from_pretrained(base_model, adapter_path)
     model.eval()
+
+    load_seconds = time.perf_counter() - start
+    print(f"Model ready in {load_seconds:.2f}s")
+    if mlflow.active_run():
+        run_logger.log_metric("model_load_seconds", load_seconds)
     
     return model, tokenizer
 
+def is_full_model(model_path):
+    """
+    A saved model dir without a LoRA adapter (e.g. the step2_distill student).
+    """
+    return (os.path.isdir(model_path)
+            and os.path.exists(os.path.join(model_path, "config.json"))
+            and not os.path.exists(os.path.join(model_path, "adapter_config.json")))
+
+def load_full_model(model_path):
+    print(f"Loading full model: {model_path}")
+    start = time.perf_counter()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=dtype, device_map="auto", trust_remote_code=True)
+    model.eval()
+    load_seconds = time.perf_counter() - start
+    print(f"Model ready in {load_seconds:.2f}s")
+    if mlflow.active_run():
+        run_logger.log_metric("model_load_seconds", load_seconds)
+    return model, tokenizer
+
 def run_inference(model, tokenizer, prompt):
-    # FunctionGemma prompt format for inference
-    formatted_prompt = f"<start_of_turn>user\n{prompt}<end_of_turn>\n<start_of_turn>model\n"
-    
-    inputs = tokenizer(formatted_prompt, return_tensors="pt").to(model.device)
-    
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=256,
-            do_sample=False, # Deterministic for eval
-            temperature=0.0
-        )
-    
-    generated_text = tokenizer.decode(outputs[0], skip_special_tokens=False)
-    
-    # Extract model response part
-    # Look for <start_of_turn>model\n and take everything after until <end_of_turn>
-    try:
-        parts = generated_text.split("<start_of_turn>model\n")
-        if len(parts) > 1:
-            response_part = parts[1].split("<end_of_turn>")[0]
-            return response_part.strip()
-    except:
-        pass
-        
-    return generated_text # Fallback
+    response, _ = generate_response(model, tokenizer, prompt)
+    return response
+
+def load_backend(backend, base_model_name, model_path, decoding="generate", work_dir=None, quantize="none", model_cache_dir=None):
+    """
+    Build an inference backend for run_evaluation.
+    - torch: base model + adapter (model_path = adapter dir); quantize=int8/int4
+      merges the adapter and quantizes the model for CPU inference. A
+      utils/vocab_trim.py output dir loads the trimmed model and tokenizer, a
+      full model dir (e.g. the step2_distill student) loads as-is
+    - onnx: model_path is an exported ONNX dir, or an adapter dir that is
+      merged and exported (int8) into work_dir first
+    - llama_cpp: model_path is a .gguf file, or an adapter dir that is
+      merged and exported (Q8_0) into work_dir first
+    """
+    if backend == "torch":
+        if is_trimmed_model(model_path):
+            if decoding != "generate":
+                raise ValueError("Trimmed-vocabulary models only support decoding=generate")
+            model, tokenizer = load_trimmed_model(model_path)
+        elif is_full_model(model_path):
+            model, tokenizer = load_full_model(model_path)
+        else:
+            model, tokenizer = load_model(base_model_name, model_path, cache_dir=model_cache_dir)
+        model = quantize_model(model, quantize)
+        return TorchBackend(model, tokenizer, decoding=decoding)
+
+    if quantize != "none":
+        raise ValueError(f"quantize={quantize} is only supported by the torch backend")
+    if decoding != "generate":
+        raise ValueError(f"decoding={decoding} is only supported by the torch backend")
+
+    if backend == "onnx":
+        from utils.export_utils import merge_adapter, export_onnx, ONNX_QUANTIZED_FILE
+        if os.path.exists(os.path.join(model_path, "adapter_config.json")):
+            work_dir = work_dir or "onnx_export"
+            merged_dir = merge_adapter(base_model_name, model_path, os.path.join(work_dir, "merged"))
+            onnx_dir = os.path.join(work_dir, "onnx")
+            file_name = export_onnx(merged_dir, onnx_dir, quantize=True)
+        else:
+            onnx_dir = model_path
+            quantized = os.path.exists(os.path.join(onnx_dir, ONNX_QUANTIZED_FILE))
+            file_name = ONNX_QUANTIZED_FILE if quantized else None
+        return OnnxBackend(onnx_dir, file_name=file_name)
+
+    if backend == "llama_cpp":
+        gguf_path = model_path
+        if os.path.isdir(model_path):
+            from utils.export_utils import merge_adapter, export_gguf
+            work_dir = work_dir or "gguf_export"
+            merged_dir = merge_adapter(base_model_name, model_path, os.path.join(work_dir, "merged"))
+            gguf_path = export_gguf(merged_dir, work_dir, quant_types=("Q8_0",))["Q8_0"]
+        return LlamaCppBackend(gguf_path)
+
+    raise ValueError(f"Unknown backend: {backend} (available: {', '.join(BACKENDS)})")
 
 def _extract_json_from_text(text: str):
     cleaned = (text or "").strip()
@@ -101,6 +175,25 @@ def geval_judge_tool_calls(
     reason = str(obj.get("reason", ""))
     return verdict, reason, content
 
+PARTIAL_RESULTS_FILE = "eval_results.partial.jsonl"
+
+def load_partial_results(path):
+    """
+    {sample_id: result} from an interrupted run. A truncated last line
+    (crash mid-write) is ignored and that sample is scored again.
+    """
+    prior = {}
+    if not os.path.exists(path):
+        return prior
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                res = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            prior[res["id"]] = res
+    return prior
+
 def run_evaluation(
     model_path,
     dataset_path,
@@ -109,18 +202,39 @@ def run_evaluation(
     enable_geval=False,
     geval_model="gpt-4o-mini",
     geval_max_samples=0,
+    decoding="generate",
+    backend="torch",
+    quantize="none",
+    model_cache_dir=None,
+    resume=False,
 ):
-    # Load Model
-    model, tokenizer = load_model(base_model_name, model_path)
+    # Load Model (RSS is measured as a delta so variants in one process stay comparable)
+    rss_before = current_rss_mb()
+    engine = load_backend(
+        backend,
+        base_model_name,
+        model_path,
+        decoding=decoding,
+        work_dir=os.path.join(output_dir, f"{backend}_export"),
+        quantize=quantize,
+        model_cache_dir=model_cache_dir,
+    )
+    run_logger.set_tags({"decoding": decoding, "backend": backend, "quantize": quantize})
+    rss_loaded = current_rss_mb()
+    rss_eval_peak = rss_loaded
     
     # Load Dataset
     print(f"Loading validation dataset: {dataset_path}")
-    with open(dataset_path, "r") as f:
-        lines = f.readlines()
-        
-    samples = [json.loads(line) for line in lines]
+    if is_parquet(dataset_path):
+        samples = list(iter_canonical(dataset_path))
+    else:
+        with open(dataset_path, "r") as f:
+            lines = f.readlines()
+        samples = [json.loads(line) for line in lines]
     
     results = []
+    latencies = []
+    completion_tokens = 0
     correct_count = 0
     valid_json_count = 0
     # Tag breakdown
@@ -130,27 +244,63 @@ def run_evaluation(
     openai_api_key = os.environ.get("OPENAI_API_KEY")
     if enable_geval and not openai_api_key:
         enable_geval = False
-        mlflow.set_tag("geval_status", "skipped_no_openai_api_key")
+        run_logger.set_tag("geval_status", "skipped_no_openai_api_key")
 
     openai_client = OpenAI(api_key=openai_api_key) if enable_geval else None
     geval_judged = 0
     geval_correct = 0
     geval_results = []
     
-    print(f"Evaluating {len(samples)} samples...")
+    # Every scored sample is appended here so an interrupted run can resume
+    os.makedirs(output_dir, exist_ok=True)
+    partial_path = os.path.join(output_dir, PARTIAL_RESULTS_FILE)
+    prior_results = load_partial_results(partial_path) if resume else {}
+    sample_ids = {sample["id"] for sample in samples}
+    prior_results = {sid: res for sid, res in prior_results.items() if sid in sample_ids}
+    if prior_results:
+        print(f"Resuming: {len(prior_results)} samples already scored in {partial_path}")
+    for res in prior_results.values():
+        results.append(res)
+        latencies.append(res["latency_ms"])
+        completion_tokens += res["generation"].get("completion_tokens") or 0
+        correct_count += int(res["is_correct"])
+        valid_json_count += int(res["predicted_parsed"] is not None)
+        for tag in res.get("tags", []):
+            tag_stats.setdefault(tag, {"total": 0, "correct": 0})
+            tag_stats[tag]["total"] += 1
+            tag_stats[tag]["correct"] += int(res["is_correct"])
+        if openai_client is not None and res.get("geval_verdict") is not None:
+            geval_judged += 1
+            geval_correct += int(bool(res["geval_verdict"]))
+            geval_results.append({"id": res["id"], "verdict": bool(res["geval_verdict"]), "reason": res["geval_reason"],
+                                  "judge_model": geval_model, "raw": None})
+    # Rewrite the valid prefix so a truncated line never sits mid-file
+    partial_file = open(partial_path, "w")
+    for res in prior_results.values():
+        partial_file.write(json.dumps(res) + "\n")
+    partial_file.flush()
+
+    print(f"Evaluating {len(samples) - len(prior_results)} samples...")
     
     # Import Metric
     # from chatbot_tester.evaluator.metrics.tool_call import ToolCallMatchMetric
     from utils.metric_utils import ToolCallMatchMetric
     
-    for sample in tqdm(samples):
+    for sample in tqdm([s for s in samples if s["id"] not in prior_results]):
         # Extract user prompt from canonical format
         user_msg = next((m["content"] for m in sample["messages"] if m["role"] == "user"), "")
         
-        predicted_str = run_inference(model, tokenizer, user_msg)
+        timer = StageTimer()
+        start = time.perf_counter()
+        predicted_str, gen_stats = engine.generate(user_msg, timer=timer)
+        latency_ms = (time.perf_counter() - start) * 1000.0
+        latencies.append(latency_ms)
+        rss_eval_peak = max(rss_eval_peak, current_rss_mb(release=False))
+        completion_tokens += gen_stats.get("completion_tokens") or 0
         expected_obj = sample["expected"]
         
-        is_match, reason, pred_obj = ToolCallMatchMetric.match(predicted_str, expected_obj)
+        with timer.stage("parse"):
+            is_match, reason, pred_obj = ToolCallMatchMetric.match(predicted_str, expected_obj)
 
         geval_verdict = None
         geval_reason = None
@@ -158,13 +308,14 @@ def run_evaluation(
         if openai_client is not None:
             if (geval_max_samples or 0) <= 0 or geval_judged < int(geval_max_samples):
                 try:
-                    geval_verdict, geval_reason, geval_raw = geval_judge_tool_calls(
-                        client=openai_client,
-                        judge_model=geval_model,
-                        user_prompt=user_msg,
-                        expected_tool_calls=expected_obj,
-                        predicted_text=predicted_str,
-                    )
+                    with timer.stage("geval"):
+                        geval_verdict, geval_reason, geval_raw = geval_judge_tool_calls(
+                            client=openai_client,
+                            judge_model=geval_model,
+                            user_prompt=user_msg,
+                            expected_tool_calls=expected_obj,
+                            predicted_text=predicted_str,
+                        )
                     geval_judged += 1
                     if geval_verdict:
                         geval_correct += 1
@@ -209,8 +360,15 @@ def run_evaluation(
             "tags": sample.get("tags", []),
             "geval_verdict": geval_verdict,
             "geval_reason": geval_reason,
+            "latency_ms": latency_ms,
+            "generation": gen_stats,
+            "timing": timer.as_dict(),
         })
+        partial_file.write(json.dumps(results[-1]) + "\n")
+        partial_file.flush()
         
+    partial_file.close()
+
     # Metrics
     accuracy = correct_count / len(samples) if samples else 0
     json_validity = valid_json_count / len(samples) if samples else 0
@@ -219,23 +377,56 @@ def run_evaluation(
         "accuracy_total": accuracy,
         "json_validity_score": json_validity
     }
+    if latencies:
+        metrics["latency_ms_mean"] = float(np.mean(latencies))
+        metrics["latency_ms_p50"] = float(np.percentile(latencies, 50))
+        metrics["latency_ms_p95"] = float(np.percentile(latencies, 95))
+        if completion_tokens:
+            metrics["tokens_per_sec"] = completion_tokens / (sum(latencies) / 1000.0)
+
+    # Per-stage timing and token throughput
+    metrics.update(summarize_timings([r["timing"] for r in results]))
+    ttfts = [r["generation"]["ttft_ms"] for r in results if r["generation"].get("ttft_ms") is not None]
+    if ttfts:
+        metrics["ttft_ms_p50"] = float(np.percentile(ttfts, 50))
+        metrics["ttft_ms_p95"] = float(np.percentile(ttfts, 95))
+    prompt_tokens = [r["generation"].get("prompt_tokens") or 0 for r in results]
+    if any(prompt_tokens):
+        metrics["prompt_tokens_mean"] = float(np.mean(prompt_tokens))
+        metrics["completion_tokens_mean"] = float(np.mean([r["generation"].get("completion_tokens") or 0 for r in results]))
+    prefill_ms = sum(r["timing"].get("prefill", 0.0) for r in results)
+    decode_ms = sum(r["timing"].get("decode", 0.0) for r in results)
+    if prefill_ms and any(prompt_tokens):
+        metrics["prefill_tokens_per_sec"] = sum(prompt_tokens) / (prefill_ms / 1000.0)
+    if decode_ms and completion_tokens:
+        # The first token comes out of the prefill pass
+        metrics["decode_tokens_per_sec"] = max(completion_tokens - len(ttfts), 0) / (decode_ms / 1000.0)
+
+    # Memory footprint
+    if isinstance(engine, TorchBackend):
+        metrics["model_size_mb"] = model_size_mb(engine.model)
+        if isinstance(engine.tokenizer, TrimmedTokenizer):
+            metrics["oov_tokens"] = engine.tokenizer.oov_tokens
+    metrics["rss_model_mb"] = rss_loaded - rss_before
+    metrics["rss_eval_peak_mb"] = rss_eval_peak - rss_before
 
     if openai_client is not None and geval_judged > 0:
         metrics["accuracy_geval"] = geval_correct / float(geval_judged)
         metrics["geval_judged_count"] = float(geval_judged)
-        mlflow.set_tag("geval_status", "enabled")
-        mlflow.set_tag("geval_model", geval_model)
+        run_logger.set_tags({"geval_status": "enabled", "geval_model": geval_model})
     
     # Add per-tag accuracy
     for tag, stat in tag_stats.items():
         tag_acc = stat["correct"] / stat["total"] if stat["total"] > 0 else 0
         metrics[f"accuracy_{tag}"] = tag_acc
         
-    # Save detailed results
-    os.makedirs(output_dir, exist_ok=True)
+    # Save detailed results (dataset order, also when resumed)
+    order = {sample["id"]: i for i, sample in enumerate(samples)}
+    results.sort(key=lambda r: order.get(r["id"], len(order)))
     results_path = os.path.join(output_dir, "eval_results.json")
     with open(results_path, "w") as f:
         json.dump(results, f, indent=2)
+    os.remove(partial_path)
 
     geval_path = None
     if openai_client is not None and len(geval_results) > 0:
@@ -248,14 +439,24 @@ def run_evaluation(
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model-path", type=str, required=True, help="Path to adapter (step 2 output)")
-    parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset_canonical.jsonl (step 1 output)")
+    parser.add_argument("--model-path", type=str, required=True, help="Path to adapter (step 2 output), or a full / vocab-trimmed model dir")
+    parser.add_argument("--dataset-path", type=str, required=True, help="Path to dataset_canonical.jsonl (step 1 output) or dataset.parquet")
     parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
     parser.add_argument("--output-dir", type=str, default="eval_output")
     parser.add_argument("--experiment-name", type=str, default=None, help="MLflow experiment name for standalone run")
     parser.add_argument("--geval", action="store_true", help="Enable OpenAI G-Eval judging")
     parser.add_argument("--geval-model", type=str, default="gpt-4o-mini")
     parser.add_argument("--geval-max-samples", type=int, default=0, help="0 means judge all samples")
+    parser.add_argument("--decoding", type=str, default="generate", choices=["generate", "structured"],
+                        help="structured: pick tool names/arguments from known choices instead of free-form generation")
+    parser.add_argument("--backend", type=str, default="torch", choices=sorted(BACKENDS),
+                        help="onnx/llama_cpp: --model-path may be an exported model (ONNX dir / .gguf) or an adapter to merge+export")
+    parser.add_argument("--quantize", type=str, default="none", choices=QUANT_MODES,
+                        help="torch backend only: merge the adapter and quantize on CPU (int8 dynamic / int4 weight-only)")
+    parser.add_argument("--model-cache-dir", type=str, default=None,
+                        help="Cache merged safetensors here for fast restarts (default: $MODEL_CACHE_DIR, disabled if unset)")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"Skip samples already scored in <output-dir>/{PARTIAL_RESULTS_FILE}")
     args = parser.parse_args()
     
     if args.experiment_name:
@@ -277,19 +478,24 @@ def main():
             enable_geval=args.geval,
             geval_model=args.geval_model,
             geval_max_samples=args.geval_max_samples,
+            decoding=args.decoding,
+            backend=args.backend,
+            quantize=args.quantize,
+            model_cache_dir=args.model_cache_dir,
+            resume=args.resume,
         )
         
         # Log metrics
-        for k, v in metrics.items():
-            mlflow.log_metric(k, v)
+        run_logger.log_metrics(metrics)
             
         # Log artifact
-        mlflow.log_artifact(results_path)
+        run_logger.log_artifact(results_path)
 
         if geval_path:
-            mlflow.log_artifact(geval_path)
+            run_logger.log_artifact(geval_path)
         
     finally:
+        run_logger.flush()
         if not active_run:
             mlflow.end_run()
 
@@ -1,116 +1,321 @@
 import json
 import os
-import random
+import hashlib
 import argparse
+import tempfile
 from collections import Counter
 
-def analyze_and_split(canonical_path, finetune_path, output_dir, train_ratio=0.9, seed=42):
-    random.seed(seed)
+def infer_tag(user_msg):
+    """
+    Recover the scenario of an untagged sample from the prompt's context JSON
+    (only for datasets without a dataset_context.jsonl sidecar).
+    Returns None if the prompt does not follow the known structure.
+    """
+    # Robust extraction based on known prompt structure
+    marker_start = "Input context is structured sensor state (do not invent fields):\n"
+    marker_end = "\n\nUser prompt:"
     
-    print(f"Loading canonical dataset: {canonical_path}")
-    with open(canonical_path, 'r') as f:
-        canonical_data = [json.loads(line) for line in f]
-        
-    print(f"Loading finetune dataset: {finetune_path}")
-    with open(finetune_path, 'r') as f:
-        finetune_data = [json.loads(line) for line in f]
-        
-    if len(canonical_data) != len(finetune_data):
-        print(f"Warning: Line counts mismatch! Canonical: {len(canonical_data)}, Finetune: {len(finetune_data)}")
-        # Proceed with safe length
-        min_len = min(len(canonical_data), len(finetune_data))
-        canonical_data = canonical_data[:min_len]
-        finetune_data = finetune_data[:min_len]
-    
-    # Analyze Scenarios and Update Tags
-    scenario_counter = Counter()
+    s_idx = user_msg.find(marker_start)
+    e_idx = user_msg.find(marker_end)
+    if s_idx == -1 or e_idx == -1:
+        return None
+
+    json_str = user_msg[s_idx + len(marker_start) : e_idx].strip()
+    return infer_tag_from_context(json.loads(json_str))
+
+def infer_tag_from_context(ctx):
+    inferred_tag = "normal"
     
-    for item in canonical_data:
-        current_tags = item.get("tags", [])
-        
-        # If tag is generic 'from_seed', try to infer actual scenario from content
-        if "from_seed" in current_tags or not current_tags:
-            try:
-                # Extract context from user message
-                user_msg = item["messages"][0]["content"]
-                
-                # Robust extraction based on known prompt structure
-                marker_start = "Input context is structured sensor state (do not invent fields):\n"
-                marker_end = "\n\nUser prompt:"
-                
-                s_idx = user_msg.find(marker_start)
-                e_idx = user_msg.find(marker_end)
-                
-                if s_idx != -1 and e_idx != -1:
-                    json_str = user_msg[s_idx + len(marker_start) : e_idx].strip()
-                    ctx = json.loads(json_str)
-                    
-                    inferred_tag = "normal"
-                    
-                    # Heuristics (Priority order matching step1 generator)
-                    if ctx.get("sensor_health_status", {}).get("camera_ok") is False:
-                        inferred_tag = "sensor_fail"
-                    elif ctx.get("driver_drowsiness", {}).get("drowsy") and ctx.get("recent_warning_history", {}).get("last_warning_type") == "drowsiness":
-                        inferred_tag = "safe_mode_needed" # Approximation
-                    elif ctx.get("driver_drowsiness", {}).get("drowsy"):
-                        # Check for complex (drowsy + lane)
-                        if ctx.get("lane_departure", {}).get("departed"):
-                            inferred_tag = "complex"
-                        else:
-                            inferred_tag = "drowsy"
-                    elif ctx.get("lane_departure", {}).get("departed"):
-                        inferred_tag = "lane_departure"
-                    elif ctx.get("steering_grip", {}).get("hands_on") is False:
-                        inferred_tag = "hands_off"
-                    elif ctx.get("forward_collision_risk", 0) >= 0.7:
-                        inferred_tag = "collision_risk"
-                    elif ctx.get("driving_environment", {}).get("weather") in ["rain", "snow", "fog"]:
-                         inferred_tag = "bad_weather"
-                    
-                    # Update item tag
-                    item["tags"] = [inferred_tag]
-                    current_tags = [inferred_tag]
-            except Exception as e:
-                pass # Keep original tag if parsing fails
-        
-        if current_tags:
-            scenario_counter.update(current_tags)
+    # Heuristics (Priority order matching step1 generator)
+    if ctx.get("sensor_health_status", {}).get("camera_ok") is False:
+        inferred_tag = "sensor_fail"
+    elif ctx.get("driver_drowsiness", {}).get("drowsy") and ctx.get("recent_warning_history", {}).get("last_warning_type") == "drowsiness":
+        inferred_tag = "safe_mode_needed" # Approximation
+    elif ctx.get("driver_drowsiness", {}).get("drowsy"):
+        # Check for complex (drowsy + lane)
+        if ctx.get("lane_departure", {}).get("departed"):
+            inferred_tag = "complex"
         else:
-            scenario_counter["unknown"] += 1
-            
-    total_count = len(canonical_data)
-    
-    # Split Data
-    indices = list(range(total_count))
-    random.shuffle(indices)
-    
-    split_idx = int(total_count * train_ratio)
-    train_indices = indices[:split_idx]
-    eval_indices = indices[split_idx:]
-    
-    # Create Output Directory
+            inferred_tag = "drowsy"
+    elif ctx.get("lane_departure", {}).get("departed"):
+        inferred_tag = "lane_departure"
+    elif ctx.get("steering_grip", {}).get("hands_on") is False:
+        inferred_tag = "hands_off"
+    elif ctx.get("forward_collision_risk", 0) >= 0.7:
+        inferred_tag = "collision_risk"
+    elif ctx.get("driving_environment", {}).get("weather") in ["rain", "snow", "fog"]:
+         inferred_tag = "bad_weather"
+    return inferred_tag
+
+FINETUNE_ONLY_TAG = "session"
+
+def hash_fraction(sample_id, seed=42):
+    """
+    Stable pseudo-random number in [0, 1) for a sample id.
+    """
+    digest = hashlib.sha1(f"{seed}:{sample_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") / float(1 << 64)
+
+class StratifiedHashSplitter:
+    """
+    Train/eval assignment stratified by scenario tag. Within each tag the
+    samples are ranked by hash_fraction(id) (salted by seed only, so a sample
+    keeps its hash when its tag changes) and the top round(n * eval_ratio)
+    go to eval, at least one for any tag with 2+ samples. A sample's split
+    only depends on the hashes of its own tag, so appending data can only
+    move samples at that tag's eval boundary.
+    dev_ratio > 0 takes the dev split from the ranks just below eval, so the
+    eval split does not change.
+    Usage: add() every sample, fit(), then split_of().
+    """
+
+    def __init__(self, train_ratio=0.9, seed=42, dev_ratio=0.0):
+        # Rounded so train_ratio - dev_ratio from callers keeps the same eval share
+        self.eval_ratio = round(1.0 - train_ratio - dev_ratio, 9)
+        self.dev_ratio = dev_ratio
+        self.seed = seed
+        self.hashes = {} # tag -> [(hash, sample id)]
+        self.assignment = {} # (sample id, tag) -> split name
+        self.counts = {} # tag -> Counter of split names
+
+    def add(self, sample_id, tag):
+        self.hashes.setdefault(tag, []).append((hash_fraction(sample_id, self.seed), sample_id))
+
+    def fit(self):
+        for tag, ranked in self.hashes.items():
+            ranked.sort(reverse=True)
+            n = len(ranked)
+            n_eval = int(n * self.eval_ratio + 0.5)
+            if n >= 2 and self.eval_ratio > 0:
+                n_eval = max(n_eval, 1)
+            n_dev = min(int(n * self.dev_ratio + 0.5), n - n_eval)
+            for rank, (_, sample_id) in enumerate(ranked):
+                split_name = "eval" if rank < n_eval else "dev" if rank < n_eval + n_dev else "train"
+                self.assignment[(sample_id, tag)] = split_name
+            self.counts[tag] = Counter({"eval": n_eval, "dev": n_dev, "train": n - n_eval - n_dev})
+        return self
+
+    def split_of(self, sample_id, tag):
+        return self.assignment[(sample_id, tag)]
+
+    def report(self):
+        """
+        {tag: {"total", "eval", "expected_eval"}} for every tag.
+        """
+        return {
+            tag: {"total": len(self.hashes[tag]), "eval": counts["eval"],
+                  "expected_eval": round(len(self.hashes[tag]) * self.eval_ratio, 1)}
+            for tag, counts in self.counts.items()
+        }
+
+def resolve_tag(item, record):
+    """
+    Scenario tag of a canonical sample. Generic 'from_seed' (or missing) tags
+    are replaced in item by the scenario inferred from the structured context
+    or the prompt. Returns (tag, changed).
+    """
+    current_tags = item.get("tags", [])
+    if "from_seed" in current_tags or not current_tags:
+        try:
+            if record is not None:
+                inferred_tag = record.get("scenario") or infer_tag_from_context(record["context"])
+            else:
+                inferred_tag = infer_tag(item["messages"][0]["content"])
+            if inferred_tag:
+                item["tags"] = [inferred_tag]
+                return inferred_tag, True
+        except Exception as e:
+            pass # Keep original tag if parsing fails
+    return (current_tags[0] if current_tags else "unknown"), False
+
+def finetune_only_id(finetune_line):
+    """
+    Id of a finetune row without a canonical sample (multi-turn sessions):
+    hash of its text, so its split does not depend on its position.
+    """
+    return "ft_" + hashlib.sha1(finetune_line.strip().encode("utf-8")).hexdigest()[:16]
+
+def _line(text):
+    return text if text.endswith("\n") else text + "\n"
+
+def iter_rows(canonical_path, finetune_path, context_path=None, unpaired=None):
+    """
+    (canonical_line, finetune_line, context_line, item, record) for line i of
+    each file; finetune rows past the end of the canonical file (step 1
+    sessions) come last with canonical_line = item = None. Canonical lines
+    without a finetune line are skipped and counted in unpaired["canonical"].
+    """
+    xf = open(context_path, 'r') if context_path else None
+    try:
+        with open(canonical_path, 'r') as cf, open(finetune_path, 'r') as ff:
+            for canonical_line in cf:
+                finetune_line = ff.readline()
+                if not finetune_line:
+                    if unpaired is not None:
+                        unpaired["canonical"] += 1
+                    continue
+                item = json.loads(canonical_line)
+                context_line = next(xf, None) if xf else None
+                record = json.loads(context_line) if context_line else None
+                if record is not None and record["id"] != item["id"]:
+                    raise ValueError(f"Context sidecar out of sync: {record['id']} != {item['id']}")
+                yield canonical_line, finetune_line, context_line, item, record
+            for finetune_line in ff:
+                if finetune_line.strip():
+                    yield None, finetune_line, None, None, None
+    finally:
+        if xf:
+            xf.close()
+
+def analyze_and_split(canonical_path, finetune_path, output_dir, train_ratio=0.9, seed=42, context_path=None, dedup=False, near_threshold=0.9, dev_ratio=0.0):
+    """
+    Two passes over both files (line i of each belongs together): the first
+    resolves tags, runs the dedup and ranks the sample hashes per tag
+    (StratifiedHashSplitter), the second streams the rows to their splits.
+    Memory holds one (hash, id, tag) per sample.
+    Finetune rows past the end of the canonical file (step 1 sessions) are
+    split as their own tag, by the hash of their text, into *_finetune.jsonl only.
+    If the step 1 context sidecar exists (default: dataset_context.jsonl next to
+    the canonical file), tags come from its structured columns and it is split
+    alongside; prompts are never parsed.
+    leakage_report.json (utils/dedup.py) always covers the produced train/eval
+    files. dedup=True drops exact / near duplicates before the split and adds
+    the leakage a split of all samples would have had ("before_dedup").
+    dev_ratio > 0 also writes dev_*.jsonl (taken from the train share).
+    """
     os.makedirs(output_dir, exist_ok=True)
-    
-    # Save Split Files
-    splits = {
-        "train": train_indices,
-        "eval": eval_indices
+    if context_path is None:
+        candidate = os.path.join(os.path.dirname(canonical_path), "dataset_context.jsonl")
+        context_path = candidate if os.path.exists(candidate) else None
+    splitter = StratifiedHashSplitter(train_ratio=train_ratio, seed=seed, dev_ratio=dev_ratio)
+    # With dedup, the same split over every sample (kept or removed) for the "before" leakage
+    before_splitter = StratifiedHashSplitter(train_ratio=train_ratio, seed=seed, dev_ratio=dev_ratio) if dedup else None
+    split_names = ("train", "dev", "eval") if dev_ratio > 0 else ("train", "eval")
+    from utils.dedup import Deduplicator, sample_signature, leakage_report
+    deduplicator = Deduplicator(near_threshold=near_threshold) if dedup else None
+    removed = Counter()
+
+    # Pass 1: tags, dedup and per-tag hash ranking
+    print(f"Streaming {canonical_path} + {finetune_path}")
+    if context_path:
+        print(f"Using structured context: {context_path}")
+    rows = [] # (sample id, tag, kept) per row of iter_rows
+    unpaired = Counter()
+    for canonical_line, finetune_line, _, item, record in iter_rows(canonical_path, finetune_path, context_path, unpaired):
+        if item is None:
+            sample_id, tag = finetune_only_id(finetune_line), FINETUNE_ONLY_TAG
+        else:
+            sample_id, (tag, _) = item["id"], resolve_tag(item, record)
+        kept = True
+        if deduplicator is not None and item is not None:
+            before_splitter.add(sample_id, tag)
+            signature = sample_signature(item, record)
+            kind, _ = deduplicator.find(signature)
+            if kind is not None:
+                removed[kind] += 1
+                kept = False
+            else:
+                deduplicator.add(sample_id, signature)
+        if kept:
+            splitter.add(sample_id, tag)
+        rows.append((sample_id, tag, kept))
+    if unpaired["canonical"]:
+        print(f"Warning: {unpaired['canonical']} canonical lines have no finetune line and were skipped.")
+    splitter.fit()
+    if before_splitter:
+        before_splitter.fit()
+
+    # Pass 2: write the splits
+    scenario_counter = Counter()
+    split_counter = {split_name: Counter() for split_name in ("train", "dev", "eval")}
+    outputs = {
+        (split_name, kind): open(os.path.join(output_dir, f"{split_name}_{kind}.jsonl"), "w")
+        for split_name in split_names
+        for kind in ("finetune", "canonical")
     }
-    
-    for split_name, idx_list in splits.items():
-        # Save Finetune Split (For Step 2 Training)
-        ft_out = os.path.join(output_dir, f"{split_name}_finetune.jsonl")
-        with open(ft_out, 'w') as f:
-            for idx in idx_list:
-                f.write(json.dumps(finetune_data[idx]) + "\n")
-                
-        # Save Canonical Split (For Step 3 Evaluation)
-        cn_out = os.path.join(output_dir, f"{split_name}_canonical.jsonl")
-        with open(cn_out, 'w') as f:
-            for idx in idx_list:
-                f.write(json.dumps(canonical_data[idx]) + "\n")
-                
-    print(f"Split complete: Train ({len(train_indices)}), Eval ({len(eval_indices)}) saved to {output_dir}")
+    if context_path:
+        for split_name in split_names:
+            outputs[(split_name, "context")] = open(os.path.join(output_dir, f"{split_name}_context.jsonl"), "w")
+    before_dir = tempfile.TemporaryDirectory(dir=output_dir) if dedup else None
+    before = {}
+    if before_dir:
+        for split_name in ("train", "eval"):
+            for kind in ("canonical", "context") if context_path else ("canonical",):
+                before[(split_name, kind)] = open(os.path.join(before_dir.name, f"{split_name}_{kind}.jsonl"), "w")
+    try:
+        for (canonical_line, finetune_line, context_line, item, record), (sample_id, tag, kept) in zip(
+                iter_rows(canonical_path, finetune_path, context_path), rows):
+            if item is not None:
+                _, changed = resolve_tag(item, record)
+                if changed:
+                    canonical_line = json.dumps(item) + "\n"
+                if before_splitter:
+                    before_split = before_splitter.split_of(sample_id, tag)
+                    if before_split != "dev": # leakage is train vs eval
+                        before[(before_split, "canonical")].write(_line(canonical_line))
+                        if context_line:
+                            before[(before_split, "context")].write(_line(context_line))
+            if not kept:
+                continue
+
+            split_name = splitter.split_of(sample_id, tag)
+            scenario_counter[tag] += 1
+            split_counter[split_name][tag] += 1
+            # Finetune lines are passed through without re-serializing
+            outputs[(split_name, "finetune")].write(_line(finetune_line))
+            if item is not None:
+                outputs[(split_name, "canonical")].write(_line(canonical_line))
+                if context_line:
+                    outputs[(split_name, "context")].write(_line(context_line))
+    finally:
+        for f in list(outputs.values()) + list(before.values()):
+            f.close()
+
+    total_count = sum(scenario_counter.values())
+    train_count = sum(split_counter["train"].values())
+    eval_count = sum(split_counter["eval"].values())
+    dev_count = sum(split_counter["dev"].values())
+    print(f"Split complete: Train ({train_count}), {f'Dev ({dev_count}), ' if dev_ratio > 0 else ''}Eval ({eval_count}) saved to {output_dir}")
+    split_report = splitter.report()
+    with open(os.path.join(output_dir, "split_report.json"), "w") as f:
+        json.dump(split_report, f, indent=2)
+    no_eval = sorted(tag for tag, r in split_report.items() if r["eval"] == 0)
+    if no_eval:
+        print(f"Warning: no eval samples for tags {', '.join(no_eval)} (single-sample tags stay in train)")
+
+    session_line = ""
+    if scenario_counter[FINETUNE_ONLY_TAG]:
+        session_line = f"*   **Session**: canonical 없는 finetune 행 {scenario_counter[FINETUNE_ONLY_TAG]}개(multi-turn session)는 텍스트 해시로 split되어 `*_finetune.jsonl`에만 포함됩니다.\n"
+
+    # Train/eval leakage of the produced split (and of the same split without dedup)
+    def split_leakage(directory):
+        return leakage_report(
+            os.path.join(directory, "train_canonical.jsonl"),
+            os.path.join(directory, "eval_canonical.jsonl"),
+            os.path.join(directory, "train_context.jsonl") if context_path else None,
+            os.path.join(directory, "eval_context.jsonl") if context_path else None,
+            near_threshold=near_threshold,
+        )
+
+    report = split_leakage(output_dir)
+    leaked = report["leaked_exact"] + report["leaked_near"]
+    print(f"Train/eval leakage: {report['leaked_exact']} exact, {report['leaked_near']} near ({report['leakage_rate']*100:.1f}%)")
+    dedup_lines = ""
+    if dedup:
+        before_report = split_leakage(before_dir.name)
+        before_dir.cleanup()
+        report["removed_exact"] = removed["exact"]
+        report["removed_near"] = removed["near"]
+        report["before_dedup"] = before_report
+        print(f"Dedup: removed {removed['exact']} exact + {removed['near']} near duplicates "
+              f"(leakage before dedup: {before_report['leakage_rate']*100:.1f}%)")
+        dedup_lines = (
+            f"*   **Dedup**: 결정 시그니처 기준 중복 제거 (exact {removed['exact']}, near {removed['near']}, threshold {near_threshold})"
+            f" — dedup 전 leakage {before_report['leaked_exact'] + before_report['leaked_near']} ({before_report['leakage_rate']*100:.1f}%)\n"
+        )
+    with open(os.path.join(output_dir, "leakage_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    dedup_lines += f"*   **Train/Eval Leakage**: {leaked} ({report['leakage_rate']*100:.1f}%) — `leakage_report.json`\n"
 
     # Generate README.md
     readme_content = f"""# 🚗 Driver Assist Seed Dataset (v1.0)
@@ -120,20 +325,21 @@ def analyze_and_split(canonical_path, finetune_path, output_dir, train_ratio=0.9
 
 ## 📊 Data Statistics
 *   **Total Samples**: {total_count}
-*   **Train Set**: {len(train_indices)} ({(len(train_indices)/total_count)*100:.1f}%)
-*   **Eval Set**: {len(eval_indices)} ({(len(eval_indices)/total_count)*100:.1f}%)
-
+*   **Train Set**: {train_count} ({(train_count/total_count)*100:.1f}%)
+*   **Eval Set**: {eval_count} ({(eval_count/total_count)*100:.1f}%){f"{chr(10)}*   **Dev Set**: {dev_count} ({(dev_count/total_count)*100:.1f}%) — hard-example mining용, train/eval과 겹치지 않음" if dev_ratio > 0 else ""}
+*   **Split**: 시나리오 태그별 층화 — 태그 안에서 sample id 해시(seed {seed}) 순위 상위 {splitter.eval_ratio*100:.0f}%가 eval (샘플 2개 이상인 태그는 최소 1개). 데이터를 추가해도 각 태그의 eval 경계에 있는 샘플만 바뀔 수 있습니다. 태그별 수는 `split_report.json`에 기록합니다.{f"{chr(10)}*   **Eval 없는 태그**: {', '.join(no_eval)}" if no_eval else ""}
+{session_line}{dedup_lines}
 ### 🏷️ Scenario Distribution
 다양한 운전 상황 시나리오가 포함되어 있으며, 분포는 다음과 같습니다.
 
-| Scenario Tag | Count | Percentage |
-| :--- | :--- | :--- |
+| Scenario Tag | Count | Percentage | Train | Eval |
+| :--- | :--- | :--- | :--- | :--- |
 """
     
     # Sort by count desc
     for tag, count in scenario_counter.most_common():
         percentage = (count / total_count) * 100
-        readme_content += f"| `{tag}` | {count} | {percentage:.1f}% |\n"
+        readme_content += f"| `{tag}` | {count} | {percentage:.1f}% | {split_counter['train'][tag]} | {split_counter['eval'][tag]} |\n"
 
     readme_content += f"""
 ## 🎯 Purpose
@@ -145,6 +351,9 @@ def analyze_and_split(canonical_path, finetune_path, output_dir, train_ratio=0.9
 *   `train_finetune.jsonl`: 학습용 데이터 (Function Gemma Format)
 *   `eval_canonical.jsonl`: 평가용 데이터 (Ground Truth 포함, Chatbot Tester Format)
 *   `eval_finetune.jsonl`: 학습 중 Loss 계산용 (Optional)
+*   `split_report.json`: 태그별 전체 / eval / 기대 eval 수
+*   `leakage_report.json`: train과 결정 시그니처가 같거나(exact) 유사한(near) eval 샘플 (`--dedup` 시 dedup 전 수치 포함)
+*   `*_context.jsonl`: 구조화된 context / prompt hint / expected (step 1 sidecar가 있을 때, `utils/prompt_templates.py`로 프롬프트 재생성 가능)
 
 ## 🚀 Usage
 이 데이터셋은 `02_Model_Dev/pipeline` 의 `step2_finetune.py` 와 `step3_evaluate.py` 에서 즉시 사용할 수 있습니다.
@@ -157,11 +366,20 @@ def analyze_and_split(canonical_path, finetune_path, output_dir, train_ratio=0.9
     print(f"README.md generated at {readme_path}")
 
 if __name__ == "__main__":
+    # Run as a script from pipeline/: make utils importable (utils.dedup)
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--canonical", required=True, help="Path to canonical jsonl")
     parser.add_argument("--finetune", required=True, help="Path to finetune jsonl")
     parser.add_argument("--output-dir", required=True, help="Directory to save splits and readme")
-    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--seed", type=int, default=42, help="Hash salt for the split")
+    parser.add_argument("--train-ratio", type=float, default=0.9)
+    parser.add_argument("--dev-ratio", type=float, default=0.0, help="Extra dev split (dev_*.jsonl) between train and eval")
+    parser.add_argument("--context", default=None, help="Path to dataset_context.jsonl (default: next to --canonical if present)")
+    parser.add_argument("--dedup", action="store_true", help="Drop exact/near duplicates before the split (leakage_report.json is always written)")
+    parser.add_argument("--near-threshold", type=float, default=0.9)
     args = parser.parse_args()
     
-    analyze_and_split(args.canonical, args.finetune, args.output_dir, seed=args.seed)
+    analyze_and_split(args.canonical, args.finetune, args.output_dir, train_ratio=args.train_ratio, seed=args.seed, context_path=args.context, dedup=args.dedup, near_threshold=args.near_threshold, dev_ratio=args.dev_ratio)
@@ -0,0 +1,196 @@
+import copy
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import mlflow
+import torch
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from utils.mlflow_logger import run_logger
+
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+TRAINER_STATE_NAME = "trainer_state.json"
+OPTIMIZER_NAME = "optimizer.pt" # names Trainer._load_optimizer_and_scheduler looks for
+SCHEDULER_NAME = "scheduler.pt"
+MANIFEST_NAME = "checkpoints.json"
+
+
+def _to_cpu(value):
+    """
+    Copy of a (nested) state dict with every tensor cloned to CPU.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {k: _to_cpu(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(v) for v in value)
+    return copy.deepcopy(value)
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """
+    Replaces the Trainer's save_steps checkpoints for LoRA runs.
+    - Saves on a wall-clock budget (every_seconds) and/or every fraction of an
+      epoch (every_epoch_fraction), whichever comes first.
+    - The adapter weights and the optimizer / LR scheduler state are copied to
+      CPU on the training thread; the file writes happen on a background thread.
+    - Keeps the last `keep_last` checkpoints plus the one with the lowest
+      training loss at save time.
+    Checkpoints are `checkpoint-<step>` dirs with adapter_config.json,
+    adapter_model.safetensors, optimizer.pt, scheduler.pt and trainer_state.json,
+    so trainer.train(resume_from_checkpoint=...) restores the adapter, the
+    AdamW moments, the LR schedule position and the step counter.
+    """
+
+    def __init__(self, output_dir, every_seconds=None, every_epoch_fraction=0.25, keep_last=2, keep_best=True):
+        if not every_seconds and not every_epoch_fraction:
+            raise ValueError("Set every_seconds and/or every_epoch_fraction")
+        self.output_dir = output_dir
+        self.every_seconds = every_seconds
+        self.every_epoch_fraction = every_epoch_fraction
+        self.keep_last = max(1, keep_last)
+        self.keep_best = keep_best
+
+        self.interval_steps = None
+        self.last_save_time = None
+        self.checkpoints = [] # [{"step", "path", "loss"}] in save order
+        self.best = None
+        self.snapshot_ms = 0.0 # blocking time on the training thread
+        self.write_ms = 0.0 # background I/O time
+        self.errors = []
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    # --- Triggers ---
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.last_save_time = time.perf_counter()
+        if self.every_epoch_fraction and state.max_steps and args.num_train_epochs:
+            steps_per_epoch = state.max_steps / args.num_train_epochs
+            self.interval_steps = max(1, int(round(steps_per_epoch * self.every_epoch_fraction)))
+        self._load_manifest()
+
+    def _due(self, state):
+        if self.interval_steps and state.global_step % self.interval_steps == 0:
+            return True
+        if self.every_seconds and time.perf_counter() - self.last_save_time >= self.every_seconds:
+            return True
+        return False
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step > 0 and self._due(state):
+            self.save(kwargs["model"], state, kwargs.get("optimizer"), kwargs.get("lr_scheduler"))
+
+    # --- Saving ---
+
+    def save(self, model, state, optimizer=None, lr_scheduler=None):
+        from peft import get_peft_model_state_dict
+
+        start = time.perf_counter()
+        weights = {k: v.detach().to("cpu", copy=True).contiguous() for k, v in get_peft_model_state_dict(model).items()}
+        adapter_config = copy.deepcopy(model.peft_config[model.active_adapter])
+        state_copy = copy.deepcopy(state)
+        # The optimizer keeps updating its tensors in place, so they are copied now
+        optimizer_state = _to_cpu(optimizer.state_dict()) if optimizer is not None else None
+        scheduler_state = copy.deepcopy(lr_scheduler.state_dict()) if lr_scheduler is not None else None
+        self.snapshot_ms += (time.perf_counter() - start) * 1000.0
+        self.last_save_time = time.perf_counter()
+
+        losses = [h["loss"] for h in state.log_history if "loss" in h]
+        self._queue.put((state.global_step, weights, adapter_config, state_copy, optimizer_state, scheduler_state,
+                         losses[-1] if losses else None))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.errors.append(f"{type(e).__name__}: {e}")
+                print(f"⚠️ Checkpoint write failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, step, weights, adapter_config, state, optimizer_state, scheduler_state, loss):
+        from safetensors.torch import save_file
+
+        start = time.perf_counter()
+        final_dir = os.path.join(self.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{step}")
+        tmp_dir = final_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        save_file(weights, os.path.join(tmp_dir, ADAPTER_WEIGHTS_NAME), metadata={"format": "pt"})
+        adapter_config.save_pretrained(tmp_dir)
+        if optimizer_state is not None:
+            torch.save(optimizer_state, os.path.join(tmp_dir, OPTIMIZER_NAME))
+        if scheduler_state is not None:
+            torch.save(scheduler_state, os.path.join(tmp_dir, SCHEDULER_NAME))
+        state.save_to_json(os.path.join(tmp_dir, TRAINER_STATE_NAME))
+        # Rename last so a crash never leaves a half-written checkpoint-<step>
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+
+        with self._lock:
+            entry = {"step": step, "path": final_dir, "loss": loss}
+            self.checkpoints.append(entry)
+            if loss is not None and (self.best is None or loss < self.best["loss"]):
+                self.best = entry
+            self._prune()
+            self._save_manifest()
+            self.write_ms += (time.perf_counter() - start) * 1000.0
+
+    def _prune(self):
+        keep = {c["path"] for c in self.checkpoints[-self.keep_last:]}
+        if self.keep_best and self.best is not None:
+            keep.add(self.best["path"])
+        for c in [c for c in self.checkpoints if c["path"] not in keep]:
+            shutil.rmtree(c["path"], ignore_errors=True)
+            self.checkpoints.remove(c)
+
+    def _save_manifest(self):
+        with open(os.path.join(self.output_dir, MANIFEST_NAME), "w") as f:
+            json.dump({"checkpoints": self.checkpoints, "best": self.best}, f, indent=2)
+
+    def _load_manifest(self):
+        # Resumed run: keep pruning the checkpoints of the interrupted one
+        path = os.path.join(self.output_dir, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self.checkpoints = [c for c in manifest.get("checkpoints", []) if os.path.isdir(c["path"])]
+            best = manifest.get("best")
+            self.best = best if best and os.path.isdir(best["path"]) else None
+
+    # --- Reporting ---
+
+    def wait(self):
+        self._queue.join()
+
+    def stats(self):
+        return {
+            "checkpoint_count": len(self.checkpoints),
+            "checkpoint_snapshot_ms_total": self.snapshot_ms,
+            "checkpoint_write_ms_total": self.write_ms,
+            "checkpoint_errors": len(self.errors),
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.wait()
+        stats = self.stats()
+        print(f"Checkpoint I/O: {stats['checkpoint_count']} kept, "
+              f"{stats['checkpoint_snapshot_ms_total']:.0f} ms blocking, "
+              f"{stats['checkpoint_write_ms_total']:.0f} ms background writes")
+        if mlflow.active_run():
+            run_logger.log_metrics(stats)
+            if self.best is not None:
+                run_logger.set_tag("best_checkpoint", self.best["path"])
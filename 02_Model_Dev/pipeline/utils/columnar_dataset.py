@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # pyarrow ships with `datasets`; only needed for .parquet files
+    pa = None
+    pq = None
+
+# One Parquet file replaces dataset_canonical.jsonl + dataset_finetune.jsonl
+# (+ dataset_context.jsonl). Rows with structured context store the context
+# and the template id instead of the rendered prompt. The finetune text of a
+# paired row is only stored when rebuilding it from prompt + expected would
+# not reproduce the original line (e.g. legacy seed data); otherwise it is
+# rebuilt on load. Finetune-only rows (e.g. multi-turn sessions) keep their
+# raw `text`.
+DICTIONARY_COLUMNS = ["template_id", "prompt_hint", "scenario", "tags"]
+BATCH_ROWS = 10000
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet datasets require `pip install pyarrow` (installed with `datasets`)")
+
+
+def _schema():
+    return pa.schema([
+        ("id", pa.string()),
+        ("template_id", pa.string()),
+        ("prompt_hint", pa.string()),
+        ("context", pa.string()), # JSON
+        ("prompt", pa.string()), # only when there is no structured context
+        ("expected", pa.string()), # JSON
+        ("scenario", pa.string()),
+        ("tags", pa.list_(pa.string())),
+        ("text", pa.string()), # finetune-only rows and rows whose text cannot be rebuilt
+    ])
+
+
+def _row_from_jsonl(canonical, context_record):
+    row = {
+        "id": canonical["id"],
+        "template_id": None,
+        "prompt_hint": None,
+        "context": None,
+        "prompt": None,
+        "expected": json.dumps(canonical["expected"]),
+        "scenario": canonical.get("metadata", {}).get("scenario"),
+        "tags": canonical.get("tags", []),
+        "text": None,
+    }
+    if context_record is not None:
+        row["template_id"] = context_record["template_id"]
+        row["prompt_hint"] = context_record["prompt_hint"]
+        row["context"] = json.dumps(context_record["context"])
+    else:
+        row["prompt"] = next((m["content"] for m in canonical["messages"] if m["role"] == "user"), "")
+    return row
+
+
+def _rebuilt_text(row):
+    from step1_generate_data import format_for_finetuning
+    return format_for_finetuning(_render_user_prompt(row), json.loads(row["expected"]))["text"]
+
+
+def stored_text(row, finetune_line):
+    """
+    The original finetune text if rebuilding it from the row differs, else None.
+    """
+    if not finetune_line.strip():
+        return None
+    text = json.loads(finetune_line)["text"]
+    return None if _rebuilt_text(row) == text else text
+
+
+def jsonl_to_parquet(canonical_path, finetune_path, output_path, context_path=None):
+    """
+    Stream the JSONL files into one zstd-compressed Parquet file with
+    dictionary-encoded template/hint/tag columns.
+    context_path defaults to dataset_context.jsonl next to the canonical file.
+    """
+    _require_pyarrow()
+    if context_path is None:
+        candidate = os.path.join(os.path.dirname(canonical_path), "dataset_context.jsonl")
+        context_path = candidate if os.path.exists(candidate) else None
+
+    schema = _schema()
+    writer = pq.ParquetWriter(output_path, schema, compression="zstd", use_dictionary=DICTIONARY_COLUMNS)
+    rows = []
+    count = 0
+    kept_text = 0
+
+    def flush():
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            rows.clear()
+
+    xf = open(context_path, "r") if context_path else None
+    try:
+        with open(canonical_path, "r") as cf, open(finetune_path, "r") as ff:
+            for canonical_line in cf:
+                canonical = json.loads(canonical_line)
+                context_line = next(xf, None) if xf else None
+                row = _row_from_jsonl(canonical, json.loads(context_line) if context_line else None)
+                row["text"] = stored_text(row, ff.readline())
+                kept_text += row["text"] is not None
+                rows.append(row)
+                count += 1
+                if len(rows) >= BATCH_ROWS:
+                    flush()
+
+            # Finetune-only rows (sessions appended by step 1)
+            for i, finetune_line in enumerate(ff):
+                rows.append({"id": f"finetune_only_{i:05d}", "tags": [], "text": json.loads(finetune_line)["text"]})
+                count += 1
+                if len(rows) >= BATCH_ROWS:
+                    flush()
+        flush()
+    finally:
+        writer.close()
+        if xf:
+            xf.close()
+
+    print(f"Wrote {count} rows to {output_path} ({os.path.getsize(output_path) / (1024 * 1024):.2f} MB)")
+    if kept_text:
+        print(f"Stored the original finetune text for {kept_text} rows that cannot be rebuilt from prompt + expected")
+    return output_path
+
+
+def _render_user_prompt(row):
+    if row["prompt"] is not None:
+        return row["prompt"]
+    from utils.prompt_templates import render_prompt
+    return render_prompt(json.loads(row["context"]), row["prompt_hint"], row["template_id"])
+
+
+def iter_canonical(path):
+    """
+    Canonical samples (step 3 format) from a Parquet dataset, one record batch
+    at a time. Finetune-only rows are skipped.
+    """
+    _require_pyarrow()
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=BATCH_ROWS):
+        for row in batch.to_pylist():
+            if row["expected"] is None:
+                continue
+            yield {
+                "id": row["id"],
+                "messages": [{"role": "user", "content": _render_user_prompt(row)}],
+                "expected": json.loads(row["expected"]),
+                "tags": row["tags"] or [],
+                "metadata": {"scenario": row["scenario"]},
+            }
+
+
+def load_finetune_dataset(path):
+    """
+    HF Dataset with a `text` column for step 2. The Parquet file is loaded
+    through Arrow (memory-mapped cache); rows without stored text get it rebuilt.
+    """
+    from datasets import load_dataset
+
+    def add_text(row):
+        if row["text"] is not None:
+            return {"text": row["text"]}
+        return {"text": _rebuilt_text(row)}
+
+    dataset = load_dataset("parquet", data_files=path, split="train")
+    return dataset.map(add_text, remove_columns=[c for c in dataset.column_names if c != "text"])
+
+
+def is_parquet(path):
+    return str(path).endswith(".parquet")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert canonical + finetune JSONL into one Parquet dataset")
+    parser.add_argument("--canonical", required=True)
+    parser.add_argument("--finetune", required=True)
+    parser.add_argument("--context", default=None, help="dataset_context.jsonl (default: next to --canonical if present)")
+    parser.add_argument("--output", required=True, help="e.g. dataset.parquet")
+    args = parser.parse_args()
+
+    jsonl_to_parquet(args.canonical, args.finetune, args.output, context_path=args.context)
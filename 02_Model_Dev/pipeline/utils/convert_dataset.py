@@ -2,70 +2,157 @@ import json
 import os
 import argparse
 import re
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# User Prompt와 Model Action을 한 번의 스캔으로 분리합니다.
+# (user 태그 다음부터 ~ model 태그 앞까지, model 태그 다음부터 ~ end_of_turn 까지)
+TURN_PATTERN = re.compile(
+    r"<start_of_turn>user\n(.*?)\n<start_of_turn>model(?:\n(.*?)(?:<end_of_turn>|$))?",
+    re.DOTALL,
+)
+CHUNK_LINES = 2000
 
 def parse_function_gemma_text(text):
     """
     Function Gemma 포맷(<start_of_turn>...)에서 User Prompt와 Model Action을 분리합니다.
     """
-    # 1. User Prompt 추출 (user 태그 다음부터 ~ model 태그 앞까지)
     # 보통 Function Gemma 프롬프트에는 System Prompt와 Context가 포함되어 있으므로 통째로 Input으로 씁니다.
-    pattern = r"<start_of_turn>user\n(.*?)\n<start_of_turn>model"
-    match = re.search(pattern, text, re.DOTALL)
-    
+    match = TURN_PATTERN.search(text)
+
     if not match:
         return None, None
-        
+
     user_input = match.group(1).strip()
-    
-    # 2. Model Action 추출 (model 태그 다음부터 ~ end_of_turn 까지)
-    action_pattern = r"<start_of_turn>model\n(.*?)(?:<end_of_turn>|$)"
-    action_match = re.search(action_pattern, text, re.DOTALL)
-    
-    if not action_match:
+
+    if match.group(2) is None:
         return user_input, []
-        
-    action_json_str = action_match.group(1).strip()
+
+    action_json_str = match.group(2).strip()
     try:
         expected_actions = json.loads(action_json_str)
     except:
         expected_actions = action_json_str # JSON 파싱 실패 시 원문 유지
-        
+
     return user_input, expected_actions
 
-def convert_dataset(input_path, output_path):
-    print(f"Converting {input_path} -> {output_path} ...")
-    
+def content_id(user_input, expected):
+    """
+    내용 기반 id: 같은 (prompt, expected)는 항상 같은 id → 재변환해도 동일, 중복 제거에 사용.
+    """
+    key = json.dumps([user_input, expected], sort_keys=True, ensure_ascii=False)
+    return "seed_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def convert_chunk(chunk):
+    """
+    chunk: [(line_idx, line)] → [(line_idx, sample or None, error or None)]
+    Process pool worker (module-level so it can be pickled).
+    """
+    out = []
+    for idx, line in chunk:
+        try:
+            data = json.loads(line)
+            user_input, expected = parse_function_gemma_text(data.get("text", ""))
+            if not user_input:
+                out.append((idx, None, None))
+                continue
+            # Canonical Format (Chatbot Tester)
+            sample = {
+                "id": content_id(user_input, expected),
+                "messages": [
+                    {"role": "user", "content": user_input}
+                ],
+                "expected": expected,
+                "tags": ["from_seed"],
+                "metadata": {"source": "seed_dataset"}
+            }
+            out.append((idx, sample, None))
+        except Exception as e:
+            out.append((idx, None, str(e)))
+    return out
+
+def iter_chunks(f, chunk_lines=CHUNK_LINES):
+    chunk = []
+    for idx, line in enumerate(f):
+        chunk.append((idx, line))
+        if len(chunk) >= chunk_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def default_finetune_output(output_path):
+    """
+    dataset_canonical.jsonl -> dataset_finetune.jsonl, x.jsonl -> x_finetune.jsonl
+    """
+    directory, name = os.path.split(output_path)
+    if "canonical" in name:
+        return os.path.join(directory, name.replace("canonical", "finetune"))
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, f"{stem}_finetune{ext or '.jsonl'}")
+
+def convert_dataset(input_path, output_path, workers=None, chunk_lines=CHUNK_LINES, finetune_output_path=None):
+    """
+    Streams the input in chunks; with workers > 1 chunks are parsed in a process
+    pool (at most 2 * workers chunks in flight) and written back in input order.
+    Duplicate samples (same content id) are written once.
+    The original finetune line of every written sample goes to
+    finetune_output_path, so line i of both outputs stays paired
+    (analyze_and_split / dedup / Parquet conversion rely on that).
+    """
+    workers = workers or os.cpu_count() or 1
+    finetune_output_path = finetune_output_path or default_finetune_output(output_path)
+    if os.path.abspath(finetune_output_path) == os.path.abspath(input_path):
+        raise ValueError(f"Finetune output would overwrite the input: {input_path}")
+    print(f"Converting {input_path} -> {output_path} + {finetune_output_path} ({workers} workers) ...")
+
     converted_count = 0
-    with open(input_path, 'r') as fin, open(output_path, 'w') as fout:
-        for idx, line in enumerate(fin):
-            try:
-                data = json.loads(line)
-                full_text = data.get("text", "")
-                
-                user_input, expected = parse_function_gemma_text(full_text)
-                
-                if user_input:
-                    # Canonical Format (Chatbot Tester)
-                    sample = {
-                        "id": f"seed_{idx:05d}",
-                        "messages": [
-                            {"role": "user", "content": user_input}
-                        ],
-                        "expected": expected,
-                        "tags": ["from_seed"],
-                        "metadata": {"source": "seed_dataset"}
-                    }
-                    fout.write(json.dumps(sample) + "\n")
-                    converted_count += 1
-            except Exception as e:
-                print(f"Skipping line {idx}: {e}")
-                
-    print(f"✅ Success! Converted {converted_count} samples.")
+    duplicate_count = 0
+    seen_ids = set()
+
+    def write_results(chunk, results, fout, ffout):
+        nonlocal converted_count, duplicate_count
+        for (_, line), (idx, sample, error) in zip(chunk, results):
+            if error is not None:
+                print(f"Skipping line {idx}: {error}")
+            elif sample is not None:
+                if sample["id"] in seen_ids:
+                    duplicate_count += 1
+                    continue
+                seen_ids.add(sample["id"])
+                fout.write(json.dumps(sample) + "\n")
+                ffout.write(line if line.endswith("\n") else line + "\n")
+                converted_count += 1
+
+    with open(input_path, 'r') as fin, open(output_path, 'w') as fout, open(finetune_output_path, 'w') as ffout:
+        if workers == 1:
+            for chunk in iter_chunks(fin, chunk_lines):
+                write_results(chunk, convert_chunk(chunk), fout, ffout)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for chunk in iter_chunks(fin, chunk_lines):
+                    # Lines stay here; only the parsed samples come back from the workers
+                    pending.append((chunk, pool.submit(convert_chunk, chunk)))
+                    if len(pending) >= 2 * workers:
+                        chunk_done, future = pending.popleft()
+                        write_results(chunk_done, future.result(), fout, ffout)
+                while pending:
+                    chunk_done, future = pending.popleft()
+                    write_results(chunk_done, future.result(), fout, ffout)
+
+    print(f"✅ Success! Converted {converted_count} samples ({duplicate_count} duplicates removed).")
+    return converted_count, duplicate_count
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input", help="Path to existing finetune.jsonl")
     parser.add_argument("output", help="Path to save canonical.jsonl")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count, 1 = no pool)")
+    parser.add_argument("--chunk-lines", type=int, default=CHUNK_LINES)
+    parser.add_argument("--finetune-output", default=None,
+                        help="Finetune lines aligned with the output (default: output name with canonical -> finetune, else <output>_finetune.jsonl)")
     args = parser.parse_args()
-    
-    convert_dataset(args.input, args.output)
\ No newline at end of file
+
+    convert_dataset(args.input, args.output, workers=args.workers, chunk_lines=args.chunk_lines, finetune_output_path=args.finetune_output)
@@ -0,0 +1,239 @@
+import itertools
+import json
+import random
+from collections import Counter, defaultdict
+
+from utils.response_cache import (
+    LANE_CONFIDENCE_THRESHOLDS,
+    DROWSY_CONFIDENCE_THRESHOLDS,
+    SPEED_THRESHOLDS,
+    COLLISION_RISK_THRESHOLDS,
+    WARNING_SECONDS_THRESHOLDS,
+)
+from utils.analyze_and_split import infer_tag_from_context
+
+# Coverage-guided generation for determine_actions (step1_generate_data.py).
+# A decision path is the tool-call list a context produces. Contexts are
+# enumerated over the factor levels below (each continuous field on both
+# sides of every threshold), grouped by decision path, and N variants per
+# path are emitted, preferring contexts that sit exactly on a threshold edge
+# where the edge changes the decision.
+
+# (edge name, field path, threshold, value just below the threshold)
+THRESHOLD_EDGES = (
+    [(f"speed_{t}", ("vehicle_speed_kph",), t, t - 1) for t in SPEED_THRESHOLDS]
+    + [(f"drowsy_confidence_{t}", ("driver_drowsiness", "confidence"), t, round(t - 0.01, 2)) for t in DROWSY_CONFIDENCE_THRESHOLDS]
+    + [(f"lane_confidence_{t}", ("lane_departure", "confidence"), t, round(t - 0.01, 2)) for t in LANE_CONFIDENCE_THRESHOLDS]
+    + [(f"collision_risk_{t}", ("forward_collision_risk",), t, round(t - 0.01, 2)) for t in COLLISION_RISK_THRESHOLDS]
+    + [(f"seconds_ago_{t}", ("recent_warning_history", "seconds_ago"), float(t), float(t - 1)) for t in WARNING_SECONDS_THRESHOLDS]
+)
+
+PROMPT_HINTS = [
+    "Monitor status.",
+    "User looks tired.", "Drowsiness detected.", "Check driver status.",
+    "Lane departure warning.", "Car is drifting.", "Stay in lane.",
+    "Hands off steering wheel.", "Driver hands not detected.", "Grab the wheel.",
+    "Collision warning!", "Brake now!", "Obstacle ahead.",
+    "Weather condition changed.",
+]
+
+# factor -> [(level, edge value(s), interior sampler)]
+# The first use of a combination takes the edge values, later variants
+# sample inside the same bin.
+FACTOR_LEVELS = {
+    "camera": [("ok", [True], lambda: True), ("fail", [False], lambda: False)],
+    "drowsy": [
+        ("none", [None], lambda: None),
+        ("low", [0.79], lambda: round(random.uniform(0.5, 0.79), 2)),
+        ("high", [0.8], lambda: round(random.uniform(0.8, 0.99), 2)),
+    ],
+    "warning": [
+        ("none", [None], lambda: None),
+        ("recent", [59.0], lambda: float(random.randint(0, 59))),
+        ("old", [60.0], lambda: float(random.randint(60, 300))),
+    ],
+    "lane": [
+        ("none", [None], lambda: None),
+        ("low", [0.69], lambda: round(random.uniform(0.4, 0.69), 2)),
+        ("high", [0.7], lambda: round(random.uniform(0.7, 0.99), 2)),
+    ],
+    "lka": [("on", [True], lambda: True), ("off", [False], lambda: False)],
+    "hands": [("on", [True], lambda: True), ("off", [False], lambda: False)],
+    "speed": [
+        ("lt90", [89], lambda: random.randint(40, 89)),
+        ("90to99", [90, 99], lambda: random.randint(90, 99)),
+        ("ge100", [100], lambda: random.randint(100, 140)),
+    ],
+    "risk": [
+        ("low", [0.74], lambda: round(random.uniform(0.0, 0.74), 2)),
+        ("high", [0.75], lambda: round(random.uniform(0.75, 0.99), 2)),
+    ],
+    # The weather name is part of the navigation message, so each bad weather is its own level
+    "environment": [
+        ("clear", [None], lambda: None),
+        ("rain", [None], lambda: None),
+        ("snow", [None], lambda: None),
+        ("fog", [None], lambda: None),
+        ("icy_road", [None], lambda: None),
+    ],
+}
+
+
+def _get(context, path):
+    for key in path:
+        context = context[key]
+    return context
+
+
+def _set(context, path, value):
+    for key in path[:-1]:
+        context = context[key]
+    context[path[-1]] = value
+
+
+def build_context(levels, values):
+    """
+    Context for one factor combination. levels: {factor: level name},
+    values: {factor: value from that level}. Fields outside the factors are random.
+    """
+    context = {
+        "lane_departure": {"departed": False, "confidence": round(random.uniform(0.0, 0.3), 2)},
+        "driver_drowsiness": {"drowsy": False, "confidence": round(random.uniform(0.0, 0.3), 2)},
+        "steering_grip": {"hands_on": values["hands"]},
+        "vehicle_speed_kph": values["speed"],
+        "forward_collision_risk": values["risk"],
+        "driving_duration_minutes": random.randint(10, 120),
+        "lka_status": {"enabled": values["lka"]},
+        "driving_environment": {"weather": "clear", "road_condition": "dry", "visibility": "good"},
+        "recent_warning_history": {"last_warning_type": "none", "seconds_ago": float(random.randint(300, 86400))},
+        "sensor_health_status": {"camera_ok": values["camera"], "ai_model_confidence": round(random.uniform(0.8, 1.0), 2)},
+    }
+    if not values["camera"]:
+        context["sensor_health_status"]["ai_model_confidence"] = 0.0
+    if values["drowsy"] is not None:
+        context["driver_drowsiness"] = {"drowsy": True, "confidence": values["drowsy"]}
+    if values["warning"] is not None:
+        context["recent_warning_history"] = {"last_warning_type": "drowsiness", "seconds_ago": values["warning"]}
+    if values["lane"] is not None:
+        context["lane_departure"] = {"departed": True, "confidence": values["lane"]}
+    if levels["environment"] in ("rain", "snow", "fog"):
+        context["driving_environment"] = {
+            "weather": levels["environment"],
+            "road_condition": random.choice(["wet", "icy", "snowy"]),
+            "visibility": "poor",
+        }
+    elif levels["environment"] == "icy_road":
+        context["driving_environment"] = {"weather": "clear", "road_condition": random.choice(["icy", "snowy"]), "visibility": "good"}
+    return context
+
+
+def decision_key(actions):
+    return json.dumps(actions, sort_keys=True)
+
+
+def active_edges(context, decide):
+    """
+    (edge name, "below" | "above") for every threshold the context sits on
+    (value at the threshold or just below it) where crossing it changes the
+    decision.
+    """
+    base = decision_key(decide(context, ""))
+    edges = []
+    for name, path, threshold, below in THRESHOLD_EDGES:
+        value = _get(context, path)
+        if value not in (threshold, below):
+            continue
+        flipped = json.loads(json.dumps(context))
+        _set(flipped, path, below if value == threshold else threshold)
+        if decision_key(decide(flipped, "")) != base:
+            edges.append((name, "above" if value == threshold else "below"))
+    return edges
+
+
+def enumerate_combinations():
+    factors = list(FACTOR_LEVELS)
+    for choice in itertools.product(*(FACTOR_LEVELS[f] for f in factors)):
+        for edge_values in itertools.product(*(level[1] for level in choice)):
+            yield (
+                {f: level[0] for f, level in zip(factors, choice)},
+                dict(zip(factors, edge_values)),
+                {f: level[2] for f, level in zip(factors, choice)},
+            )
+
+
+def generate_coverage_contexts(variants_per_path=3):
+    """
+    [(context, prompt_hint, scenario_type)] covering every decision path
+    reachable from FACTOR_LEVELS with `variants_per_path` samples each.
+    Uses the global `random` state (seeded by the caller).
+    """
+    from step1_generate_data import determine_actions
+
+    # Group edge-valued combinations by decision path
+    paths = defaultdict(list)
+    for levels, values, samplers in enumerate_combinations():
+        context = build_context(levels, values)
+        actions = determine_actions(context, "")
+        paths[decision_key(actions)].append({
+            "levels": levels,
+            "samplers": samplers,
+            "context": context,
+            "edges": set(active_edges(context, determine_actions)),
+            "uses": 0,
+        })
+
+    covered_edges = set()
+    samples = []
+    for key in sorted(paths):
+        candidates = paths[key]
+        for _ in range(variants_per_path):
+            # Prefer uncovered decision-changing edges, then the least-used combination
+            combo = max(candidates, key=lambda c: (len(c["edges"] - covered_edges) if c["uses"] == 0 else -1, -c["uses"]))
+            if combo["uses"] == 0:
+                context = combo["context"]
+                covered_edges |= combo["edges"]
+            else:
+                values = {f: sampler() for f, sampler in combo["samplers"].items()}
+                context = build_context(combo["levels"], values)
+                if decision_key(determine_actions(context, "")) != key:
+                    context = combo["context"] # interior sample crossed a threshold; reuse the edge one
+            combo["uses"] += 1
+            prompt_hint = PROMPT_HINTS[0] if combo["uses"] == 1 else random.choice(PROMPT_HINTS)
+            samples.append((json.loads(json.dumps(context)), prompt_hint, infer_tag_from_context(context)))
+    return samples
+
+
+def coverage_stats(contexts):
+    """
+    Decision-path and threshold-edge coverage of a list of contexts, against
+    the paths reachable from FACTOR_LEVELS.
+    """
+    from step1_generate_data import determine_actions
+
+    # Enumerating draws random filler fields; keep the caller's random stream intact
+    state = random.getstate()
+    all_paths = set()
+    all_edges = set()
+    for levels, values, _ in enumerate_combinations():
+        context = build_context(levels, values)
+        all_paths.add(decision_key(determine_actions(context, "")))
+        all_edges.update(active_edges(context, determine_actions))
+    random.setstate(state)
+
+    path_counts = Counter()
+    edge_counts = Counter()
+    for context in contexts:
+        path_counts[decision_key(determine_actions(context, ""))] += 1
+        edge_counts.update(active_edges(context, determine_actions))
+
+    covered = [p for p in all_paths if path_counts[p]]
+    return {
+        "decision_paths_total": len(all_paths),
+        "decision_paths_covered": len(covered),
+        "decision_path_coverage": len(covered) / len(all_paths) if all_paths else 0.0,
+        "samples_per_path_min": min((path_counts[p] for p in all_paths), default=0),
+        "samples_per_path_max": max(path_counts.values(), default=0),
+        "threshold_edges_total": len(all_edges),
+        "threshold_edges_covered": sum(1 for e in all_edges if edge_counts[e]),
+        "threshold_edge_counts": {f"{name}:{side}": edge_counts[(name, side)] for name, side in sorted(all_edges)},
+    }
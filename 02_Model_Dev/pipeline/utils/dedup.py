@@ -0,0 +1,296 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+from collections import Counter, defaultdict
+
+from utils.response_cache import canonicalize_context
+
+# Samples are compared on their decision-relevant signature: the context with
+# continuous fields bucketed on the determine_actions thresholds
+# (response_cache.canonicalize_context), the prompt hint and the expected
+# tool calls. Exact duplicates share the signature hash; near duplicates have
+# the same expected tool calls and a MinHash-estimated Jaccard similarity of
+# their signature features >= threshold. Samples with different labels are
+# never merged (those are the informative boundary cases).
+
+CONTEXT_MARKER = "Input context is structured sensor state (do not invent fields):\n"
+HINT_MARKER = "\n\nUser prompt:\n"
+HINT_END_MARKER = "\n\nReturn ONLY"
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def parse_prompt(user_msg):
+    """
+    (context, prompt_hint) from a full_v1 prompt, or (None, None).
+    """
+    s_idx = user_msg.find(CONTEXT_MARKER)
+    h_idx = user_msg.find(HINT_MARKER)
+    if s_idx == -1 or h_idx == -1:
+        return None, None
+    e_idx = user_msg.find(HINT_END_MARKER, h_idx)
+    try:
+        context = json.loads(user_msg[s_idx + len(CONTEXT_MARKER):h_idx])
+    except ValueError:
+        return None, None
+    hint = user_msg[h_idx + len(HINT_MARKER):e_idx if e_idx != -1 else None].strip()
+    return context, hint
+
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, sub in value.items():
+            yield from _flatten(sub, f"{prefix}{key}.")
+    else:
+        yield f"{prefix[:-1]}={json.dumps(value)}"
+
+
+def sample_signature(sample, record=None):
+    """
+    {"key": exact hash, "group": hash of the expected tool calls, "features": [...]}
+    record: the dataset_context.jsonl line of the sample, if available.
+    Prompts that do not follow the template fall back to word 3-grams.
+    """
+    if record is not None:
+        context, hint = record["context"], record["prompt_hint"]
+    else:
+        user_msg = next((m["content"] for m in sample["messages"] if m["role"] == "user"), "")
+        context, hint = parse_prompt(user_msg)
+
+    if context is not None:
+        canonical = canonicalize_context(context)
+        features = list(_flatten(canonical)) + [f"prompt={hint}"]
+        payload = {"context": canonical, "prompt": hint}
+    else:
+        words = re.sub(r"\s+", " ", user_msg).strip().split(" ")
+        features = [" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))]
+        payload = {"prompt": " ".join(words)}
+
+    group = hashlib.sha1(json.dumps(sample["expected"], sort_keys=True).encode()).hexdigest()
+    payload["expected"] = group
+    key = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    return {"key": key, "group": group, "features": features}
+
+
+class MinHashLSH:
+    """
+    MinHash signatures with banded LSH buckets. Candidates are only looked up
+    within the same group (expected tool calls).
+    """
+
+    def __init__(self, num_perm=32, bands=8, threshold=0.9, seed=42):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        rng = random.Random(seed)
+        self.perms = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.buckets = defaultdict(list) # (group, band, band values) -> [sample ids]
+        self.minhashes = {}
+
+    def minhash(self, features):
+        hashes = [int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), "big") for f in set(features)]
+        return tuple(min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self.perms)
+
+    def _band_keys(self, mh, group):
+        for band in range(self.bands):
+            yield (group, band, mh[band * self.rows:(band + 1) * self.rows])
+
+    def query(self, mh, group):
+        """
+        (sample id, estimated Jaccard) of the most similar indexed sample at or
+        above the threshold, or (None, 0.0).
+        """
+        best_id, best_sim = None, 0.0
+        seen = set()
+        for band_key in self._band_keys(mh, group):
+            for sample_id in self.buckets.get(band_key, ()):
+                if sample_id in seen:
+                    continue
+                seen.add(sample_id)
+                other = self.minhashes[sample_id]
+                sim = sum(1 for x, y in zip(mh, other) if x == y) / len(mh)
+                if sim >= self.threshold and sim > best_sim:
+                    best_id, best_sim = sample_id, sim
+        return best_id, best_sim
+
+    def insert(self, sample_id, mh, group):
+        self.minhashes[sample_id] = mh
+        for band_key in self._band_keys(mh, group):
+            self.buckets[band_key].append(sample_id)
+
+
+class Deduplicator:
+    """
+    Index of kept samples. find() returns ("exact" | "near", matching id) or
+    (None, None); add() indexes a sample.
+    """
+
+    def __init__(self, near_threshold=0.9, near=True, seed=42):
+        self.exact = {} # signature key -> sample id
+        self.lsh = MinHashLSH(threshold=near_threshold, seed=seed) if near else None
+
+    def find(self, signature):
+        match = self.exact.get(signature["key"])
+        if match is not None:
+            return "exact", match
+        if self.lsh is not None:
+            signature.setdefault("minhash", self.lsh.minhash(signature["features"]))
+            match, _ = self.lsh.query(signature["minhash"], signature["group"])
+            if match is not None:
+                return "near", match
+        return None, None
+
+    def add(self, sample_id, signature):
+        self.exact[signature["key"]] = sample_id
+        if self.lsh is not None:
+            signature.setdefault("minhash", self.lsh.minhash(signature["features"]))
+            self.lsh.insert(sample_id, signature["minhash"], signature["group"])
+
+
+def _iter_with_context(canonical_path, context_path):
+    xf = open(context_path, "r") if context_path else None
+    try:
+        with open(canonical_path, "r") as cf:
+            for line in cf:
+                sample = json.loads(line)
+                context_line = next(xf, None) if xf else None
+                record = json.loads(context_line) if context_line else None
+                if record is not None and record["id"] != sample["id"]:
+                    raise ValueError(f"Context sidecar out of sync: {record['id']} != {sample['id']}")
+                yield line, sample, context_line, record
+    finally:
+        if xf:
+            xf.close()
+
+
+def _default_context_path(canonical_path, name="dataset_context.jsonl"):
+    candidate = os.path.join(os.path.dirname(canonical_path), name)
+    return candidate if os.path.exists(candidate) else None
+
+
+def dedup_files(canonical_path, finetune_path, output_dir, context_path=None, near_threshold=0.9, near=True):
+    """
+    Stream step 1 output and keep the first sample of every duplicate cluster.
+    Writes dataset_canonical.jsonl / dataset_finetune.jsonl (/ dataset_context.jsonl)
+    and dedup_report.json to output_dir. Finetune-only rows (sessions) are
+    passed through.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if context_path is None:
+        context_path = _default_context_path(canonical_path)
+    dedup = Deduplicator(near_threshold=near_threshold, near=near)
+    removed = Counter()
+    removed_by_tag = Counter()
+    kept = 0
+
+    out_canonical = os.path.join(output_dir, "dataset_canonical.jsonl")
+    out_finetune = os.path.join(output_dir, "dataset_finetune.jsonl")
+    out_context = os.path.join(output_dir, "dataset_context.jsonl") if context_path else None
+    with open(out_canonical, "w") as oc, open(out_finetune, "w") as of, open(finetune_path, "r") as ff:
+        ox = open(out_context, "w") if out_context else None
+        try:
+            for canonical_line, sample, context_line, record in _iter_with_context(canonical_path, context_path):
+                finetune_line = ff.readline()
+                signature = sample_signature(sample, record)
+                kind, _ = dedup.find(signature)
+                if kind is not None:
+                    removed[kind] += 1
+                    removed_by_tag[(sample.get("tags") or ["unknown"])[0]] += 1
+                    continue
+                dedup.add(sample["id"], signature)
+                oc.write(canonical_line)
+                of.write(finetune_line)
+                if ox:
+                    ox.write(context_line)
+                kept += 1
+            for finetune_line in ff:
+                of.write(finetune_line)
+        finally:
+            if ox:
+                ox.close()
+
+    report = {
+        "kept": kept,
+        "removed_exact": removed["exact"],
+        "removed_near": removed["near"],
+        "removed_by_tag": dict(removed_by_tag),
+        "near_threshold": near_threshold if near else None,
+    }
+    with open(os.path.join(output_dir, "dedup_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Dedup: kept {kept}, removed {removed['exact']} exact + {removed['near']} near duplicates -> {output_dir}")
+    return out_canonical, out_finetune, report
+
+
+def leakage_report(train_canonical, eval_canonical, train_context=None, eval_context=None, near_threshold=0.9, max_examples=20):
+    """
+    Eval samples whose signature matches (exactly or nearly) a train sample.
+    """
+    index = Deduplicator(near_threshold=near_threshold)
+    for _, sample, _, record in _iter_with_context(train_canonical, train_context):
+        signature = sample_signature(sample, record)
+        if index.exact.get(signature["key"]) is None:
+            index.add(sample["id"], signature)
+
+    leaked = Counter()
+    eval_by_tag = Counter()
+    leaked_by_tag = Counter()
+    examples = []
+    total = 0
+    for _, sample, _, record in _iter_with_context(eval_canonical, eval_context):
+        total += 1
+        tag = (sample.get("tags") or ["unknown"])[0]
+        eval_by_tag[tag] += 1
+        kind, train_id = index.find(sample_signature(sample, record))
+        if kind is None:
+            continue
+        leaked[kind] += 1
+        leaked_by_tag[tag] += 1
+        if len(examples) < max_examples:
+            examples.append({"eval_id": sample["id"], "train_id": train_id, "kind": kind})
+
+    return {
+        "eval_samples": total,
+        "leaked_exact": leaked["exact"],
+        "leaked_near": leaked["near"],
+        "leakage_rate": (leaked["exact"] + leaked["near"]) / total if total else 0.0,
+        "leakage_rate_by_tag": {tag: leaked_by_tag[tag] / count for tag, count in eval_by_tag.items()},
+        "near_threshold": near_threshold,
+        "examples": examples,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decision-signature dedup and train/eval leakage report")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_dedup = sub.add_parser("dedup", help="Remove duplicates from step 1 output")
+    p_dedup.add_argument("--canonical", required=True)
+    p_dedup.add_argument("--finetune", required=True)
+    p_dedup.add_argument("--context", default=None, help="dataset_context.jsonl (default: next to --canonical if present)")
+    p_dedup.add_argument("--output-dir", required=True)
+    p_dedup.add_argument("--near-threshold", type=float, default=0.9)
+    p_dedup.add_argument("--exact-only", action="store_true")
+
+    p_leak = sub.add_parser("leakage", help="Report eval samples duplicated in train")
+    p_leak.add_argument("--train", required=True, help="train_canonical.jsonl")
+    p_leak.add_argument("--eval", required=True, help="eval_canonical.jsonl")
+    p_leak.add_argument("--train-context", default=None)
+    p_leak.add_argument("--eval-context", default=None)
+    p_leak.add_argument("--near-threshold", type=float, default=0.9)
+    p_leak.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    if args.command == "dedup":
+        dedup_files(args.canonical, args.finetune, args.output_dir, context_path=args.context,
+                    near_threshold=args.near_threshold, near=not args.exact_only)
+    else:
+        report = leakage_report(args.train, args.eval, args.train_context, args.eval_context, near_threshold=args.near_threshold)
+        print(json.dumps({k: v for k, v in report.items() if k != "examples"}, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
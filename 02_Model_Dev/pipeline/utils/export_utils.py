@@ -0,0 +1,135 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftModel
+
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+
+# Quantization types convert_hf_to_gguf.py can write directly; others go through llama-quantize
+GGUF_DIRECT_TYPES = {"f32", "f16", "bf16", "q8_0"}
+
+
+def merge_adapter(base_model_name, adapter_path, output_dir, dtype=torch.float32):
+    """
+    Merge a LoRA adapter into the base model and save a plain HF checkpoint.
+    Export tools (ONNX, GGUF) only understand merged weights.
+    """
+    print(f"Merging adapter {adapter_path} into {base_model_name} ({dtype})")
+    base_model = AutoModelForCausalLM.from_pretrained(
+        base_model_name,
+        torch_dtype=dtype,
+        trust_remote_code=True
+    )
+    model = PeftModel.from_pretrained(base_model, adapter_path)
+    model = model.merge_and_unload()
+
+    # The adapter dir carries the tokenizer/chat template used in training
+    tokenizer_src = adapter_path if os.path.exists(os.path.join(adapter_path, "tokenizer_config.json")) else base_model_name
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_src, trust_remote_code=True)
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+    print(f"Merged model saved to {output_dir}")
+    return output_dir
+
+
+def export_onnx(merged_dir, output_dir, quantize=True):
+    """
+    Export a merged model to ONNX (with past key values for KV-cache decoding)
+    and optionally apply dynamic int8 quantization.
+    Returns the ONNX file name to load with OnnxBackend.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    except ImportError as e:
+        raise ImportError("ONNX export requires `pip install optimum[onnxruntime]`") from e
+
+    print(f"Exporting {merged_dir} to ONNX -> {output_dir}")
+    ort_model = ORTModelForCausalLM.from_pretrained(merged_dir, export=True, use_cache=True)
+    ort_model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(merged_dir).save_pretrained(output_dir)
+
+    if not quantize:
+        return "model.onnx"
+
+    print("Applying dynamic int8 quantization...")
+    quantizer = ORTQuantizer.from_pretrained(output_dir, file_name="model.onnx")
+    # Dynamic int8 needs no calibration data; the avx2 config runs on any modern x86 CPU
+    qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=qconfig)
+    return ONNX_QUANTIZED_FILE
+
+
+def _find_llama_quantize(llama_cpp_dir):
+    candidates = [
+        os.path.join(llama_cpp_dir, "build", "bin", "llama-quantize"),
+        os.path.join(llama_cpp_dir, "llama-quantize"),
+    ]
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    found = shutil.which("llama-quantize")
+    if found:
+        return found
+    raise FileNotFoundError(f"llama-quantize not found (looked in {candidates} and PATH). Build llama.cpp first.")
+
+
+def export_gguf(merged_dir, output_dir, quant_types=("Q8_0",), llama_cpp_dir=None):
+    """
+    Convert a merged HF checkpoint to GGUF with llama.cpp tooling.
+    Returns {quant_type: gguf_path}.
+    LLAMA_CPP_DIR (or llama_cpp_dir) must point to a llama.cpp checkout.
+    """
+    llama_cpp_dir = llama_cpp_dir or os.environ.get("LLAMA_CPP_DIR")
+    if not llama_cpp_dir:
+        raise ValueError("Set LLAMA_CPP_DIR to a llama.cpp checkout (needs convert_hf_to_gguf.py and llama-quantize)")
+    convert_script = os.path.join(llama_cpp_dir, "convert_hf_to_gguf.py")
+    os.makedirs(output_dir, exist_ok=True)
+
+    def convert(outtype, outfile):
+        print(f"Converting {merged_dir} -> {outfile} ({outtype})")
+        subprocess.run(
+            [sys.executable, convert_script, merged_dir, "--outfile", outfile, "--outtype", outtype],
+            check=True,
+        )
+        return outfile
+
+    paths = {}
+    f16_path = None
+    for quant in quant_types:
+        out_path = os.path.join(output_dir, f"model-{quant}.gguf")
+        if quant.lower() in GGUF_DIRECT_TYPES:
+            paths[quant] = convert(quant.lower(), out_path)
+            continue
+
+        # k-quants (Q4_K_M, ...) are produced from an f16 intermediate
+        if f16_path is None:
+            f16_path = convert("f16", os.path.join(output_dir, "model-f16.gguf"))
+        print(f"Quantizing -> {out_path} ({quant})")
+        subprocess.run([_find_llama_quantize(llama_cpp_dir), f16_path, out_path, quant], check=True)
+        paths[quant] = out_path
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter and export it to ONNX")
+    parser.add_argument("--adapter-path", required=True, help="Path to adapter (step 2 output)")
+    parser.add_argument("--base-model", type=str, default="google/functiongemma-270m-it")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--no-quantize", action="store_true", help="Skip dynamic int8 quantization")
+    args = parser.parse_args()
+
+    merged_dir = merge_adapter(args.base_model, args.adapter_path, os.path.join(args.output_dir, "merged"))
+    file_name = export_onnx(merged_dir, os.path.join(args.output_dir, "onnx"), quantize=not args.no_quantize)
+    print(f"✅ ONNX model ready: {os.path.join(args.output_dir, 'onnx', file_name)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,25 @@ import torch
 from typing import Any, Dict, List, Union
 
 class CompletionOnlyDataCollator(DataCollatorForLanguageModeling):
-    def __init__(self, response_template, tokenizer, mlm=False):
+    """
+    Trains only on model turns. Every `<start_of_turn>model` span is kept up to
+    and including its `<end_of_turn>`; the last span runs to the end of the
+    sequence (padding excluded), so single-turn samples are masked as before.
+    Multi-turn session samples therefore never train on user (delta) turns.
+    """
+    def __init__(self, response_template, tokenizer, mlm=False, end_of_turn="<end_of_turn>"):
         super().__init__(tokenizer=tokenizer, mlm=mlm)
         self.response_template = response_template
         self.response_token_ids = self.tokenizer.encode(self.response_template, add_special_tokens=False)
+        self.end_token_ids = self.tokenizer.encode(end_of_turn, add_special_tokens=False)
+
+    @staticmethod
+    def _find(ids, pattern, start=0):
+        n = len(pattern)
+        for j in range(start, len(ids) - n + 1):
+            if ids[j:j+n] == pattern:
+                return j
+        return -1
 
     def torch_call(self, examples: List[Union[List[int], Any, Dict[str, Any]]]) -> Dict[str, Any]:
         batch = super().torch_call(examples)
@@ -26,25 +41,30 @@ class CompletionOnlyDataCollator(DataCollatorForLanguageModeling):
         if self.tokenizer.pad_token_id is not None:
             labels[labels == self.tokenizer.pad_token_id] = -100
 
+        len_template = len(self.response_token_ids)
         for i in range(len(input_ids)):
-            # Find the start of the response
-            # We look for the sequence of response_token_ids
-            response_start_idx = -1
-            
-            # Simple linear search for the sub-sequence
-            len_template = len(self.response_token_ids)
-            for j in range(len(input_ids[i]) - len_template + 1):
-                if input_ids[i][j:j+len_template].tolist() == self.response_token_ids:
-                    response_start_idx = j + len_template # Start of the actual response
-                    break
-            
-            if response_start_idx != -1:
-                # Mask everything before the response
-                labels[i, :response_start_idx] = -100
-            else:
-                # If template not found, ignore the whole sample (or maybe just keep it? standard practice is ignore)
-                # But to be safe and avoid learning garbage:
+            ids = input_ids[i].tolist()
+
+            # Start of every model response (right after the template)
+            starts = []
+            j = self._find(ids, self.response_token_ids)
+            while j != -1:
+                starts.append(j + len_template)
+                j = self._find(ids, self.response_token_ids, j + len_template)
+
+            if not starts:
+                # If template not found, ignore the whole sample to avoid learning garbage
                 labels[i, :] = -100
+                continue
+
+            keep = torch.zeros(len(ids), dtype=torch.bool)
+            for k, start in enumerate(starts):
+                end = len(ids)
+                if k < len(starts) - 1:
+                    eot = self._find(ids, self.end_token_ids, start)
+                    end = eot + len(self.end_token_ids) if eot != -1 else starts[k + 1] - len_template
+                keep[start:end] = True
+            labels[i, ~keep] = -100
                 
         batch["labels"] = labels
         return batch
@@ -114,11 +134,12 @@ def get_data_collator(tokenizer):
         mlm=False
     )
 
-def get_training_args(output_dir, epochs=3, batch_size=4, learning_rate=2e-4):
+def get_training_args(output_dir, epochs=3, batch_size=4, learning_rate=2e-4, save_strategy="steps"):
     """
     Get stable training arguments.
     Disables fp16 on MPS to prevent NaNs.
     Adds gradient clipping.
+    save_strategy="no" when checkpoints are handled by utils.checkpointing.
     """
     # Check device for bf16/fp16 support
     is_mps = torch.backends.mps.is_available()
@@ -146,7 +167,7 @@ def get_training_args(output_dir, epochs=3, batch_size=4, learning_rate=2e-4):
         gradient_accumulation_steps=4, # From train_unsloth.py
         learning_rate=learning_rate,
         logging_steps=10,
-        save_strategy="steps",
+        save_strategy=save_strategy,
         save_steps=10,
         eval_strategy="no", # We evaluate separately
         
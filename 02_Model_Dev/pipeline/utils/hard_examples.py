@@ -0,0 +1,95 @@
+import json
+import random
+import re
+from collections import Counter
+
+from utils.dedup import parse_prompt
+
+# Hard-example mining for the active-learning loop in run_pipeline.py.
+# Failures in the eval_results.json of the dev split (never the eval split
+# the rounds are gated on) steer the next generation round:
+# - scenario weights follow the per-scenario failure rate, mixed with the
+#   base weights so every scenario is still replayed, and
+# - part of the slice are perturbed copies of the failing contexts
+#   (evolve_context noise moves them across nearby thresholds).
+
+REPLAY_WEIGHT = 0.2 # share of the base scenario weights in a hard-example round
+
+
+def error_category(error_type):
+    """
+    count_mismatch_expected_3_got_2 -> count_mismatch, item_1_not_dict -> item_not_dict.
+    """
+    if not error_type:
+        return "unknown"
+    return re.sub(r"_expected_\d+_got_\d+$", "", re.sub(r"^item_\d+_", "item_", error_type))
+
+
+def mine_failures(results_path):
+    """
+    Summary of the failed samples in an eval_results.json, including the
+    parsed (context, prompt_hint, scenario) of each failure with a full prompt.
+    """
+    with open(results_path, "r") as f:
+        results = json.load(f)
+
+    total_by_tag = Counter()
+    failed_by_tag = Counter()
+    error_types = Counter()
+    failing_contexts = []
+    for res in results:
+        tag = (res.get("tags") or ["unknown"])[0]
+        total_by_tag[tag] += 1
+        if res["is_correct"]:
+            continue
+        failed_by_tag[tag] += 1
+        error_types[error_category(res.get("error_type"))] += 1
+        context, hint = parse_prompt(res.get("input", ""))
+        if context is not None:
+            failing_contexts.append((context, hint, tag))
+
+    return {
+        "total": len(results),
+        "failed": sum(failed_by_tag.values()),
+        "failure_rate_by_tag": {tag: failed_by_tag[tag] / count for tag, count in total_by_tag.items()},
+        "failed_by_tag": dict(failed_by_tag),
+        "error_types": dict(error_types),
+        "failing_contexts": failing_contexts,
+    }
+
+
+def failure_weights(mined, scenario_types, base_weights):
+    """
+    (1 - REPLAY_WEIGHT) * failure-rate distribution + REPLAY_WEIGHT * base weights.
+    Without failures the base weights are returned.
+    """
+    rates = [mined["failure_rate_by_tag"].get(scenario, 0.0) for scenario in scenario_types]
+    base_total = sum(base_weights)
+    if sum(rates) == 0:
+        return [w / base_total for w in base_weights]
+    return [
+        (1.0 - REPLAY_WEIGHT) * rate / sum(rates) + REPLAY_WEIGHT * base / base_total
+        for rate, base in zip(rates, base_weights)
+    ]
+
+
+def generate_hard_contexts(mined, num_samples, scenario_weights, neighbor_fraction=0.5, max_steps=3):
+    """
+    [(context, prompt_hint, scenario_type)]: neighbor_fraction of the slice are
+    perturbed failing contexts, the rest is drawn with the failure weights.
+    Uses the global `random` state (seeded by the caller).
+    """
+    from step1_generate_data import generate_random_context, evolve_context
+
+    failing = mined["failing_contexts"]
+    num_neighbors = int(round(num_samples * neighbor_fraction)) if failing else 0
+    samples = []
+    for _ in range(num_neighbors):
+        context, hint, tag = random.choice(failing)
+        for _ in range(random.randint(1, max_steps)):
+            context = evolve_context(context, dt=random.uniform(1.0, 30.0))
+        samples.append((context, hint, tag))
+    for _ in range(num_samples - num_neighbors):
+        samples.append(generate_random_context(weights=scenario_weights))
+    random.shuffle(samples)
+    return samples
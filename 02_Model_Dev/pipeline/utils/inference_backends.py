@@ -0,0 +1,231 @@
+import time
+import torch
+from utils.tracing import StageTimer, FirstTokenStreamer
+
+RESPONSE_TEMPLATE = "<start_of_turn>model\n"
+END_OF_TURN = "<end_of_turn>"
+
+
+def format_prompt(prompt):
+    # FunctionGemma prompt format for inference
+    return f"<start_of_turn>user\n{prompt}{END_OF_TURN}\n{RESPONSE_TEMPLATE}"
+
+
+def extract_response(generated_text):
+    """
+    Take everything after <start_of_turn>model\\n until <end_of_turn>.
+    Falls back to the full text if the template is missing.
+    """
+    parts = generated_text.split(RESPONSE_TEMPLATE)
+    if len(parts) > 1:
+        return parts[1].split(END_OF_TURN)[0].strip()
+    return generated_text
+
+
+def generate_response(model, tokenizer, prompt, max_new_tokens=256, timer=None):
+    """
+    Greedy generation for any model exposing the HF generate() API
+    (transformers, PEFT, optimum ORTModelForCausalLM).
+    With a utils.tracing.StageTimer, records tokenize / prefill / decode /
+    detokenize stages (prefill = time to first token).
+    Returns (response_text, stats).
+    """
+    timer = timer or StageTimer()
+    with timer.stage("tokenize"):
+        inputs = tokenizer(format_prompt(prompt), return_tensors="pt").to(model.device)
+
+    streamer = FirstTokenStreamer()
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False, # Deterministic for eval
+            streamer=streamer,
+        )
+    generate_ms = (time.perf_counter() - streamer.start) * 1000.0
+    ttft_ms = streamer.ttft_ms()
+    if ttft_ms is not None:
+        timer.record("prefill", ttft_ms)
+        timer.record("decode", generate_ms - ttft_ms)
+    else:
+        timer.record("prefill", generate_ms)
+
+    with timer.stage("detokenize"):
+        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=False)
+        response = extract_response(generated_text)
+
+    prompt_tokens = inputs["input_ids"].shape[1]
+    stats = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": outputs.shape[1] - prompt_tokens,
+        "ttft_ms": ttft_ms,
+    }
+    return response, stats
+
+
+def generate_batch(model, tokenizer, prompts, adapter_names=None, max_new_tokens=256):
+    """
+    Greedy generation for a batch of prompts (left-padded).
+    With a multi-adapter PeftModel, adapter_names selects the LoRA adapter per
+    row ("__base__" = adapter disabled), so different adapters share one pass.
+    Returns a list of response texts.
+    """
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer([format_prompt(p) for p in prompts], return_tensors="pt", padding=True).to(model.device)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    terminators = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids(END_OF_TURN)]
+    kwargs = {"adapter_names": adapter_names} if adapter_names is not None else {}
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=terminators,
+            pad_token_id=tokenizer.pad_token_id,
+            **kwargs,
+        )
+
+    # Left padding: generated tokens start at the same column for every row
+    generated = outputs[:, inputs["input_ids"].shape[1]:]
+    return [text.strip() for text in tokenizer.batch_decode(generated, skip_special_tokens=True)]
+
+
+class InferenceBackend:
+    """
+    Minimal interface used by step3_evaluate: generate(prompt, timer=None) -> (text, stats).
+    `prompt` is the user message of a canonical sample (no chat markup);
+    `timer` is an optional utils.tracing.StageTimer for per-stage timings.
+    """
+    name = "base"
+
+    def generate(self, prompt, timer=None):
+        raise NotImplementedError
+
+
+class TorchBackend(InferenceBackend):
+    name = "torch"
+
+    def __init__(self, model, tokenizer, decoding="generate"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.decoding = decoding
+        self.decoder = None
+        if decoding == "structured":
+            from utils.structured_decoding import StructuredToolCallDecoder
+            self.decoder = StructuredToolCallDecoder(model, tokenizer)
+
+    def generate(self, prompt, timer=None):
+        if self.decoder is not None:
+            with (timer or StageTimer()).stage("structured_decode"):
+                text = self.decoder.decode(prompt)
+            return text, dict(self.decoder.last_stats)
+        return generate_response(self.model, self.tokenizer, prompt, timer=timer)
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    ONNX Runtime backend (CPU). Expects a directory produced by
+    utils/export_utils.py (merged model exported with past key values,
+    optionally dynamically quantized to int8).
+    """
+    name = "onnx"
+
+    def __init__(self, onnx_dir, file_name=None):
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError as e:
+            raise ImportError("ONNX backend requires `pip install optimum[onnxruntime]`") from e
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        # use_cache=True keeps the exported past_key_values inputs, so decoding
+        # only feeds the newest token each step
+        self.model = ORTModelForCausalLM.from_pretrained(
+            onnx_dir,
+            file_name=file_name,
+            use_cache=True,
+            provider="CPUExecutionProvider",
+        )
+
+    def generate(self, prompt, timer=None):
+        return generate_response(self.model, self.tokenizer, prompt, timer=timer)
+
+
+class LlamaCppBackend(InferenceBackend):
+    """
+    llama.cpp backend (the runtime shipped in the Android app via java-llama.cpp).
+    llama_cpp.Llama reuses the KV cache for the longest common token prefix
+    with the previous prompt; a RAM prompt cache additionally keeps states
+    for earlier prompts.
+    """
+    name = "llama_cpp"
+
+    def __init__(self, gguf_path, n_ctx=2048, n_threads=None, n_gpu_layers=0, prompt_cache_bytes=1 << 30):
+        try:
+            from llama_cpp import Llama, LlamaRAMCache
+        except ImportError as e:
+            raise ImportError("llama_cpp backend requires `pip install llama-cpp-python`") from e
+
+        print(f"Loading GGUF model: {gguf_path}")
+        self.llm = Llama(
+            model_path=gguf_path,
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            n_gpu_layers=n_gpu_layers,
+            verbose=False,
+        )
+        if prompt_cache_bytes:
+            self.llm.set_cache(LlamaRAMCache(capacity_bytes=prompt_cache_bytes))
+
+    def generate(self, prompt, timer=None):
+        if timer is not None:
+            return self._generate_traced(prompt, timer)
+        output = self.llm(
+            format_prompt(prompt),
+            max_tokens=256,
+            temperature=0.0,
+            stop=[END_OF_TURN],
+            echo=False,
+        )
+        usage = output.get("usage", {})
+        stats = {
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+        }
+        return output["choices"][0]["text"].strip(), stats
+
+    def _generate_traced(self, prompt, timer):
+        # Streaming mode: one chunk per token, so the first chunk marks TTFT
+        text = format_prompt(prompt)
+        with timer.stage("tokenize"):
+            prompt_tokens = len(self.llm.tokenize(text.encode("utf-8"), special=True))
+
+        start = time.perf_counter()
+        ttft_ms = None
+        pieces = []
+        for chunk in self.llm(text, max_tokens=256, temperature=0.0, stop=[END_OF_TURN], echo=False, stream=True):
+            if ttft_ms is None:
+                ttft_ms = (time.perf_counter() - start) * 1000.0
+            pieces.append(chunk["choices"][0]["text"])
+        total_ms = (time.perf_counter() - start) * 1000.0
+        timer.record("prefill", ttft_ms if ttft_ms is not None else total_ms)
+        if ttft_ms is not None:
+            timer.record("decode", total_ms - ttft_ms)
+
+        stats = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces),
+            "ttft_ms": ttft_ms,
+        }
+        return "".join(pieces).strip(), stats
+
+
+BACKENDS = {
+    "torch": TorchBackend,
+    "onnx": OnnxBackend,
+    "llama_cpp": LlamaCppBackend,
+}
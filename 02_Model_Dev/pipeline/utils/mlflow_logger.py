@@ -0,0 +1,160 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import mlflow
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.tracking import MlflowClient
+
+# MLflow's log_batch limits per request
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_PER_BATCH = 100
+MAX_TAGS_PER_BATCH = 100
+
+
+class BatchedLogger:
+    """
+    Logging facade for the pipeline steps.
+    - Params, metrics and tags are buffered per run (the run active at call
+      time) and written with MlflowClient.log_batch on flush(), instead of
+      one tracking request per value.
+    - Artifacts are uploaded on a background thread.
+    - flush() (end of each step) writes the buffers and waits for uploads.
+    Without an active run calls go straight to the fluent API, which starts
+    a run as before.
+    """
+
+    def __init__(self, max_buffered_metrics=MAX_METRICS_PER_BATCH):
+        self.max_buffered_metrics = max_buffered_metrics
+        self.errors = []
+        self.flush_ms = 0.0 # time spent in log_batch on the calling thread
+        self.upload_ms = 0.0 # background artifact upload time
+
+        self._client = None
+        self._buffers = {} # run_id -> {"params": {}, "metrics": [], "tags": {}}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = MlflowClient()
+        return self._client
+
+    def _buffer(self):
+        active = mlflow.active_run()
+        if active is None:
+            return None
+        return self._buffers.setdefault(active.info.run_id, {"params": {}, "metrics": [], "tags": {}})
+
+    # --- Params / metrics / tags ---
+
+    def log_params(self, params):
+        with self._lock:
+            buf = self._buffer()
+            if buf is not None:
+                buf["params"].update({k: str(v) for k, v in params.items()})
+                return
+        mlflow.log_params(params)
+
+    def log_param(self, key, value):
+        self.log_params({key: value})
+
+    def log_metrics(self, metrics, step=None):
+        timestamp = int(time.time() * 1000)
+        with self._lock:
+            buf = self._buffer()
+            if buf is not None:
+                buf["metrics"].extend(Metric(k, float(v), timestamp, step or 0) for k, v in metrics.items())
+                full = sum(len(b["metrics"]) for b in self._buffers.values()) >= self.max_buffered_metrics
+            else:
+                full = None
+        if full is None:
+            mlflow.log_metrics(metrics, step=step)
+        elif full:
+            self.flush(wait=False)
+
+    def log_metric(self, key, value, step=None):
+        self.log_metrics({key: value}, step=step)
+
+    def set_tags(self, tags):
+        with self._lock:
+            buf = self._buffer()
+            if buf is not None:
+                buf["tags"].update({k: str(v) for k, v in tags.items()})
+                return
+        mlflow.set_tags(tags)
+
+    def set_tag(self, key, value):
+        self.set_tags({key: value})
+
+    # --- Artifacts ---
+
+    def log_artifact(self, local_path, artifact_path=None):
+        self._upload("file", local_path, artifact_path)
+
+    def log_artifacts(self, local_dir, artifact_path=None):
+        self._upload("dir", local_dir, artifact_path)
+
+    def _upload(self, kind, path, artifact_path):
+        active = mlflow.active_run()
+        if active is None:
+            (mlflow.log_artifact if kind == "file" else mlflow.log_artifacts)(path, artifact_path)
+            return
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+        self._queue.put((kind, active.info.run_id, os.path.abspath(path), artifact_path))
+
+    def _run(self):
+        while True:
+            kind, run_id, path, artifact_path = self._queue.get()
+            start = time.perf_counter()
+            try:
+                if kind == "file":
+                    self.client.log_artifact(run_id, path, artifact_path)
+                else:
+                    self.client.log_artifacts(run_id, path, artifact_path)
+            except Exception as e:
+                self.errors.append(f"{type(e).__name__}: {e}")
+                print(f"⚠️ Artifact upload failed ({path}): {e}")
+            finally:
+                self.upload_ms += (time.perf_counter() - start) * 1000.0
+                self._queue.task_done()
+
+    # --- Flushing ---
+
+    def flush(self, wait=True):
+        """
+        Writes the buffered values of every run with log_batch; with wait=True
+        also blocks until the queued artifact uploads are done.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+        for run_id, buf in buffers.items():
+            params = [Param(k, v) for k, v in buf["params"].items()]
+            tags = [RunTag(k, v) for k, v in buf["tags"].items()]
+            metrics = buf["metrics"]
+            try:
+                for i in range(0, max(len(params), len(tags)), MAX_PARAMS_PER_BATCH):
+                    self.client.log_batch(run_id, params=params[i:i + MAX_PARAMS_PER_BATCH],
+                                          tags=tags[i:i + MAX_TAGS_PER_BATCH])
+                for i in range(0, len(metrics), MAX_METRICS_PER_BATCH):
+                    self.client.log_batch(run_id, metrics=metrics[i:i + MAX_METRICS_PER_BATCH])
+            except Exception as e:
+                self.errors.append(f"{type(e).__name__}: {e}")
+                print(f"⚠️ MLflow batch logging failed for run {run_id}: {e}")
+        self.flush_ms += (time.perf_counter() - start) * 1000.0
+        if wait:
+            self._queue.join()
+
+    def close(self):
+        self.flush(wait=True)
+
+
+# Shared by all steps so one flush covers everything logged in a step
+run_logger = BatchedLogger()
+atexit.register(run_logger.close)
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import mlflow
+import torch
+from transformers import AutoModelForCausalLM
+from peft import PeftModel
+from utils.mlflow_logger import run_logger
+
+CACHE_INFO_FILE = "cache_info.json"
+ADAPTER_FILES = ("adapter_config.json", "adapter_model.safetensors", "adapter_model.bin")
+
+
+def default_cache_dir():
+    """
+    MODEL_CACHE_DIR enables the cache for scripts without a CLI flag.
+    """
+    return os.environ.get("MODEL_CACHE_DIR")
+
+
+def adapter_hash(adapter_path):
+    h = hashlib.sha256()
+    for name in ADAPTER_FILES:
+        path = os.path.join(adapter_path, name)
+        if not os.path.exists(path):
+            continue
+        h.update(name.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(base_model_name, adapter_path, dtype):
+    parts = [base_model_name, str(dtype)]
+    if adapter_path:
+        parts.append(adapter_hash(adapter_path))
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+
+def _build(base_model_name, adapter_path, dtype, target_dir):
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model_name,
+        torch_dtype=dtype,
+        trust_remote_code=True
+    )
+    if adapter_path:
+        model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    model = model.to(dtype=dtype)
+
+    # Write to a temp dir and rename so an interrupted save never looks like a hit
+    tmp_dir = target_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    model.save_pretrained(tmp_dir, safe_serialization=True)
+    with open(os.path.join(tmp_dir, CACHE_INFO_FILE), "w") as f:
+        json.dump({
+            "base_model": base_model_name,
+            "adapter_path": os.path.abspath(adapter_path) if adapter_path else None,
+            "dtype": str(dtype),
+            "created_at": time.time(),
+        }, f, indent=2)
+    os.replace(tmp_dir, target_dir)
+    return model
+
+
+def load_cached_model(base_model_name, adapter_path=None, dtype=torch.float32, device="cpu", cache_dir=None):
+    """
+    Return a ready-to-run model (adapter merged, dtype converted).
+    The first call builds it and stores safetensors under cache_dir/<key>;
+    later calls load the safetensors file memory-mapped.
+    Load time is printed and logged as model_load_seconds when an MLflow run is active.
+    """
+    cache_dir = cache_dir or default_cache_dir() or os.path.expanduser("~/.cache/driver_assist/models")
+    key = cache_key(base_model_name, adapter_path, dtype)
+    target_dir = os.path.join(cache_dir, key)
+
+    start = time.perf_counter()
+    hit = os.path.exists(os.path.join(target_dir, CACHE_INFO_FILE))
+    if hit:
+        print(f"Loading cached model: {target_dir}")
+        model = AutoModelForCausalLM.from_pretrained(
+            target_dir,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True, # Tensors come straight from the mmap'd safetensors file
+        )
+    else:
+        print(f"Model cache miss ({key}), building merged model...")
+        os.makedirs(cache_dir, exist_ok=True)
+        model = _build(base_model_name, adapter_path, dtype, target_dir)
+
+    model = model.to(device)
+    model.eval()
+    load_seconds = time.perf_counter() - start
+
+    print(f"Model ready in {load_seconds:.2f}s (cache {'hit' if hit else 'miss'})")
+    if mlflow.active_run():
+        run_logger.log_metric("model_load_seconds", load_seconds)
+        run_logger.set_tag("model_cache", "hit" if hit else "miss")
+    return model
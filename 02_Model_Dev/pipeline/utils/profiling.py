@@ -0,0 +1,167 @@
+import json
+import os
+import time
+import mlflow
+import numpy as np
+import torch
+from transformers import TrainerCallback
+from utils.quantization import peak_rss_mb
+from utils.mlflow_logger import run_logger
+
+
+class TimedCollator:
+    """
+    Wraps a data collator and records the wall time of every call, so collation
+    can be separated from forward/backward in the step timings.
+    """
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.pending_ms = 0.0
+        self.calls = 0
+
+    def __call__(self, features):
+        start = time.perf_counter()
+        batch = self.collator(features)
+        self.pending_ms += (time.perf_counter() - start) * 1000.0
+        self.calls += 1
+        return batch
+
+    def pop_ms(self):
+        ms, self.pending_ms = self.pending_ms, 0.0
+        return ms
+
+    def __getattr__(self, name):
+        return getattr(self.collator, name)
+
+
+def allocator_memory_mb():
+    """
+    Accelerator allocator stats where available (CUDA peak since last reset, MPS current).
+    """
+    if torch.cuda.is_available():
+        return {
+            "cuda_allocated_mb": torch.cuda.memory_allocated() / (1024 * 1024),
+            "cuda_peak_allocated_mb": torch.cuda.max_memory_allocated() / (1024 * 1024),
+            "cuda_reserved_mb": torch.cuda.memory_reserved() / (1024 * 1024),
+        }
+    if torch.backends.mps.is_available() and hasattr(torch, "mps"):
+        return {
+            "mps_allocated_mb": torch.mps.current_allocated_memory() / (1024 * 1024),
+            "mps_driver_allocated_mb": torch.mps.driver_allocated_memory() / (1024 * 1024),
+        }
+    return {}
+
+
+class ProfilingCallback(TrainerCallback):
+    """
+    Opt-in profiling for step 2:
+    - torch.profiler trace for `active` optimizer steps after `wait` + `warmup`
+    - per-step wall time split into collator vs forward/backward/optimizer
+    - peak RSS and allocator memory per step
+    Everything is written to output_dir and attached to the active MLflow run
+    under `profiling/`.
+    """
+
+    def __init__(self, output_dir, timed_collator=None, wait=1, warmup=1, active=3):
+        self.output_dir = output_dir
+        self.timed_collator = timed_collator
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.profiler = None
+        self.steps = []
+        self._step_start = None
+        self._tables_written = False
+
+    def _on_trace_ready(self, prof):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prof.export_chrome_trace(os.path.join(self.output_dir, "profiler_trace.json"))
+
+        averages = prof.key_averages()
+        tables = {
+            "profiler_ops_cpu_time.txt": averages.table(sort_by="self_cpu_time_total", row_limit=40),
+            "profiler_ops_cpu_memory.txt": averages.table(sort_by="self_cpu_memory_usage", row_limit=40),
+        }
+        if torch.cuda.is_available():
+            tables["profiler_ops_cuda_time.txt"] = averages.table(sort_by="self_cuda_time_total", row_limit=40)
+        for name, table in tables.items():
+            with open(os.path.join(self.output_dir, name), "w") as f:
+                f.write(table)
+        self._tables_written = True
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.profiler.start()
+        if self.timed_collator is not None:
+            self.timed_collator.pop_ms() # drop collation done before training started
+        self._step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        step_ms = (now - self._step_start) * 1000.0
+        self._step_start = now
+        collator_ms = self.timed_collator.pop_ms() if self.timed_collator is not None else 0.0
+
+        record = {
+            "step": state.global_step,
+            "step_ms": step_ms,
+            "collator_ms": collator_ms,
+            "compute_ms": step_ms - collator_ms,
+            "peak_rss_mb": peak_rss_mb(),
+            **allocator_memory_mb(),
+        }
+        self.steps.append(record)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if mlflow.active_run():
+            run_logger.log_metrics({f"profile_{k}": v for k, v in record.items() if k != "step"}, step=state.global_step)
+
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def summary(self):
+        summary = {"steps": len(self.steps)}
+        if not self.steps:
+            return summary
+        for key in ("step_ms", "collator_ms", "compute_ms"):
+            values = [s[key] for s in self.steps]
+            summary[f"{key}_mean"] = float(np.mean(values))
+            summary[f"{key}_p50"] = float(np.percentile(values, 50))
+            summary[f"{key}_p95"] = float(np.percentile(values, 95))
+        total_step_ms = sum(s["step_ms"] for s in self.steps)
+        summary["collator_share"] = sum(s["collator_ms"] for s in self.steps) / total_step_ms if total_step_ms else 0.0
+        summary["peak_rss_mb"] = max(s["peak_rss_mb"] for s in self.steps)
+        for key in ("cuda_peak_allocated_mb", "mps_driver_allocated_mb"):
+            if key in self.steps[0]:
+                summary[key] = max(s[key] for s in self.steps)
+        return summary
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, "step_profile.json"), "w") as f:
+            json.dump(self.steps, f, indent=2)
+        with open(os.path.join(self.output_dir, "profile_summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+        if not self._tables_written:
+            print(f"⚠️ Training ended before the profiler window ({self.wait}+{self.warmup}+{self.active} steps); no trace recorded")
+        print(f"Profiling summary: {json.dumps(summary)}")
+
+        if mlflow.active_run():
+            run_logger.log_metrics({f"profile_{k}": v for k, v in summary.items() if isinstance(v, (int, float))})
+            run_logger.log_artifacts(self.output_dir, artifact_path="profiling")
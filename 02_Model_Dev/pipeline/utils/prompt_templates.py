@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+
+# Prompt templates by id. Datasets store the raw context + prompt hint and the
+# template id (dataset_context.jsonl), so prompts can be rendered again, or
+# with a different template, without parsing prompt text.
+
+FULL_TEMPLATE_V1 = """You are FunctionGemma, a function selection model for a driver assistance demo.
+
+Input context is structured sensor state (do not invent fields):
+{context}
+
+User prompt:
+{prompt_hint}
+
+Return ONLY a JSON array of tool calls. Each item must be:
+{{"name": "<tool_name>", "arguments": {{ ... }}}}
+
+Allowed tool names:
+- trigger_steering_vibration
+- trigger_navigation_notification
+- trigger_drowsiness_alert_sound
+- trigger_cluster_visual_warning
+- trigger_hud_warning
+- trigger_voice_prompt
+- escalate_warning_level
+- trigger_rest_recommendation
+- log_safety_event
+- request_safe_mode
+
+If no action is needed, return:
+[{{"name":"log_safety_event","arguments":{{"message":"no_action_selected"}}}}]
+"""
+
+DELTA_TEMPLATE_V1 = """Sensor update (changed fields only, all other fields unchanged):
+{context}
+
+User prompt:
+{prompt_hint}
+
+Return ONLY a JSON array of tool calls.
+"""
+
+TEMPLATES = {
+    "full_v1": (FULL_TEMPLATE_V1, {"indent": 2}),
+    "delta_v1": (DELTA_TEMPLATE_V1, {"separators": (",", ":")}),
+}
+DEFAULT_TEMPLATE_ID = "full_v1"
+DELTA_TEMPLATE_ID = "delta_v1"
+
+
+def render_prompt(context, prompt_hint, template_id=DEFAULT_TEMPLATE_ID):
+    if template_id not in TEMPLATES:
+        raise ValueError(f"Unknown template id: {template_id} (available: {', '.join(TEMPLATES)})")
+    template, json_kwargs = TEMPLATES[template_id]
+    return template.format(context=json.dumps(context, **json_kwargs), prompt_hint=prompt_hint)
+
+
+def context_record(sample_id, context, prompt_hint, expected, scenario, template_id=DEFAULT_TEMPLATE_ID):
+    """
+    One line of dataset_context.jsonl (same order and ids as dataset_canonical.jsonl).
+    """
+    return {
+        "id": sample_id,
+        "template_id": template_id,
+        "context": context,
+        "prompt_hint": prompt_hint,
+        "expected": expected,
+        "scenario": scenario,
+    }
+
+
+def iter_context_records(path):
+    with open(path, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def rerender(context_path, output_dir, template_id=None):
+    """
+    Rebuild canonical + finetune files from a context sidecar.
+    template_id=None keeps each record's own template.
+    """
+    from step1_generate_data import format_for_finetuning
+
+    os.makedirs(output_dir, exist_ok=True)
+    canonical_path = os.path.join(output_dir, "dataset_canonical.jsonl")
+    finetune_path = os.path.join(output_dir, "dataset_finetune.jsonl")
+    count = 0
+    with open(canonical_path, "w") as cf, open(finetune_path, "w") as ff:
+        for rec in iter_context_records(context_path):
+            prompt_text = render_prompt(rec["context"], rec["prompt_hint"], template_id or rec["template_id"])
+            cf.write(json.dumps({
+                "id": rec["id"],
+                "messages": [{"role": "user", "content": prompt_text}],
+                "expected": rec["expected"],
+                "tags": [rec["scenario"]],
+                "metadata": {"scenario": rec["scenario"], "complexity": len(rec["expected"])},
+            }) + "\n")
+            ff.write(json.dumps(format_for_finetuning(prompt_text, rec["expected"])) + "\n")
+            count += 1
+    print(f"Rendered {count} samples ({template_id or 'stored templates'}) to {output_dir}")
+    return canonical_path, finetune_path
+
+
+if __name__ == "__main__":
+    # Run as a script from pipeline/: make step1_generate_data and utils importable
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    parser = argparse.ArgumentParser(description="Re-render prompts from dataset_context.jsonl")
+    parser.add_argument("--context", required=True, help="Path to dataset_context.jsonl (step 1 output)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--template", type=str, default=None, choices=sorted(TEMPLATES))
+    args = parser.parse_args()
+
+    rerender(args.context, args.output_dir, args.template)
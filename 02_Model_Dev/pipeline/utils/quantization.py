@@ -0,0 +1,99 @@
+import ctypes
+import gc
+import resource
+import sys
+import torch
+from peft import PeftModel
+
+QUANT_MODES = ["none", "int8", "int4"]
+
+
+def quantize_model(model, mode="none", group_size=32):
+    """
+    CPU post-training quantization, applied after merging the LoRA adapter.
+    - int8: torch.ao dynamic quantization of every nn.Linear (weights int8,
+      activations quantized on the fly)
+    - int4: torchao weight-only int4 (grouped), bf16 activations
+    Returns a plain (non-PEFT) model on CPU.
+    """
+    if mode == "none":
+        return model
+    if mode not in QUANT_MODES:
+        raise ValueError(f"Unknown quantization mode: {mode} (available: {', '.join(QUANT_MODES)})")
+
+    if isinstance(model, PeftModel):
+        print("Merging adapter before quantization...")
+        model = model.merge_and_unload()
+    model = model.to("cpu")
+    model.eval()
+
+    print(f"Quantizing model on CPU ({mode})...")
+    if mode == "int8":
+        model = model.float()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif mode == "int4":
+        try:
+            from torchao.quantization import quantize_, int4_weight_only
+            from torchao.dtypes import Int4CPULayout
+        except ImportError as e:
+            raise ImportError("int4 quantization requires `pip install torchao`") from e
+        model = model.to(torch.bfloat16)
+        quantize_(model, int4_weight_only(group_size=group_size, layout=Int4CPULayout()))
+
+    return model
+
+
+def tensor_nbytes(value, seen=None):
+    """
+    Storage bytes of a state_dict value: plain and quantized tensors, packed
+    (weight, bias) tuples of dynamic int8 Linear and tensor subclasses such as
+    torchao's int4 weights (summed over their inner tensors). Shared storage
+    (tied embeddings) is counted once.
+    """
+    seen = set() if seen is None else seen
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_nbytes(v, seen) for v in value)
+    if not isinstance(value, torch.Tensor):
+        return 0
+    if hasattr(value, "__tensor_flatten__"):
+        names, _ = value.__tensor_flatten__()
+        return sum(tensor_nbytes(getattr(value, name), seen) for name in names)
+    key = (value.data_ptr(), value.numel())
+    if key in seen:
+        return 0
+    seen.add(key)
+    return value.numel() * value.element_size()
+
+
+def model_size_mb(model):
+    """
+    In-memory size of parameters and buffers, without serializing the model.
+    """
+    seen = set()
+    return sum(tensor_nbytes(v, seen) for v in model.state_dict().values()) / (1024 * 1024)
+
+
+def current_rss_mb(release=True):
+    """
+    Resident set size right now. With release, garbage is collected and freed
+    heap returned to the OS first (glibc malloc_trim), so a dropped fp32 copy
+    no longer counts. Falls back to the process peak without /proc (macOS).
+    """
+    if release:
+        gc.collect()
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # Process lifetime peak: only meaningful for one model per process (e.g. training)
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
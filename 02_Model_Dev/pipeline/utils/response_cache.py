@@ -0,0 +1,126 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Decision thresholds from determine_actions (step1_generate_data.py).
+# Values on the same side of every threshold lead to the same tool calls.
+LANE_CONFIDENCE_THRESHOLDS = [0.7]
+DROWSY_CONFIDENCE_THRESHOLDS = [0.8]
+SPEED_THRESHOLDS = [90, 100]
+COLLISION_RISK_THRESHOLDS = [0.75]
+WARNING_SECONDS_THRESHOLDS = [60]
+
+
+def bucket(value, thresholds):
+    """
+    Index of the bin `value` falls into: 0 below the first threshold,
+    len(thresholds) at or above the last one.
+    """
+    return sum(1 for t in thresholds if value >= t)
+
+
+def canonicalize_context(context):
+    """
+    Replace continuous sensor fields with their decision bins and drop fields
+    that never influence the selected tools (driving duration, model confidence).
+    Categorical fields are kept as-is.
+    """
+    canonical = json.loads(json.dumps(context)) # deep copy, same shape as the prompt JSON
+
+    canonical["lane_departure"]["confidence"] = bucket(context["lane_departure"]["confidence"], LANE_CONFIDENCE_THRESHOLDS)
+    canonical["driver_drowsiness"]["confidence"] = bucket(context["driver_drowsiness"]["confidence"], DROWSY_CONFIDENCE_THRESHOLDS)
+    canonical["vehicle_speed_kph"] = bucket(context["vehicle_speed_kph"], SPEED_THRESHOLDS)
+    canonical["forward_collision_risk"] = bucket(context["forward_collision_risk"], COLLISION_RISK_THRESHOLDS)
+    canonical["recent_warning_history"]["seconds_ago"] = bucket(context["recent_warning_history"]["seconds_ago"], WARNING_SECONDS_THRESHOLDS)
+    canonical.pop("driving_duration_minutes", None)
+    canonical.get("sensor_health_status", {}).pop("ai_model_confidence", None)
+    return canonical
+
+
+def context_key(context, prompt_hint=""):
+    """
+    Stable cache key: the canonical context serialized as JSON (like
+    construct_prompt, but with sorted keys) plus the user prompt hint.
+    """
+    payload = json.dumps({"context": canonicalize_context(context), "prompt": prompt_hint}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache with TTL for model responses.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if self.ttl_seconds and now >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + (self.ttl_seconds or 0)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "cache_entries": len(self._entries),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_evictions": self.evictions,
+            "cache_expirations": self.expirations,
+            "cache_hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedInference:
+    """
+    Inference entry point for raw sensor contexts with a response cache in
+    front of any backend from utils.inference_backends.
+    infer(context, prompt_hint) -> (response_text, stats, cache_hit)
+    """
+
+    def __init__(self, backend, cache=None, render_prompt=None):
+        if render_prompt is None:
+            from step1_generate_data import construct_prompt as render_prompt
+        self.backend = backend
+        self.cache = cache or ResponseCache()
+        self.render_prompt = render_prompt
+
+    def infer(self, context, prompt_hint):
+        key = context_key(context, prompt_hint)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, {}, True
+
+        text, stats = self.backend.generate(self.render_prompt(context, prompt_hint))
+        self.cache.put(key, text)
+        return text, stats, False
@@ -0,0 +1,97 @@
+import torch
+from transformers import DynamicCache
+from utils.inference_backends import RESPONSE_TEMPLATE, END_OF_TURN
+
+
+class DrivingSession:
+    """
+    Multi-turn inference for consecutive sensor frames of one drive.
+    The first frame is sent as the full construct_prompt(); later frames only
+    send the changed fields (construct_delta_prompt) as a new user turn on top
+    of the KV cache kept from earlier turns, matching the session samples
+    produced by step1_generate_data --session-samples.
+    The session re-prefills from scratch when the cache would exceed
+    max_cache_tokens (keep it at or below the training max_length).
+    """
+
+    def __init__(self, model, tokenizer, max_cache_tokens=1024, max_new_tokens=256):
+        from step1_generate_data import construct_prompt, construct_delta_prompt, context_delta
+        self._full_prompt = construct_prompt
+        self._delta_prompt = construct_delta_prompt
+        self._delta = context_delta
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_cache_tokens = max_cache_tokens
+        self.max_new_tokens = max_new_tokens
+        self.terminators = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids(END_OF_TURN)}
+        self.reset()
+
+    def reset(self):
+        self.past = None
+        self.prev_context = None
+        self.turns = 0
+
+    def cached_tokens(self):
+        return self.past.get_seq_length() if self.past is not None else 0
+
+    def _greedy(self, input_ids):
+        """
+        Prefill input_ids on top of self.past, then decode greedily.
+        The terminator itself is not fed back, so the cache ends right after
+        the last response token.
+        """
+        generated = []
+        finished = False
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids, past_key_values=self.past, use_cache=True)
+            for _ in range(self.max_new_tokens):
+                next_id = int(out.logits[0, -1].argmax())
+                if next_id in self.terminators:
+                    finished = True
+                    break
+                generated.append(next_id)
+                next_input = torch.tensor([[next_id]], device=input_ids.device)
+                out = self.model(input_ids=next_input, past_key_values=out.past_key_values, use_cache=True)
+        self.past = out.past_key_values
+        return generated, finished
+
+    def step(self, context, prompt_hint):
+        """
+        Returns (response_text, stats). stats["prompt_tokens"] counts only the
+        tokens prefilled for this turn.
+        """
+        turn_text = None
+        if self.prev_context is not None:
+            delta_prompt = self._delta_prompt(self._delta(self.prev_context, context), prompt_hint)
+            # Close the previous model turn (its terminator was not fed back) and open a new one
+            turn_text = f"{END_OF_TURN}\n<start_of_turn>user\n{delta_prompt}{END_OF_TURN}\n{RESPONSE_TEMPLATE}"
+            turn_ids = self.tokenizer(turn_text, add_special_tokens=False, return_tensors="pt")["input_ids"]
+            if self.cached_tokens() + turn_ids.shape[1] + self.max_new_tokens > self.max_cache_tokens:
+                turn_text = None
+
+        reset = turn_text is None
+        if reset:
+            self.reset()
+            self.past = DynamicCache()
+            full_text = f"<start_of_turn>user\n{self._full_prompt(context, prompt_hint)}{END_OF_TURN}\n{RESPONSE_TEMPLATE}"
+            turn_ids = self.tokenizer(full_text, return_tensors="pt")["input_ids"]
+
+        turn_ids = turn_ids.to(self.model.device)
+        generated, finished = self._greedy(turn_ids)
+
+        if finished:
+            self.prev_context = context
+            self.turns += 1
+        else:
+            # Hit max_new_tokens mid-response; the cache no longer matches the
+            # training format, so start over on the next frame
+            self.reset()
+
+        stats = {
+            "prompt_tokens": turn_ids.shape[1],
+            "completion_tokens": len(generated),
+            "cached_tokens": self.cached_tokens(),
+            "session_reset": reset,
+        }
+        return self.tokenizer.decode(generated, skip_special_tokens=True).strip(), stats
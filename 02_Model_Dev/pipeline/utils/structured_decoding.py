@@ -0,0 +1,198 @@
+import copy
+import json
+import torch
+
+# Argument values the generator can emit for each tool (see determine_actions in
+# step1_generate_data.py). Key order matches the training data so the scored
+# text is exactly what the model saw during fine-tuning.
+TOOL_ARGUMENT_CHOICES = {
+    "trigger_steering_vibration": {
+        "intensity": ["high", "medium"],
+    },
+    "trigger_navigation_notification": {
+        "message": [
+            "Bad weather: rain. Drive carefully.",
+            "Bad weather: snow. Drive carefully.",
+            "Bad weather: fog. Drive carefully.",
+        ],
+        "level": ["info"],
+    },
+    "trigger_drowsiness_alert_sound": {
+        "volume_percent": [100],
+    },
+    "trigger_cluster_visual_warning": {
+        "message": ["Camera Fail. System Disabled.", "LKA is OFF", "Keep hands on wheel", "BRAKE!"],
+        "level": ["critical", "warning"],
+    },
+    "trigger_hud_warning": {
+        "message": ["Lane Departure", "COLLISION WARNING"],
+        "level": ["warning", "critical"],
+    },
+    "trigger_voice_prompt": {
+        "message": [
+            "Pulling over safely.",
+            "Are you drowsy? Please take a rest.",
+            "Please hold the steering wheel.",
+        ],
+        "level": ["critical", "warning"],
+    },
+    "escalate_warning_level": {
+        "level": ["critical"],
+    },
+    "trigger_rest_recommendation": {
+        "reason": ["Drowsiness detected"],
+    },
+    "log_safety_event": {
+        "message": ["sensor_failure_camera", "status_normal", "no_action_selected"],
+    },
+    "request_safe_mode": {
+        "reason": ["Driver unresponsive to drowsiness warnings"],
+    },
+}
+
+CALL_PREFIX = '[{"name": "'
+NEXT_CALL = ', {"name": "'
+END_OF_CALLS = "]<end_of_turn>"
+
+
+def _expand_cache(past, n):
+    """Copy a KV cache and repeat it n times along the batch dimension."""
+    past = copy.deepcopy(past)
+    if hasattr(past, "batch_repeat_interleave"):
+        past.batch_repeat_interleave(n)
+        return past
+    return tuple(tuple(t.repeat_interleave(n, dim=0) for t in layer) for layer in past)
+
+
+def _select_cache(past, index, length):
+    """Row `index` of a batched KV cache, cropped to `length` positions (drops the right padding)."""
+    if hasattr(past, "batch_select_indices"):
+        past.batch_select_indices(torch.tensor([index]))
+        if past.get_seq_length() > length:
+            past.crop(length)
+        return past
+    return tuple(tuple(t[index : index + 1, :, :length] for t in layer) for layer in past)
+
+
+class StructuredToolCallDecoder:
+    """
+    Decodes tool calls as a sequence of choices instead of free-form text.
+    Each decision (tool name, argument value, continue/stop) scores every
+    candidate continuation in one batched forward pass on top of the prompt's
+    KV cache; the winner's cache row and last logits are kept from that pass.
+    Decisions with a single candidate cost no forward pass at all.
+    The output is json.dumps() of the chosen calls, so it is directly
+    comparable with ToolCallMatchMetric.
+    """
+
+    def __init__(self, model, tokenizer, tool_choices=None, max_calls=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.tool_choices = tool_choices or TOOL_ARGUMENT_CHOICES
+        self.max_calls = max_calls or len(self.tool_choices)
+        self.last_stats = {}
+
+    def _encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def _forward(self, input_ids, attention_mask, past=None):
+        with torch.no_grad():
+            out = self.model(
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
+                past_key_values=past,
+                use_cache=True,
+            )
+        self.last_stats["forward_passes"] += 1
+        return out
+
+    def _prefill(self, prompt):
+        formatted_prompt = f"<start_of_turn>user\n{prompt}<end_of_turn>\n<start_of_turn>model\n"
+        inputs = self.tokenizer(formatted_prompt, return_tensors="pt")
+        out = self._forward(inputs["input_ids"], inputs["attention_mask"])
+        return out.past_key_values, out.logits[0, -1].float(), inputs["input_ids"].shape[1]
+
+    def _commit(self, state, ids):
+        past, _, length = state
+        input_ids = torch.tensor([ids])
+        attention_mask = torch.ones(1, length + len(ids), dtype=torch.long)
+        out = self._forward(input_ids, attention_mask, past)
+        return out.past_key_values, out.logits[0, -1].float(), length + len(ids)
+
+    def _choose(self, state, pending, candidates):
+        """
+        Score `pending + candidate` for every candidate and keep the best one's
+        cache row from the same pass. Returns (best_index, new_state).
+        """
+        past, last_logits, length = state
+        sequences = [self._encode(pending + c) for c in candidates]
+        n = len(sequences)
+        max_len = max(len(s) for s in sequences)
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+        # Right-pad candidates so every row keeps contiguous positions after the prefix
+        input_ids = torch.full((n, max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros(n, length + max_len, dtype=torch.long)
+        attention_mask[:, :length] = 1
+        for i, seq in enumerate(sequences):
+            input_ids[i, : len(seq)] = torch.tensor(seq)
+            attention_mask[i, length : length + len(seq)] = 1
+
+        out = self._forward(input_ids, attention_mask, _expand_cache(past, n))
+        logprobs = torch.log_softmax(out.logits.float(), dim=-1).cpu()
+        first_logprobs = torch.log_softmax(last_logits, dim=-1).cpu()
+
+        scores = []
+        for i, seq in enumerate(sequences):
+            score = first_logprobs[seq[0]].item()
+            if len(seq) > 1:
+                targets = torch.tensor(seq[1:]).unsqueeze(-1)
+                score += logprobs[i, : len(seq) - 1].gather(-1, targets).sum().item()
+            scores.append(score)
+
+        best = max(range(n), key=lambda i: scores[i])
+        self.last_stats["decisions"] += 1
+        best_len = len(sequences[best])
+        try:
+            new_past = _select_cache(out.past_key_values, best, length + best_len)
+        except (NotImplementedError, ValueError):
+            # Cache type without row selection / cropping: re-run the winner
+            return best, self._commit(state, sequences[best])
+        return best, (new_past, out.logits[best, best_len - 1].float(), length + best_len)
+
+    def decode(self, prompt):
+        self.last_stats = {"decisions": 0, "forward_passes": 0}
+        state = self._prefill(prompt)
+
+        calls = []
+        remaining = list(self.tool_choices)
+        pending = CALL_PREFIX
+
+        while True:
+            # Tool names are unique within one response (determine_actions deduplicates)
+            idx, state = self._choose(state, pending, [f'{name}", "arguments": {{' for name in remaining])
+            name = remaining.pop(idx)
+            pending = ""
+
+            arguments = {}
+            for arg_idx, (key, values) in enumerate(self.tool_choices[name].items()):
+                pending += ("" if arg_idx == 0 else ", ") + f'"{key}": '
+                rendered = [json.dumps(v) for v in values]
+                if len(values) == 1:
+                    choice = 0
+                    pending += rendered[0]
+                else:
+                    choice, state = self._choose(state, pending, rendered)
+                    pending = ""
+                arguments[key] = values[choice]
+            calls.append({"name": name, "arguments": arguments})
+            pending += "}}"
+
+            if not remaining or len(calls) >= self.max_calls:
+                break
+            idx, state = self._choose(state, pending, [NEXT_CALL, END_OF_CALLS])
+            if idx == 1:
+                break
+            pending = ""
+
+        return json.dumps(calls)
@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+import numpy as np
+
+
+class StageTimer:
+    """
+    Per-sample wall-clock timings by stage (tokenize, prefill, decode,
+    detokenize, parse, geval, ...). Repeated stages accumulate.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000.0)
+
+    def record(self, name, ms):
+        self.timings[name] = self.timings.get(name, 0.0) + ms
+
+    def as_dict(self):
+        return {name: round(ms, 3) for name, ms in self.timings.items()}
+
+
+class FirstTokenStreamer:
+    """
+    generate() streamer that only notes when the first new token arrives.
+    The first put() carries the prompt ids, the second one the first sampled
+    token, so time-to-first-token covers the prefill pass.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self._calls = 0
+
+    def put(self, value):
+        self._calls += 1
+        if self._calls == 2 and self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def end(self):
+        pass
+
+    def ttft_ms(self):
+        if self.first_token_at is None:
+            return None
+        return (self.first_token_at - self.start) * 1000.0
+
+
+def summarize_timings(timings, prefix="timing"):
+    """
+    [{stage: ms}, ...] -> {f"{prefix}_{stage}_ms_p50": ..., "_p95", "_p99", "_mean"}
+    Samples that skipped a stage (e.g. geval past the judge limit) are left out
+    of that stage's percentiles.
+    """
+    stages = {}
+    for timing in timings:
+        for name, ms in timing.items():
+            stages.setdefault(name, []).append(ms)
+
+    metrics = {}
+    for name, values in stages.items():
+        metrics[f"{prefix}_{name}_ms_mean"] = float(np.mean(values))
+        metrics[f"{prefix}_{name}_ms_p50"] = float(np.percentile(values, 50))
+        metrics[f"{prefix}_{name}_ms_p95"] = float(np.percentile(values, 95))
+        metrics[f"{prefix}_{name}_ms_p99"] = float(np.percentile(values, 99))
+    return metrics
@@ -0,0 +1,309 @@
+import argparse
+import json
+import os
+import string
+import time
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.tokenization_utils_base import BatchEncoding
+
+VOCAB_MAP_FILE = "vocab_map.json"
+
+# The driver-assist prompts and outputs only use a small slice of the Gemma
+# vocabulary (fixed template, JSON punctuation, tool names, messages, digits).
+# A trimmed model keeps only those rows of the embedding table and LM head;
+# new token id i is original id keep_ids[i]. TrimmedTokenizer maps between the
+# two id spaces around the original tokenizer.
+
+
+def _iter_texts(path):
+    """
+    Training/eval texts of a finetune JSONL ({"text"}), a canonical JSONL
+    ({"messages", "expected"}) or a Parquet dataset.
+    """
+    from utils.inference_backends import format_prompt
+
+    def canonical_text(sample):
+        user_msg = next((m["content"] for m in sample["messages"] if m["role"] == "user"), "")
+        return format_prompt(user_msg) + json.dumps(sample["expected"])
+
+    if path.endswith(".parquet"):
+        from utils.columnar_dataset import iter_canonical
+        for sample in iter_canonical(path):
+            yield canonical_text(sample)
+        return
+    with open(path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            yield record["text"] if "text" in record else canonical_text(record)
+
+
+def collect_vocab(tokenizer, dataset_paths):
+    """
+    Sorted original token ids needed for the datasets, plus special tokens,
+    the prompt templates and every printable ASCII character.
+    """
+    from utils.prompt_templates import TEMPLATES
+
+    keep = set(tokenizer.all_special_ids)
+    for token in ("<start_of_turn>", "<end_of_turn>"):
+        token_id = tokenizer.convert_tokens_to_ids(token)
+        if token_id is not None and token_id != tokenizer.unk_token_id:
+            keep.add(token_id)
+    texts = [template for template, _ in TEMPLATES.values()] + list(string.printable)
+    for text in texts:
+        keep.update(tokenizer.encode(text, add_special_tokens=False))
+
+    samples = 0
+    for path in dataset_paths:
+        print(f"Scanning {path}...")
+        for text in _iter_texts(path):
+            keep.update(tokenizer.encode(text, add_special_tokens=True))
+            samples += 1
+    print(f"Kept {len(keep)} of {len(tokenizer)} tokens ({samples} samples)")
+    return sorted(keep)
+
+
+class TrimmedTokenizer:
+    """
+    Original tokenizer with ids remapped to the trimmed vocabulary.
+    Supports what generate_response / generate_batch use: __call__, decode,
+    batch_decode, convert_tokens_to_ids and the special token ids. Tokens
+    outside the kept vocabulary encode to the unknown token and are counted in
+    `oov_tokens`.
+    """
+
+    def __init__(self, tokenizer, keep_ids):
+        self.tokenizer = tokenizer
+        self.keep_ids = list(keep_ids)
+        self.old_to_new = {old: new for new, old in enumerate(self.keep_ids)}
+        self.unk_id = self.old_to_new.get(tokenizer.unk_token_id, 0)
+        self.oov_tokens = 0
+
+    def __len__(self):
+        return len(self.keep_ids)
+
+    def __getattr__(self, name):
+        # padding_side, eos_token, chat_template, ...
+        return getattr(self.tokenizer, name)
+
+    def _to_new(self, token_id):
+        new_id = self.old_to_new.get(token_id)
+        if new_id is None:
+            self.oov_tokens += 1
+            return self.unk_id
+        return new_id
+
+    def _to_old(self, token_ids):
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        return [self.keep_ids[i] for i in token_ids]
+
+    def __call__(self, text, return_tensors=None, **kwargs):
+        encoding = self.tokenizer(text, **kwargs)
+        ids = encoding["input_ids"]
+        if ids and isinstance(ids[0], list):
+            encoding["input_ids"] = [[self._to_new(i) for i in row] for row in ids]
+        else:
+            encoding["input_ids"] = [self._to_new(i) for i in ids]
+        return BatchEncoding(dict(encoding), tensor_type=return_tensors)
+
+    def encode(self, text, **kwargs):
+        return [self._to_new(i) for i in self.tokenizer.encode(text, **kwargs)]
+
+    def decode(self, token_ids, **kwargs):
+        return self.tokenizer.decode(self._to_old(token_ids), **kwargs)
+
+    def batch_decode(self, sequences, **kwargs):
+        return [self.decode(seq, **kwargs) for seq in sequences]
+
+    def convert_tokens_to_ids(self, tokens):
+        ids = self.tokenizer.convert_tokens_to_ids(tokens)
+        if isinstance(ids, list):
+            return [self._to_new(i) for i in ids]
+        return self._to_new(ids)
+
+    def _special(self, token_id):
+        return self.old_to_new.get(token_id) if token_id is not None else None
+
+    @property
+    def padding_side(self):
+        return self.tokenizer.padding_side
+
+    @padding_side.setter
+    def padding_side(self, value):
+        self.tokenizer.padding_side = value
+
+    @property
+    def eos_token_id(self):
+        return self._special(self.tokenizer.eos_token_id)
+
+    @property
+    def pad_token_id(self):
+        return self._special(self.tokenizer.pad_token_id)
+
+    @property
+    def bos_token_id(self):
+        return self._special(self.tokenizer.bos_token_id)
+
+    @property
+    def unk_token_id(self):
+        return self.unk_id
+
+
+def _remap_ids(value, old_to_new):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [old_to_new[v] for v in value if v in old_to_new]
+    return old_to_new.get(value)
+
+
+def trim_model(model, keep_ids):
+    """
+    Slice the input embeddings and LM head to keep_ids in place (the
+    embedding module class, e.g. Gemma's scaled embedding, is preserved) and
+    update vocab_size and the special token ids in the configs.
+    """
+    keep = torch.tensor(keep_ids, dtype=torch.long)
+    old_to_new = {old: new for new, old in enumerate(keep_ids)}
+
+    embeddings = model.get_input_embeddings()
+    lm_head = model.get_output_embeddings()
+    tied = lm_head is not None and lm_head.weight is embeddings.weight
+
+    embeddings.weight = torch.nn.Parameter(embeddings.weight.data[keep].clone())
+    embeddings.num_embeddings = len(keep_ids)
+    if embeddings.padding_idx is not None:
+        embeddings.padding_idx = old_to_new.get(embeddings.padding_idx)
+    if lm_head is not None:
+        if tied:
+            lm_head.weight = embeddings.weight
+        else:
+            lm_head.weight = torch.nn.Parameter(lm_head.weight.data[keep].clone())
+            if lm_head.bias is not None:
+                lm_head.bias = torch.nn.Parameter(lm_head.bias.data[keep].clone())
+        lm_head.out_features = len(keep_ids)
+
+    for config in (model.config, getattr(model.config, "text_config", None), model.generation_config):
+        if config is None:
+            continue
+        if hasattr(config, "vocab_size"):
+            config.vocab_size = len(keep_ids)
+        for attr in ("bos_token_id", "eos_token_id", "pad_token_id"):
+            if getattr(config, attr, None) is not None:
+                setattr(config, attr, _remap_ids(getattr(config, attr), old_to_new))
+    return model
+
+
+def trim_adapter_model(base_model_name, adapter_path, dataset_paths, output_dir):
+    """
+    Merge the adapter, trim the vocabulary to the datasets and save the
+    trimmed model, the original tokenizer and vocab_map.json to output_dir/trimmed.
+    """
+    from utils.export_utils import merge_adapter
+
+    merged_dir = merge_adapter(base_model_name, adapter_path, os.path.join(output_dir, "merged"))
+    tokenizer = AutoTokenizer.from_pretrained(merged_dir, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(merged_dir, torch_dtype=torch.float32, trust_remote_code=True)
+
+    keep_ids = collect_vocab(tokenizer, dataset_paths)
+    embedding_params_before = model.get_input_embeddings().weight.numel()
+    trim_model(model, keep_ids)
+    embedding_params_after = model.get_input_embeddings().weight.numel()
+
+    trimmed_dir = os.path.join(output_dir, "trimmed")
+    os.makedirs(trimmed_dir, exist_ok=True)
+    model.save_pretrained(trimmed_dir, safe_serialization=True)
+    tokenizer.save_pretrained(trimmed_dir)
+    stats = {
+        "original_vocab_size": len(tokenizer),
+        "trimmed_vocab_size": len(keep_ids),
+        "embedding_params_before": embedding_params_before,
+        "embedding_params_after": embedding_params_after,
+        "datasets": list(dataset_paths),
+    }
+    with open(os.path.join(trimmed_dir, VOCAB_MAP_FILE), "w") as f:
+        json.dump({"keep_ids": keep_ids, **stats}, f)
+    print(f"Trimmed model saved to {trimmed_dir} ({stats['original_vocab_size']} -> {stats['trimmed_vocab_size']} tokens)")
+    return trimmed_dir, stats
+
+
+def is_trimmed_model(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, VOCAB_MAP_FILE))
+
+
+def load_trimmed_model(model_dir, dtype=None, device=None):
+    """
+    (model, TrimmedTokenizer) for a trim_adapter_model output dir.
+    """
+    dtype = dtype or (torch.float16 if torch.cuda.is_available() else torch.float32)
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    with open(os.path.join(model_dir, VOCAB_MAP_FILE), "r") as f:
+        keep_ids = json.load(f)["keep_ids"]
+
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=dtype, trust_remote_code=True).to(device)
+    model.eval()
+    tokenizer = TrimmedTokenizer(AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True), keep_ids)
+    print(f"Trimmed model ready in {time.perf_counter() - start:.2f}s ({len(keep_ids)} tokens)")
+    return model, tokenizer
+
+
+def run_trim_parity(adapter_path, base_model_name, dataset_paths, eval_dataset, output_dir):
+    """
+    Trim, then evaluate the merged untrimmed checkpoint (output_dir/merged)
+    and the trimmed model on eval_dataset with step 3 and compare them sample
+    by sample. Both are plain checkpoints of the same merged weights, so the
+    differences come from the trimming alone, not from PEFT vs merged inference.
+    """
+    from step3_evaluate import run_evaluation
+    from backend_parity import compare_results
+
+    trimmed_dir, stats = trim_adapter_model(base_model_name, adapter_path, dataset_paths, output_dir)
+    merged_dir = os.path.join(output_dir, "merged")
+
+    runs = {}
+    for name, model_path in (("original", merged_dir), ("trimmed", trimmed_dir)):
+        print(f"\n[Vocab Trim Parity] {name}")
+        metrics, res_path, _ = run_evaluation(
+            model_path=model_path,
+            dataset_path=eval_dataset,
+            base_model_name=base_model_name,
+            output_dir=os.path.join(output_dir, f"eval_{name}"),
+        )
+        with open(res_path, "r") as f:
+            runs[name] = {"metrics": metrics, "results": json.load(f)}
+
+    original, trimmed = runs["original"]["metrics"], runs["trimmed"]["metrics"]
+    report = {
+        **stats,
+        "baseline_model": merged_dir,
+        "accuracy_original": original["accuracy_total"],
+        "accuracy_trimmed": trimmed["accuracy_total"],
+        "accuracy_delta": trimmed["accuracy_total"] - original["accuracy_total"],
+        "latency_speedup_p50": original["latency_ms_p50"] / trimmed["latency_ms_p50"] if trimmed.get("latency_ms_p50") else None,
+        **compare_results(runs["original"]["results"], runs["trimmed"]["results"]),
+    }
+    report_path = os.path.join(output_dir, "trim_parity_report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Vocab {stats['original_vocab_size']} -> {stats['trimmed_vocab_size']}, "
+          f"accuracy {report['accuracy_original']:.2%} -> {report['accuracy_trimmed']:.2%}, "
+          f"output agreement {report['output_agreement']:.2%}")
+    return report, report_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trim the vocabulary of a fine-tuned model to the driver-assist datasets")
+    parser.add_argument("--model-path", required=True, help="Adapter dir (step 2 final_model)")
+    parser.add_argument("--base-model", default="google/functiongemma-270m-it")
+    parser.add_argument("--datasets", nargs="+", required=True, help="Finetune/canonical JSONL or Parquet files to keep tokens for")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--eval-dataset", default=None, help="Canonical dataset for the accuracy parity check (skipped if not set)")
+    args = parser.parse_args()
+
+    if args.eval_dataset:
+        run_trim_parity(args.model_path, args.base_model, args.datasets, args.eval_dataset, args.output_dir)
+    else:
+        trim_adapter_model(args.base_model, args.model_path, args.datasets, args.output_dir)